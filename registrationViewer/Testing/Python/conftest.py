@@ -0,0 +1,10 @@
+"""
+Makes registrationViewerLib importable when the tests run with pytest outside Slicer:
+
+    python -m pytest registrationViewer/Testing/Python
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
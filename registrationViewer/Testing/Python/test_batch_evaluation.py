@@ -0,0 +1,122 @@
+"""
+Tests of the metrics of the headless evaluation.
+"""
+
+import importlib.util
+import unittest
+
+import numpy as np
+
+from registrationViewerLib import warping
+
+# the evaluation reads images with SimpleITK, which Slicer ships
+if importlib.util.find_spec("SimpleITK") is not None:
+    from registrationViewerLib import batch_evaluation
+else:
+    batch_evaluation = None
+
+
+def _affine_field(matrix: np.ndarray, ijk_to_ras: np.ndarray, shape=(6, 7, 8)) -> warping.DisplacementField:
+    """
+    Field of p -> matrix @ p sampled on a grid, its Jacobian is the linear part of the matrix.
+    """
+
+    points = warping.voxel_grid_ras(ijk_to_ras, shape)
+    displacements = warping.apply_matrix(matrix, points) - points
+
+    return warping.DisplacementField(displacements.reshape(shape + (3,)).astype(np.float32), ijk_to_ras)
+
+
+@unittest.skipIf(batch_evaluation is None, "SimpleITK is not installed")
+class IntensityMetricsTest(unittest.TestCase):
+
+    def test_identical_images(self):
+        fixed = np.random.default_rng(0).normal(size=(4, 5, 6))
+
+        metrics = batch_evaluation.intensity_metrics(fixed, fixed, np.zeros_like(fixed), chunk_voxels=20)
+
+        self.assertEqual(metrics["mae"], 0.0)
+        self.assertEqual(metrics["rmse"], 0.0)
+        self.assertAlmostEqual(metrics["ncc"], 1.0)
+
+    def test_against_numpy(self):
+        rng = np.random.default_rng(1)
+        fixed = rng.integers(0, 100, size=(4, 5, 6)).astype(np.int16)
+        warped = (0.5 * fixed + rng.normal(size=fixed.shape)).astype(np.float32)
+        diff = fixed - warped
+
+        metrics = batch_evaluation.intensity_metrics(fixed, warped, diff, chunk_voxels=20)
+
+        self.assertAlmostEqual(metrics["mae"], float(np.abs(diff).mean()), places=5)
+        self.assertAlmostEqual(metrics["rmse"], float(np.sqrt((diff.astype(np.float64) ** 2).mean())), places=5)
+        self.assertAlmostEqual(metrics["ncc"], float(np.corrcoef(fixed.ravel(), warped.ravel())[0, 1]), places=5)
+
+    def test_constant_image_has_no_ncc(self):
+        fixed = np.ones((2, 2, 2))
+
+        self.assertTrue(np.isnan(batch_evaluation.intensity_metrics(fixed, fixed, fixed * 0)["ncc"]))
+
+
+@unittest.skipIf(batch_evaluation is None, "SimpleITK is not installed")
+class DiceOverlapTest(unittest.TestCase):
+
+    def test_mean_over_labels(self):
+        fixed = np.zeros((2, 4, 4), dtype=np.uint8)
+        warped = np.zeros_like(fixed)
+        fixed[0, :2, :2] = 1
+        warped[0, :2, :1] = 1
+        fixed[1] = 2
+        warped[1] = 2
+
+        metrics = batch_evaluation.dice_overlap(fixed, warped, chunk_voxels=16)
+
+        # label 1: 2 * 2 / (4 + 2), label 2: 1
+        self.assertAlmostEqual(metrics["dice"], (2 / 3 + 1) / 2)
+        self.assertEqual(metrics["labels"], 2)
+
+    def test_background_only(self):
+        labels = np.zeros((2, 2, 2), dtype=np.uint8)
+
+        metrics = batch_evaluation.dice_overlap(labels, labels)
+
+        self.assertTrue(np.isnan(metrics["dice"]))
+        self.assertEqual(metrics["labels"], 0)
+
+
+@unittest.skipIf(batch_evaluation is None, "SimpleITK is not installed")
+class JacobianMetricsTest(unittest.TestCase):
+
+    def test_affine_field_has_the_determinant_of_its_matrix(self):
+        matrix = np.array([[1.2, 0.1, 0.0, 3.0],
+                           [0.0, 0.8, 0.3, -2.0],
+                           [0.1, 0.0, 1.1, 1.0],
+                           [0.0, 0.0, 0.0, 1.0]])
+
+        # anisotropic, rotated grid, so the derivatives have to be turned into spatial ones
+        ijk_to_ras = np.eye(4)
+        angle = 0.5
+        ijk_to_ras[:3, :3] = np.array([[np.cos(angle), -np.sin(angle), 0.0],
+                                       [np.sin(angle), np.cos(angle), 0.0],
+                                       [0.0, 0.0, 1.0]]) * [1.5, 2.0, 3.0]
+        field = _affine_field(matrix, ijk_to_ras)
+
+        # slabs of two slices with their halo
+        metrics = batch_evaluation.jacobian_metrics(field, chunk_voxels=2 * 7 * 8)
+
+        determinant = np.linalg.det(matrix[:3, :3])
+        self.assertAlmostEqual(metrics["jacobian_min"], determinant, places=4)
+        self.assertAlmostEqual(metrics["jacobian_max"], determinant, places=4)
+        self.assertAlmostEqual(metrics["jacobian_mean"], determinant, places=4)
+        self.assertEqual(metrics["folding_fraction"], 0.0)
+
+    def test_mirroring_field_folds(self):
+        field = _affine_field(np.diag([-1.0, 1.0, 1.0, 1.0]), np.eye(4))
+
+        metrics = batch_evaluation.jacobian_metrics(field)
+
+        self.assertAlmostEqual(metrics["jacobian_mean"], -1.0, places=5)
+        self.assertEqual(metrics["folding_fraction"], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Tests of the compact storage of displacement fields.
+"""
+
+import unittest
+
+import numpy as np
+
+from registrationViewerLib import compact_field, warping
+
+
+def _field_array() -> np.ndarray:
+    return np.random.default_rng(0).uniform(-20, 35, size=(7, 6, 5, 3))
+
+
+class CompactDisplacementsTest(unittest.TestCase):
+
+    def test_same_dtype_is_returned_unchanged(self):
+        array = _field_array().astype(np.float32)
+
+        compact, scale, shift, error_bound = compact_field.compact_displacements(array, np.float32)
+
+        self.assertIs(compact, array)
+        self.assertEqual((scale, shift, error_bound), (1.0, 0.0, 0.0))
+
+    def test_float32_error_is_bounded(self):
+        array = _field_array()
+
+        compact, scale, shift, error_bound = compact_field.compact_displacements(array, np.float32,
+                                                                                 chunk_voxels=40)
+
+        self.assertEqual(compact.dtype, np.float32)
+        self.assertEqual((scale, shift), (1.0, 0.0))
+        self.assertLessEqual(np.abs(compact.astype(np.float64) - array).max(), error_bound)
+
+    def test_int16_error_is_bounded(self):
+        array = _field_array()
+
+        compact, scale, shift, error_bound = compact_field.compact_displacements(array, np.int16,
+                                                                                 chunk_voxels=40)
+
+        self.assertEqual(compact.dtype, np.int16)
+        self.assertLessEqual(np.abs(compact * scale + shift - array).max(), error_bound * (1 + 1e-9))
+        # the range is used symmetrically
+        self.assertEqual(int(np.abs(compact).max()), np.iinfo(np.int16).max)
+
+    def test_constant_field_is_exact(self):
+        array = np.full((2, 3, 4, 3), 1.25)
+
+        compact, scale, shift, error_bound = compact_field.compact_displacements(array, np.int16)
+
+        np.testing.assert_array_equal(compact * scale + shift, array)
+        self.assertLessEqual(error_bound, 0.5)
+
+    def test_compact_field_interpolates_like_the_original(self):
+        array = _field_array()
+        ijk_to_ras = np.diag([1.5, 2.0, 2.5, 1.0])
+
+        compact, scale, shift, error_bound = compact_field.compact_displacements(array, np.int16)
+        original = warping.DisplacementField(array.astype(np.float32), ijk_to_ras)
+        quantised = warping.DisplacementField(compact, ijk_to_ras, displacement_scale=scale, displacement_shift=shift)
+
+        points = np.random.default_rng(1).uniform(0, 8, size=(50, 3))
+
+        # trilinear weights sum to one, so the interpolated error keeps the bound
+        np.testing.assert_allclose(quantised.transform_points(points), original.transform_points(points),
+                                   atol=error_bound + 1e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+Tests of the on-disk index of the original data.
+"""
+
+import os
+import tempfile
+import unittest
+
+from registrationViewerLib import dataset_index
+
+
+def _touch(path: str) -> None:
+    with open(path, "w"):
+        pass
+
+
+class DatasetIndexTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._directory = tempfile.TemporaryDirectory()
+        self.data_path = os.path.join(self._directory.name, "data")
+        self.index_path = dataset_index.default_index_path(self.data_path, os.path.join(self._directory.name, "cache"))
+
+        for subdirectory in ("imagesTr", "labelsTr"):
+            os.makedirs(os.path.join(self.data_path, subdirectory))
+        _touch(os.path.join(self.data_path, "imagesTr", "case_001.nii.gz"))
+        _touch(os.path.join(self.data_path, "imagesTr", "case_002.nii.gz"))
+        _touch(os.path.join(self.data_path, "imagesTr", "notes.txt"))
+        _touch(os.path.join(self.data_path, "labelsTr", "case_001.nii.gz"))
+
+    def tearDown(self) -> None:
+        self._directory.cleanup()
+
+    def _index(self) -> dataset_index.DatasetIndex:
+        index = dataset_index.DatasetIndex(self.data_path, self.index_path)
+        index.refresh()
+        return index
+
+    def test_find_lists_the_case_in_every_subdirectory(self):
+        index = self._index()
+
+        self.assertEqual(index.find("case_001"), [os.path.join(self.data_path, "imagesTr", "case_001.nii.gz"),
+                                                  os.path.join(self.data_path, "labelsTr", "case_001.nii.gz")])
+        self.assertEqual(index.find("notes"), [])
+        self.assertEqual((index.hits, index.misses), (1, 1))
+
+    def test_index_is_read_back_without_listing(self):
+        self._index()
+
+        index = dataset_index.DatasetIndex(self.data_path, self.index_path)
+
+        self.assertEqual(len(index.find("case_002")), 1)
+        self.assertEqual(index.rescanned_directories, 0)
+
+    def test_refresh_lists_only_modified_subdirectories(self):
+        index = self._index()
+        self.assertEqual(index.rescanned_directories, 2)
+
+        labels_path = os.path.join(self.data_path, "labelsTr")
+        _touch(os.path.join(labels_path, "case_002.nii.gz"))
+        stat = os.stat(labels_path)
+        os.utime(labels_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+        index.refresh()
+
+        self.assertEqual(index.rescanned_directories, 3)
+        self.assertEqual(len(index.find("case_002")), 2)
+
+    def test_removed_subdirectory_is_dropped(self):
+        index = self._index()
+
+        os.remove(os.path.join(self.data_path, "labelsTr", "case_001.nii.gz"))
+        os.rmdir(os.path.join(self.data_path, "labelsTr"))
+        index.refresh()
+
+        self.assertEqual(len(index.find("case_001")), 1)
+
+    def test_index_of_another_version_is_ignored(self):
+        self._index()
+        with open(self.index_path) as index_file:
+            content = index_file.read()
+        with open(self.index_path, "w") as index_file:
+            index_file.write(content.replace(f'"version": {dataset_index.INDEX_VERSION}', '"version": -1'))
+
+        index = dataset_index.DatasetIndex(self.data_path, self.index_path)
+
+        self.assertEqual(index.find("case_001"), [])
+
+    def test_unreadable_index_is_ignored(self):
+        os.makedirs(os.path.dirname(self.index_path))
+        with open(self.index_path, "w") as index_file:
+            index_file.write("{")
+
+        with self.assertLogs(level="WARNING"):
+            index = dataset_index.DatasetIndex(self.data_path, self.index_path)
+
+        self.assertEqual(index.find("case_001"), [])
+
+
+class SegmentationPathTest(unittest.TestCase):
+
+    def test_masks_and_labels_are_segmentations(self):
+        self.assertTrue(dataset_index.is_segmentation_path("/data/labelsTr/case_001.nii.gz"))
+        self.assertTrue(dataset_index.is_segmentation_path("/data/masks/case_001.nii.gz"))
+        self.assertFalse(dataset_index.is_segmentation_path("/data/imagesTr/case_001.nii.gz"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+Tests of the tiled difference.
+"""
+
+import unittest
+
+import numpy as np
+
+from registrationViewerLib import difference, warping
+
+
+class DifferenceDtypeTest(unittest.TestCase):
+
+    def test_integer_inputs_get_a_wider_signed_type(self):
+        self.assertEqual(difference.difference_dtype(np.uint8, np.uint8), np.int16)
+        self.assertEqual(difference.difference_dtype(np.int16, np.int16), np.int32)
+        self.assertEqual(difference.difference_dtype(np.int8, np.int8), np.int16)
+
+    def test_float_inputs_stay_float(self):
+        self.assertEqual(difference.difference_dtype(np.int16, np.float32), np.float32)
+        self.assertEqual(difference.difference_dtype(np.float64, np.float32), np.float64)
+
+    def test_uint64_falls_back_to_float64(self):
+        self.assertEqual(difference.difference_dtype(np.uint64, np.uint64), np.float64)
+
+
+class SubtractTiledTest(unittest.TestCase):
+
+    def test_int16_extremes_do_not_wrap(self):
+        fixed = np.full((5, 3, 4), np.iinfo(np.int16).max, dtype=np.int16)
+        warped = np.full((5, 3, 4), np.iinfo(np.int16).min, dtype=np.int16)
+        warped[2] = np.iinfo(np.int16).max
+        out = np.empty(fixed.shape, dtype=difference.difference_dtype(fixed.dtype, warped.dtype))
+        fractions = []
+
+        # one slice per tile
+        difference.subtract_tiled(fixed, warped, out, max_tile_bytes=1, progress_callback=fractions.append)
+
+        expected = fixed.astype(np.int64) - warped.astype(np.int64)
+        np.testing.assert_array_equal(out, expected)
+        self.assertEqual(len(fractions), 5)
+        self.assertEqual(fractions[-1], 1.0)
+
+    def test_shapes_must_match(self):
+        with self.assertRaises(AssertionError):
+            difference.subtract_tiled(np.zeros((2, 2, 2)), np.zeros((2, 2, 3)), np.zeros((2, 2, 2)))
+
+
+class WarpAndSubtractTest(unittest.TestCase):
+
+    def test_identity_gives_zero_difference(self):
+        fixed = np.random.default_rng(0).integers(0, 1000, size=(4, 5, 6)).astype(np.int16)
+        warped = np.empty_like(fixed)
+        diff = np.empty(fixed.shape, dtype=difference.difference_dtype(fixed.dtype, fixed.dtype))
+        fractions = []
+
+        difference.warp_and_subtract(fixed, np.eye(4), fixed, np.eye(4), warping.AffineMapping(np.eye(4)),
+                                     warped, diff, progress_callback=fractions.append)
+
+        np.testing.assert_array_equal(warped, fixed)
+        np.testing.assert_array_equal(diff, 0)
+        self.assertEqual(fractions, sorted(fractions))
+        self.assertEqual(fractions[-1], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+Tests of the inversion of displacement fields.
+"""
+
+import unittest
+
+import numpy as np
+
+from registrationViewerLib import inverse_field, warping
+
+
+def _smooth_field(shape=(12, 14, 16), amplitude: float = 1.5) -> warping.DisplacementField:
+    """
+    Smooth, invertible field on a 2 mm grid.
+    """
+
+    k, j, i = np.meshgrid(*[np.arange(n) for n in shape], indexing='ij')
+
+    array = np.stack([amplitude * np.sin(2 * np.pi * k / shape[0]),
+                      amplitude * np.cos(2 * np.pi * i / shape[2]),
+                      amplitude * np.sin(2 * np.pi * j / shape[1])], axis=-1).astype(np.float32)
+
+    ijk_to_ras = np.diag([2.0, 2.0, 2.0, 1.0])
+    ijk_to_ras[:3, 3] = [-10, 5, 0]
+
+    return warping.DisplacementField(array, ijk_to_ras)
+
+
+class InvertDisplacementFieldTest(unittest.TestCase):
+
+    def test_round_trip_returns_to_the_start(self):
+        field = _smooth_field()
+        fractions = []
+
+        inverse, residual_max, residual_mean = inverse_field.invert_displacement_field(
+            field, chunk_voxels=500, progress_callback=fractions.append)
+
+        self.assertEqual(inverse.array.shape, field.array.shape)
+        self.assertLess(residual_max, 0.01)
+        self.assertLessEqual(residual_mean, residual_max)
+        self.assertEqual(fractions[-1], 1.0)
+
+        # moving -> fixed -> moving on the grid points, away from the border where the field is clamped
+        points = warping.voxel_block_ras(field.ijk_to_ras, np.arange(3, 9), np.arange(3, 11), np.arange(3, 13))
+        round_trip = field.transform_points(inverse.transform_points(points))
+
+        np.testing.assert_allclose(round_trip, points, atol=0.01)
+
+        # between the grid points the inverse is interpolated
+        points = np.random.default_rng(0).uniform([-4, 11, 6], [16, 25, 16], size=(200, 3))
+        round_trip = inverse.transform_points(field.transform_points(points))
+
+        np.testing.assert_allclose(round_trip, points, atol=0.2)
+
+    def test_zero_field_is_its_own_inverse(self):
+        field = warping.DisplacementField(np.zeros((3, 4, 5, 3), dtype=np.float32), np.eye(4))
+
+        inverse, residual_max, _ = inverse_field.invert_displacement_field(field)
+
+        np.testing.assert_array_equal(inverse.array, 0)
+        self.assertEqual(residual_max, 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""
+Tests of the cache of decoded compressed images.
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from registrationViewerLib import nifti_cache
+
+
+class NiftiCacheTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._directory = tempfile.TemporaryDirectory()
+        self.cache = nifti_cache.NiftiCache(os.path.join(self._directory.name, "cache"))
+
+        self.source_path = os.path.join(self._directory.name, "case_001.nii.gz")
+        with open(self.source_path, "wb") as source_file:
+            source_file.write(b"compressed")
+
+        self.array = np.arange(24, dtype=np.int16).reshape(2, 3, 4)
+        self.ijk_to_ras = np.diag([1.0, 2.0, 3.0, 1.0])
+
+    def tearDown(self) -> None:
+        self._directory.cleanup()
+
+    def test_stored_file_is_returned(self):
+        self.cache.put(self.source_path, self.array, self.ijk_to_ras, metadata={"displacement_scale": 0.5})
+
+        array, ijk_to_ras, metadata = self.cache.get(self.source_path)
+
+        np.testing.assert_array_equal(array, self.array)
+        np.testing.assert_array_equal(ijk_to_ras, self.ijk_to_ras)
+        self.assertEqual(metadata, {"displacement_scale": 0.5})
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+
+    def test_variants_are_separate_entries(self):
+        self.cache.put(self.source_path, self.array, self.ijk_to_ras, variant="volume")
+
+        self.assertIsNone(self.cache.get(self.source_path, variant="transform"))
+        self.assertIsNotNone(self.cache.get(self.source_path, variant="volume"))
+
+    def test_modified_source_misses(self):
+        self.cache.put(self.source_path, self.array, self.ijk_to_ras)
+
+        with open(self.source_path, "ab") as source_file:
+            source_file.write(b"more")
+
+        self.assertIsNone(self.cache.get(self.source_path))
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_entry_evicted_while_reading_is_a_miss(self):
+        self.cache.put(self.source_path, self.array, self.ijk_to_ras)
+
+        # another load removes the header between reading and touching it
+        with mock.patch.object(nifti_cache.os, "utime", side_effect=FileNotFoundError):
+            self.assertIsNone(self.cache.get(self.source_path))
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        other_path = os.path.join(self._directory.name, "case_002.nii.gz")
+        with open(other_path, "wb") as source_file:
+            source_file.write(b"other")
+
+        self.cache.max_bytes = int(1.5 * self.array.nbytes) + 256
+        self.cache.put(self.source_path, self.array, self.ijk_to_ras)
+
+        # the header times are the LRU times, make the first entry clearly older
+        header_path = self.cache._paths(self.cache.key(self.source_path))[1]  # pylint: disable=protected-access
+        os.utime(header_path, (0, 0))
+
+        self.cache.put(other_path, self.array, self.ijk_to_ras)
+
+        self.assertIsNone(self.cache.get(self.source_path))
+        self.assertIsNotNone(self.cache.get(other_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+"""
+Tests of the cache of warped and difference volumes.
+"""
+
+import unittest
+
+import numpy as np
+
+from registrationViewerLib import volume_cache
+
+
+def _entry(nbytes: int):
+    return {"array": np.zeros(nbytes, dtype=np.uint8)}
+
+
+class _Data:
+
+    def __init__(self) -> None:
+        self.mtime = 1
+
+    def GetMTime(self) -> int:
+        return self.mtime
+
+
+class _VolumeNode:
+    """
+    The parts of a vtkMRMLScalarVolumeNode node_key() reads.
+    """
+
+    def __init__(self) -> None:
+        self.name = "Volume"
+        self.data = _Data()
+        self.origin = (0.0, 0.0, 0.0)
+
+    def IsA(self, class_name: str) -> bool:
+        return class_name == "vtkMRMLVolumeNode"
+
+    def GetID(self) -> str:
+        return "vtkMRMLScalarVolumeNode1"
+
+    def GetImageData(self) -> _Data:
+        return self.data
+
+    def GetOrigin(self):
+        return self.origin
+
+    def GetSpacing(self):
+        return (1.0, 1.0, 1.0)
+
+    def GetIToRASDirection(self, direction) -> None:
+        direction[:] = [-1.0, 0.0, 0.0]
+
+    def GetJToRASDirection(self, direction) -> None:
+        direction[:] = [0.0, -1.0, 0.0]
+
+    def GetKToRASDirection(self, direction) -> None:
+        direction[:] = [0.0, 0.0, 1.0]
+
+
+class VolumeCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = volume_cache.VolumeCache(max_bytes=300)
+        cache.put("a", _entry(100))
+        cache.put("b", _entry(100))
+        cache.put("c", _entry(100))
+
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("d", _entry(100))
+
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.nbytes, 300)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_entry_larger_than_the_budget_is_not_stored(self):
+        cache = volume_cache.VolumeCache(max_bytes=100)
+        cache.put("a", _entry(50))
+        cache.put("b", _entry(200))
+
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+
+    def test_oversize_entry_is_kept_alone_until_the_next_put(self):
+        cache = volume_cache.VolumeCache(max_bytes=100)
+        cache.put("a", _entry(50))
+        cache.put("b", _entry(200), keep_oversize=True)
+
+        self.assertEqual(cache.max_bytes, 100)
+        self.assertIsNotNone(cache.get("b"))
+        self.assertIsNone(cache.get("a"))
+
+        cache.put("c", _entry(50))
+
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertEqual(cache.nbytes, 50)
+
+    def test_replacing_an_entry_does_not_count_it_twice(self):
+        cache = volume_cache.VolumeCache(max_bytes=100)
+        cache.put("a", _entry(80))
+        cache.put("a", _entry(90))
+
+        self.assertEqual(cache.nbytes, 90)
+
+    def test_reserve_makes_room(self):
+        cache = volume_cache.VolumeCache(max_bytes=300)
+        cache.put("a", _entry(100))
+        cache.put("b", _entry(100))
+        cache.put("c", _entry(100))
+
+        self.assertTrue(cache.reserve(150))
+        self.assertEqual(cache.nbytes, 100)
+        self.assertIsNotNone(cache.get("c"))
+
+        self.assertFalse(cache.reserve(400))
+        self.assertEqual(len(cache), 1)
+
+
+class NodeKeyTest(unittest.TestCase):
+
+    def test_none_has_a_key(self):
+        self.assertEqual(volume_cache.node_key(None), (None,))
+
+    def test_rename_keeps_the_key(self):
+        node = _VolumeNode()
+        key = volume_cache.node_key(node)
+
+        node.name = "Renamed"
+
+        self.assertEqual(volume_cache.node_key(node), key)
+
+    def test_data_and_geometry_change_the_key(self):
+        node = _VolumeNode()
+        key = volume_cache.node_key(node)
+
+        node.data.mtime += 1
+        modified_key = volume_cache.node_key(node)
+        self.assertNotEqual(modified_key, key)
+
+        node.origin = (1.0, 0.0, 0.0)
+        self.assertNotEqual(volume_cache.node_key(node), modified_key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+"""
+Tests of the NumPy warping engine.
+"""
+
+import unittest
+
+import numpy as np
+
+from registrationViewerLib import warping
+
+
+def _grid(spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0), angle: float = 0.0) -> np.ndarray:
+    """
+    IJK to RAS matrix with the given spacing and origin, rotated about the S axis.
+    """
+
+    rotation = np.array([[np.cos(angle), -np.sin(angle), 0.0],
+                         [np.sin(angle), np.cos(angle), 0.0],
+                         [0.0, 0.0, 1.0]])
+
+    ijk_to_ras = np.eye(4)
+    ijk_to_ras[:3, :3] = rotation * np.asarray(spacing)
+    ijk_to_ras[:3, 3] = origin
+
+    return ijk_to_ras
+
+
+def _linear_volume(shape) -> np.ndarray:
+    """
+    Volume whose value is i + 2 j + 3 k, which trilinear interpolation reproduces exactly.
+    """
+
+    k, j, i = np.meshgrid(*[np.arange(n) for n in shape], indexing='ij')
+
+    return (i + 2 * j + 3 * k).astype(np.float32)
+
+
+class _ScalingMapping:
+    """
+    Mapping with only transform_point(), like a transform only VTK can evaluate.
+    """
+
+    def __init__(self, factor: float) -> None:
+        self.factor = factor
+
+    def transform_point(self, point_ras) -> np.ndarray:
+        return np.asarray(point_ras, dtype=np.float64) * self.factor
+
+
+class SampleTrilinearTest(unittest.TestCase):
+
+    def test_linear_function_is_reproduced(self):
+        volume = _linear_volume((5, 6, 7))
+        points = np.random.default_rng(0).uniform(0, 4, size=(100, 3))
+
+        values = warping.sample_trilinear(volume, points)
+
+        np.testing.assert_allclose(values, points @ [1, 2, 3], rtol=1e-5)
+
+    def test_points_outside_get_fill_value(self):
+        volume = _linear_volume((4, 4, 4))
+
+        values = warping.sample_trilinear(volume, np.array([[-1.0, 0, 0], [1.0, 1, 1], [3.6, 0, 0]]),
+                                          fill_value=-5)
+
+        np.testing.assert_allclose(values, [-5, 6, -5])
+
+    def test_single_point_matches_vectorized(self):
+        volume = np.random.default_rng(1).normal(size=(4, 5, 6, 3)).astype(np.float32)
+        points = np.random.default_rng(2).uniform(-1, 6, size=(20, 3))
+
+        expected = warping.sample_trilinear(volume, points)
+        for point, value in zip(points, expected):
+            np.testing.assert_allclose(warping.sample_trilinear_point(volume, point), value, rtol=1e-5, atol=1e-5)
+
+    def test_integer_output_is_rounded(self):
+        volume = np.array([[[0, 10]]], dtype=np.int16)
+        out = np.empty(1, dtype=np.int16)
+
+        warping.sample_trilinear(volume, np.array([[0.56, 0, 0]]), out=out)
+
+        self.assertEqual(out[0], 6)
+
+
+class DisplacementFieldTest(unittest.TestCase):
+
+    def test_constant_field_translates(self):
+        array = np.zeros((3, 4, 5, 3), dtype=np.float32)
+        array[...] = [1.0, -2.0, 0.5]
+        field = warping.DisplacementField(array, _grid(spacing=(2, 2, 3), angle=0.3))
+
+        points = np.random.default_rng(3).uniform(0, 5, size=(10, 3))
+
+        np.testing.assert_allclose(field.transform_points(points), points + [1.0, -2.0, 0.5], rtol=1e-6)
+        for point in points:
+            np.testing.assert_allclose(field.transform_point(point), point + [1.0, -2.0, 0.5], rtol=1e-6)
+
+    def test_scale_and_shift_are_applied(self):
+        array = np.full((2, 2, 2, 3), 100, dtype=np.int16)
+        field = warping.DisplacementField(array, np.eye(4), displacement_scale=0.01, displacement_shift=0.5)
+
+        np.testing.assert_allclose(field.displacements_at(np.zeros((1, 3))), [[1.5, 1.5, 1.5]], rtol=1e-6)
+        np.testing.assert_allclose(field.transform_point([0, 0, 0]), [1.5, 1.5, 1.5], rtol=1e-6)
+
+
+class MappingStackTest(unittest.TestCase):
+
+    def test_matches_lookup_per_mapping(self):
+        rng = np.random.default_rng(4)
+
+        mappings = [
+            warping.DisplacementField(rng.normal(size=(6, 7, 8, 3)).astype(np.float32),
+                                      _grid(spacing=(1.5, 1.0, 2.0), origin=(-3, 2, 1), angle=0.4)),
+            warping.AffineMapping(np.array([[1.1, 0.1, 0.0, 2.0],
+                                            [0.0, 0.9, 0.2, -1.0],
+                                            [0.1, 0.0, 1.0, 0.5],
+                                            [0.0, 0.0, 0.0, 1.0]])),
+            # quantised field with a single slice
+            warping.DisplacementField(rng.integers(-1000, 1000, size=(1, 5, 5, 3)).astype(np.int16),
+                                      _grid(spacing=(2.0, 2.0, 2.0)),
+                                      displacement_scale=0.003,
+                                      displacement_shift=0.2),
+            _ScalingMapping(2.0),
+        ]
+
+        stack = warping.MappingStack(mappings)
+        self.assertEqual(len(stack), 4)
+
+        # inside the grids and outside, where the fields are clamped to the border
+        for point in rng.uniform(-10, 20, size=(50, 3)):
+            expected = np.array([mapping.transform_point(point) for mapping in mappings])
+            np.testing.assert_allclose(stack.transform_point(point), expected, rtol=1e-5, atol=1e-5)
+
+
+class WarpVolumeTest(unittest.TestCase):
+
+    def test_identity_reproduces_moving(self):
+        moving = np.random.default_rng(5).normal(size=(6, 7, 8)).astype(np.float32)
+        ijk_to_ras = _grid(spacing=(1.0, 2.0, 3.0), origin=(5, -5, 0), angle=0.2)
+        out = np.empty_like(moving)
+
+        warping.warp_volume(moving, np.linalg.inv(ijk_to_ras), warping.AffineMapping(np.eye(4)),
+                            ijk_to_ras, out, chunk_voxels=50)
+
+        np.testing.assert_allclose(out, moving, rtol=1e-5, atol=1e-5)
+
+    def test_translation_shifts_by_one_voxel(self):
+        moving = _linear_volume((4, 5, 6))
+        translation = np.eye(4)
+        translation[0, 3] = 1.0
+        out = np.empty_like(moving)
+        fractions = []
+
+        warping.warp_volume(moving, np.eye(4), warping.AffineMapping(translation), np.eye(4), out,
+                            fill_value=-1, chunk_voxels=30, progress_callback=fractions.append)
+
+        np.testing.assert_allclose(out[..., :-1], moving[..., 1:])
+        np.testing.assert_allclose(out[..., -1], -1)
+        self.assertEqual(fractions[-1], 1.0)
+
+    def test_labels_use_nearest_neighbour(self):
+        labels = np.zeros((3, 3, 3), dtype=np.uint8)
+        labels[1, 1, 1] = 7
+        translation = np.eye(4)
+        translation[:3, 3] = [0.4, -0.4, 0.3]
+        out = np.empty_like(labels)
+
+        warping.warp_labels(labels, np.eye(4), warping.AffineMapping(translation), np.eye(4), out)
+
+        np.testing.assert_array_equal(out, labels)
+
+
+if __name__ == '__main__':
+    unittest.main()
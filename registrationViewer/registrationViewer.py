@@ -3,7 +3,7 @@ import logging
 import functools
 import importlib
 
-from typing import Optional, List, Any
+from typing import Optional, List, Any, Dict, Tuple
 
 import ctk
 import slicer.util
@@ -22,7 +22,8 @@ from slicer.parameterNodeWrapper import (
 )
 from slicer import vtkMRMLScalarVolumeNode, vtkMRMLTransformNode  # pylint: disable=no-name-in-module
 
-from registrationViewerLib import utils, crosshairs, baseline_loading, view_logic
+from registrationViewerLib import utils, crosshairs, baseline_loading, view_logic, volume_cache, plane_difference, \
+    background, difference, latency, lazy_groups, transform_analysis, transform_lookup, comparison
 
 
 class registrationViewer(ScriptedLoadableModule):
@@ -80,9 +81,33 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self._parameterNode: Optional[registrationViewerParameterNode] = None
         self._parameterNodeGuiTag = None
 
-        from registrationViewerLib import utils, crosshairs, baseline_loading, view_logic
+        from registrationViewerLib import utils, crosshairs, baseline_loading, view_logic, warping, volume_cache, \
+            plane_difference, background, difference, inverse_field, transform_lookup, event_coalescer, \
+            crosshair_renderer, latency, nifti_cache, zero_copy, parallel_loading, dataset_index, lazy_groups, \
+            loaded_originals, compact_field, image_io, folder_watch, transform_analysis, comparison
+        warping = importlib.reload(warping)
+        compact_field = importlib.reload(compact_field)
+        zero_copy = importlib.reload(zero_copy)
+        difference = importlib.reload(difference)
+        volume_cache = importlib.reload(volume_cache)
+        plane_difference = importlib.reload(plane_difference)
+        background = importlib.reload(background)
         utils = importlib.reload(utils)
+        inverse_field = importlib.reload(inverse_field)
+        transform_analysis = importlib.reload(transform_analysis)
+        transform_lookup = importlib.reload(transform_lookup)
+        event_coalescer = importlib.reload(event_coalescer)
+        latency = importlib.reload(latency)
+        crosshair_renderer = importlib.reload(crosshair_renderer)
         crosshairs = importlib.reload(crosshairs)
+        comparison = importlib.reload(comparison)
+        nifti_cache = importlib.reload(nifti_cache)
+        image_io = importlib.reload(image_io)
+        parallel_loading = importlib.reload(parallel_loading)
+        dataset_index = importlib.reload(dataset_index)
+        loaded_originals = importlib.reload(loaded_originals)
+        lazy_groups = importlib.reload(lazy_groups)
+        folder_watch = importlib.reload(folder_watch)
         baseline_loading = importlib.reload(baseline_loading)
         view_logic = importlib.reload(view_logic)
 
@@ -110,6 +135,12 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self.current_offset = [0.0, 0.0, 0.0]
 
         self.crosshair = None
+        self.comparison: Optional['comparison.ComparisonCrosshairs'] = None
+        self.latency_recorder = latency.LatencyRecorder()
+        self.cursor_coalescer = event_coalescer.CursorEventCoalescer(
+            self._on_cursor_moved)
+        # one cursor observer serves the synchronised crosshairs and the comparison layout
+        self._cursor_observer_tag: Optional[int] = None
 
         self.logic = registrationViewerLogic()
 
@@ -120,9 +151,28 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
 
         self.node_warped = None
         self.node_diff = None
+        self.warp_backend = utils.WarpBackend.NUMPY
+        self.diff_mode = utils.DiffMode.FULL
+        self.plane_difference: Optional['plane_difference.PlaneDifference'] = None
+        self.diff_runner = background.BackgroundRunner(
+            on_progress=self._on_diff_progress)
+        self.diff_tile_bytes = slicer.util.settingsValue("registrationViewer/DiffTileMegabytes",
+                                                         difference.DEFAULT_TILE_BYTES // 1024 ** 2,
+                                                         converter=int) * 1024 ** 2
+        self.diff_cache = volume_cache.VolumeCache(
+            max_bytes=slicer.util.settingsValue("registrationViewer/DiffCacheMegabytes",
+                                                volume_cache.DEFAULT_CACHE_BYTES // 1024 ** 2,
+                                                converter=int) * 1024 ** 2)
 
         self.current_layout: 'view_logic.Layout'
 
+        # node keys of the inputs at the last update, to only redo the steps that depend on a change
+        self._input_keys: Dict[str, Tuple] = {}
+        # fixed, moving and transformation keys the difference row shows
+        self._diff_inputs: Optional[Tuple] = None
+        # moving, transformation, backend and fixed grid the Warped node holds, see _diff_key()
+        self._warped_key: Optional[Tuple] = None
+
     def setup(self) -> None:
         """Called when the user opens the module the first time and the widget is initialized."""
         ScriptedLoadableModuleWidget.setup(self)
@@ -147,7 +197,9 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self.addObserver(slicer.mrmlScene,
                          slicer.mrmlScene.EndCloseEvent, self.onSceneEndClose)
 
-        self.node_crosshair.RemoveAllObservers()
+        # a reloaded module leaves the cursor observer of its previous widget behind
+        self.node_crosshair.RemoveObservers(slicer.vtkMRMLCrosshairNode.CursorPositionModifiedEvent)
+        self._remove_crosshair_observers()
         self.synchronise_with_displacement_pressed = False
         self.ui.synchronise_views_with_transform.setText(
             "Synchronise views (s)")
@@ -159,12 +211,14 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
 
         # set groups
         for i in range(3):
-            slicer.app.layoutManager().sliceWidget(
-                self.views_first_row[i]).mrmlSliceNode().SetViewGroup(1)
-            slicer.app.layoutManager().sliceWidget(
-                self.views_second_row[i]).mrmlSliceNode().SetViewGroup(2)
-            slicer.app.layoutManager().sliceWidget(
-                self.views_third_row[i]).mrmlSliceNode().SetViewGroup(3)
+            view_logic.registry.view(self.views_first_row[i]).slice_node.SetViewGroup(1)
+            view_logic.registry.view(self.views_second_row[i]).slice_node.SetViewGroup(2)
+            view_logic.registry.view(self.views_third_row[i]).slice_node.SetViewGroup(3)
+
+        # lazy difference follows the slices of the diff row
+        for view in self.views_third_row:
+            self.addObserver(view_logic.registry.view(view).slice_node,
+                             vtk.vtkCommand.ModifiedEvent, self._update_plane_difference)
 
         # Buttons
         self.ui.button_2x3.connect("clicked(bool)", view_logic.set_2x3_layout)
@@ -173,10 +227,22 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
             "clicked(bool)", self.on_synchronise_views_wth_trasform)
         self.ui.synchronise_views_manually.connect(
             "clicked(bool)", self.on_synchronise_views_manually)
+        self.ui.checkbox_lazy_diff.connect(
+            "toggled(bool)", self.on_lazy_diff_toggled)
+        self.ui.button_full_diff.connect(
+            "clicked(bool)", self.on_compute_full_difference)
+        self.ui.button_cancel_diff.connect(
+            "clicked()", self.diff_runner.cancel)
 
         # loading code
         baseline_loading.create_loading_ui(self)
 
+        # N-way comparison of registration results
+        comparison.create_comparison_ui(self)
+
+        # crosshair timing
+        latency.create_latency_ui(self)
+
         # Make sure parameter node is initialized (needed for module reload)
         self.initializeParameterNode()
 
@@ -185,11 +251,12 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         #                                               '0')
         utils.collapse_all_segmentations()
 
-        view_logic.link_views(self.views_first_row)
-        view_logic.link_views(self.views_second_row)
-        view_logic.link_views(self.views_third_row)
+        with view_logic.batched_view_update():
+            view_logic.link_views(self.views_first_row)
+            view_logic.link_views(self.views_second_row)
+            view_logic.link_views(self.views_third_row)
 
-        view_logic.set_2x3_layout()
+            view_logic.set_2x3_layout()
 
         slicer.util.resetSliceViews()
 
@@ -198,41 +265,290 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
     def update_current_layout(self, layout: view_logic.Layout) -> None:
         self.current_layout = layout
 
-    def update_views_third_row_with_volume_diff(self) -> None:
+        # the comparison crosshairs only exist in their layout
+        if layout != view_logic.Layout.L_COMPARISON:
+            self._remove_comparison()
+
+    def update_views_third_row_with_volume_diff(self, diff_mode: Optional[utils.DiffMode] = None) -> None:
+
+        # placeholder groups are diffed once their field arrived
+        if self.node_fixed is not None and self.node_moving is not None and self.node_transformation is not None \
+                and not lazy_groups.is_placeholder(self.node_transformation):
+            self._create_output_nodes()
+
+            if diff_mode is None:
+                diff_mode = self.diff_mode
 
-        if self.node_fixed is not None and self.node_moving is not None and self.node_transformation is not None:
-            if self.node_diff is None:
-                self.node_diff = slicer.modules.volumes.logic(
-                ).CloneVolume(self.node_fixed, "Difference")
-                self.node_diff.SetName("Difference")
+            key = self._diff_key()
+            cached = self.diff_cache.get(key)
 
-            if self.node_warped is not None:
-                slicer.mrmlScene.RemoveNode(self.node_warped)
+            # a new request supersedes the one that is still computing; the cancelled job
+            # writes into the node arrays until it stopped, and they are refilled below
+            self.diff_runner.cancel(wait=True)
 
-            self.node_warped = slicer.modules.volumes.logic(
-            ).CloneVolume(self.node_moving, "Warped")
-            self.node_warped.SetName("Warped")
-            utils.warp_moving_with_transform(self.node_moving,
-                                             self.node_transformation,
-                                             self.node_warped)
+            self.plane_difference = None
+
+            if cached is None and self._warped_key == key[1:]:
+                # only the fixed volume changed and its grid did not: no need to warp again
+                self._subtract_from_warped(key)
+            elif cached is not None or diff_mode == utils.DiffMode.FULL or \
+                    not self._set_up_plane_difference():
+                self._compute_full_difference(key, cached)
+
+            view_logic.update_views_with_volume(
+                self.views_third_row, self.node_diff)
+
+    def _diff_key(self) -> Tuple:
+        """
+        Content of the fixed, moving and transformation nodes, the warp backend and the fixed grid.
+        Everything but the first element determines the warped volume.
+        """
 
-            array_fixed = slicer.util.arrayFromVolume(self.node_fixed)
-            array_warped = slicer.util.arrayFromVolume(self.node_warped)
+        dimensions = self.node_fixed.GetImageData().GetDimensions() \
+            if self.node_fixed.GetImageData() is not None else None
 
-            array_diff = array_fixed - array_warped
+        return (volume_cache.node_key(self.node_fixed),
+                volume_cache.node_key(self.node_moving),
+                volume_cache.node_key(self.node_transformation),
+                self.warp_backend,
+                (dimensions, utils.get_ijk_to_ras_matrix(self.node_fixed).tobytes()))
 
-            slicer.util.updateVolumeFromArray(self.node_diff, array_diff)
+    def _subtract_from_warped(self, key) -> None:
+        array_fixed = slicer.util.arrayFromVolume(self.node_fixed)
+        array_warped = slicer.util.arrayFromVolume(self.node_warped)
+        array_diff = self._allocate_difference(array_warped.dtype)
+
+        difference.subtract_tiled(array_fixed,
+                                  array_warped,
+                                  array_diff,
+                                  max_tile_bytes=self.diff_tile_bytes)
+
+        self._on_difference_computed(key)
+
+    def _create_output_nodes(self) -> None:
+        """
+        Creates the Warped and Difference nodes once, afterwards they are refilled in place.
+        """
+
+        if self.node_warped is None:
+            self.node_warped = slicer.mrmlScene.AddNewNodeByClass(
+                "vtkMRMLScalarVolumeNode", "Warped")
+
+        if self.node_diff is None:
+            self.node_diff = slicer.mrmlScene.AddNewNodeByClass(
+                "vtkMRMLScalarVolumeNode", "Difference")
+            self.node_diff.CreateDefaultDisplayNodes()
 
             self.node_diff.GetDisplayNode().SetAutoWindowLevel(False)
             self.node_diff.GetDisplayNode().SetWindow(2)
             self.node_diff.GetDisplayNode().SetThreshold(-1.0, 1.0)
 
-            view_logic.update_views_with_volume(
-                self.views_third_row, self.node_diff)
+    def _compute_full_difference(self, key, cached) -> None:
+        if cached is not None:
+            self._show_cached_difference(key, cached)
+            return
+
+        # the Warped node is overwritten from here on
+        self._warped_key = None
+
+        mapping = None
+        if self.warp_backend == utils.WarpBackend.NUMPY:
+            mapping = transform_analysis.analyse_transform(
+                self.node_transformation, self.node_fixed)
+
+        array_fixed = slicer.util.arrayFromVolume(self.node_fixed)
+
+        if mapping is not None:
+            array_moving = slicer.util.arrayFromVolume(self.node_moving)
+
+            array_warped = utils.allocate_volume_like(self.node_warped,
+                                                      self.node_fixed,
+                                                      array_moving.dtype)
+            array_diff = self._allocate_difference(array_moving.dtype)
+
+            # the NumPy part runs on the worker thread and writes into the node arrays,
+            # MRML is only notified once it is done
+            self.diff_runner.submit(self._difference_job,
+                                    functools.partial(
+                                        self._on_difference_computed, key),
+                                    array_fixed,
+                                    utils.get_ijk_to_ras_matrix(
+                                        self.node_fixed),
+                                    array_moving,
+                                    utils.get_ras_to_ijk_matrix(
+                                        self.node_moving),
+                                    mapping,
+                                    array_warped,
+                                    array_diff,
+                                    self.diff_tile_bytes)
+            return
+
+        # resampled onto the fixed grid, like the NumPy warp, so the arrays can be subtracted
+        array_warped = utils.warp_moving_with_transform_into(self.node_moving,
+                                                             self.node_transformation,
+                                                             self.node_warped,
+                                                             self.node_fixed)
+        array_diff = self._allocate_difference(array_warped.dtype)
+        difference.subtract_tiled(array_fixed,
+                                  array_warped,
+                                  array_diff,
+                                  max_tile_bytes=self.diff_tile_bytes)
+
+        self._on_difference_computed(key)
+
+    def _allocate_difference(self, dtype_warped) -> Any:
+        """
+        Gives the difference node a zeroed image on the fixed grid, with a dtype that
+        holds fixed - warped without overflow.
+        """
+
+        dtype_diff = difference.difference_dtype(slicer.util.arrayFromVolume(self.node_fixed).dtype,
+                                                 dtype_warped)
+
+        array_diff = utils.allocate_volume_like(self.node_diff,
+                                                self.node_fixed,
+                                                dtype_diff)
+        array_diff.fill(0)
+
+        return array_diff
+
+    @staticmethod
+    def _difference_job(job, array_fixed, fixed_ijk_to_ras, array_moving, moving_ras_to_ijk, mapping,
+                        *args) -> Optional[Tuple]:
+        """
+        Warps and subtracts on the worker. A composite transform is flattened there first,
+        and returned with its field so the main thread can cache it.
+        """
+
+        flattened = None
+        start, scale = 0.0, 1.0
+
+        if isinstance(mapping, transform_analysis.PendingFlatten):
+            pending = mapping
+            mapping = transform_analysis.flatten_transform(
+                pending.transform, pending.ijk_to_ras, pending.shape,
+                progress_callback=lambda fraction: job.report_progress(0.5 * fraction))
+            flattened = (pending, mapping)
+            start, scale = 0.5, 0.5
+
+        difference.warp_and_subtract(array_fixed, fixed_ijk_to_ras, array_moving, moving_ras_to_ijk, mapping,
+                                     *args,
+                                     progress_callback=lambda fraction: job.report_progress(start + scale * fraction))
+
+        return flattened
+
+    def _on_difference_computed(self, key, flattened: Optional[Tuple] = None) -> None:
+        if flattened is not None:
+            transform_analysis.store_flattened(*flattened)
+
+        self.plane_difference = None
+        self._warped_key = key[1:]
+
+        slicer.util.arrayFromVolumeModified(self.node_warped)
+        slicer.util.arrayFromVolumeModified(self.node_diff)
+
+        array_warped = slicer.util.arrayFromVolume(self.node_warped)
+        array_diff = slicer.util.arrayFromVolume(self.node_diff)
+
+        # the node arrays are refilled later, so the cache needs its own copies. They are
+        # made within the cache budget, and a DiffCacheMegabytes of 0 turns them off, which
+        # keeps the peak memory of a diff at the output volumes themselves.
+        if self.diff_cache.reserve(array_warped.nbytes + array_diff.nbytes):
+            self.diff_cache.put(key, {"warped": array_warped.copy(),
+                                      "diff": array_diff.copy()})
+
+    def _show_cached_difference(self, key, cached) -> None:
+        self.plane_difference = None
+        self._warped_key = key[1:]
+
+        utils.allocate_volume_like(self.node_warped,
+                                   self.node_fixed,
+                                   cached["warped"].dtype)[...] = cached["warped"]
+        utils.allocate_volume_like(self.node_diff,
+                                   self.node_fixed,
+                                   cached["diff"].dtype)[...] = cached["diff"]
+
+        slicer.util.arrayFromVolumeModified(self.node_warped)
+        slicer.util.arrayFromVolumeModified(self.node_diff)
+
+    def _on_diff_progress(self, progress: Optional[float]) -> None:
+        running = progress is not None
+
+        self.ui.progress_diff.visible = running
+        self.ui.button_cancel_diff.visible = running
+
+        if running:
+            self.ui.progress_diff.value = int(100 * progress)
+
+    def _set_up_plane_difference(self) -> bool:
+        """
+        Prepares the lazy difference that is only computed on the displayed slice planes.
+        Returns False if the transformation is not supported by the NumPy warp.
+        """
+
+        field = transform_analysis.analyse_transform(
+            self.node_transformation, self.node_fixed)
+        if field is None:
+            logging.info("Lazy difference does not support transform %s, computing the full difference",
+                         self.node_transformation.GetName())
+            return False
+
+        array_fixed = slicer.util.arrayFromVolume(self.node_fixed)
+        array_moving = slicer.util.arrayFromVolume(self.node_moving)
+        array_diff = self._allocate_difference(array_moving.dtype)
+
+        # the planes need the field on the main thread: flatten it first, the row stays zero until then
+        if isinstance(field, transform_analysis.PendingFlatten):
+            self.diff_runner.submit(transform_analysis.flatten_job,
+                                    functools.partial(self._on_transform_flattened, field),
+                                    field)
+            return True
+
+        self.plane_difference = plane_difference.PlaneDifference(array_fixed,
+                                                                 utils.get_ijk_to_ras_matrix(
+                                                                     self.node_fixed),
+                                                                 array_moving,
+                                                                 utils.get_ras_to_ijk_matrix(
+                                                                     self.node_moving),
+                                                                 field,
+                                                                 array_diff)
+        self._update_plane_difference()
+
+        return True
+
+    def _on_transform_flattened(self, pending, field) -> None:
+        transform_analysis.store_flattened(pending, field)
+
+        # the field is cached now, the lazy difference is set up with it
+        self.update_views_third_row_with_volume_diff()
+
+    def _update_plane_difference(self, caller=None, event=None) -> None:  # pylint: disable=unused-argument
+        if self.plane_difference is None or self.current_layout != view_logic.Layout.L_3X3:
+            return
+
+        slices_to_ras = [view_logic.get_slice_to_ras(view)
+                         for view in self.views_third_row]
+
+        if self.plane_difference.update(slices_to_ras):
+            slicer.util.arrayFromVolumeModified(self.node_diff)
+
+    def on_lazy_diff_toggled(self, checked: bool) -> None:
+        self.diff_mode = utils.DiffMode.PLANES if checked else utils.DiffMode.FULL
+
+        if self.current_layout == view_logic.Layout.L_3X3:
+            self.update_views_third_row_with_volume_diff()
+
+    def on_compute_full_difference(self) -> None:
+        self.update_views_third_row_with_volume_diff(utils.DiffMode.FULL)
 
     def cleanup(self) -> None:
         """Called when the application closes and the module widget is destroyed."""
         self.removeObservers()
+        self._remove_comparison()
+        self.diff_runner.shutdown()
+        self.latencyTimer.stop()
+        self.dropWidget.loader.shutdown()
+        self.dropWidget.watcher.stop()
 
     def enter(self) -> None:
         """Called each time the user opens this module."""
@@ -252,12 +568,17 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
     def onSceneStartClose(self, caller, event) -> None:  # pylint: disable=unused-argument
         """Called just before the scene is closed."""
 
-        self.node_crosshair.RemoveAllObservers()
+        self._remove_crosshair_observers()
         self.synchronise_with_displacement_pressed = False
         self.ui.synchronise_views_with_transform.setText(
             "Synchronise views (s)")
 
         self._remove_custom_nodes()
+        self.diff_cache.clear()
+        transform_lookup.clear_cache()
+        transform_analysis.clear_cache()
+        self.dropWidget.clear_loaded_groups()
+        view_logic.registry.invalidate()
 
         # Parameter node will be reset, do not use it anymore
         self.setParameterNode(None)
@@ -296,34 +617,59 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
                              vtk.vtkCommand.ModifiedEvent, self._update_from_gui)
 
     def _update_from_gui(self, caller=None, event=None) -> None:  # pylint: disable=unused-argument
+        """
+        Updates only what depends on the inputs that changed since the last call: the fixed
+        row, the moving row, the crosshair transformation and the difference row.
+        The views render once, after all steps.
+        """
 
-        if self.current_layout == view_logic.Layout.L_3X3:
-            self.update_views_third_row_with_volume_diff()
-
-        view_logic.update_views_with_volume(
-            self.views_first_row, self.node_fixed)
-        view_logic.update_views_with_volume(
-            self.views_second_row, self.node_moving)
-        self._update_crosshair_transformation()
-
-        # set window, level and threshold for fixed and moving
-        for node in [self.node_fixed, self.node_moving]:
-            if node is None:
-                continue
-
-            utils.set_window_level_and_threshold(self.node_fixed,
-                                                 window=1036,
-                                                 level=329,
-                                                 threshold=(-1024, 3071))
-
-        # reset field of view for view 0, 3 and 6
-        for view in [self.views_first_row[0], self.views_second_row[0], self.views_third_row[0]]:
-            slicer.app.layoutManager().sliceWidget(
-                view).sliceController().fitSliceToBackground()
-
-        view_logic.link_views(self.views_first_row)
-        view_logic.link_views(self.views_second_row)
-        view_logic.link_views(self.views_third_row)
+        with view_logic.batched_view_update():
+            keys = {"fixed": volume_cache.node_key(self.node_fixed),
+                    "moving": volume_cache.node_key(self.node_moving),
+                    "transformation": volume_cache.node_key(self.node_transformation)}
+
+            # a different node is selected, not only the content of the same node changed
+            selected = {role for role, key in keys.items()
+                        if key[0] != self._input_keys.get(role, (None,))[0]}
+            self._input_keys = keys
+
+            rows = {"fixed": (self.views_first_row, self.node_fixed),
+                    "moving": (self.views_second_row, self.node_moving)}
+            for role, (views, node) in rows.items():
+                if role not in selected:
+                    continue
+
+                view_logic.update_views_with_volume(views, node)
+
+                # set window, level and threshold
+                if node is not None:
+                    utils.set_window_level_and_threshold(node,
+                                                         window=1036,
+                                                         level=329,
+                                                         threshold=(-1024, 3071))
+
+                # reset field of view for view 0 of the row
+                view_logic.registry.view(views[0]).fit_slice_to_background()
+                view_logic.link_views(views)
+
+            # a new content of the same transformation is picked up by the crosshair lookup itself
+            if "transformation" in selected:
+                self._update_crosshair_transformation()
+
+            # composite transformations are flattened on the fixed grid
+            if "fixed" in selected and self.crosshair:
+                self.crosshair.node_reference = self.node_fixed
+
+            # the difference is on the fixed grid and depends on all three inputs
+            diff_inputs = (keys["fixed"], keys["moving"], keys["transformation"])
+            if self.current_layout == view_logic.Layout.L_3X3 and diff_inputs != self._diff_inputs:
+                fixed_selected = self._diff_inputs is None or self._diff_inputs[0][0] != keys["fixed"][0]
+                self._diff_inputs = diff_inputs
+                self.update_views_third_row_with_volume_diff()
+
+                if fixed_selected:
+                    view_logic.registry.view(self.views_third_row[0]).fit_slice_to_background()
+                    view_logic.link_views(self.views_third_row)
 
     def _synchronisation_checks(self) -> bool:
         """
@@ -367,7 +713,7 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
 
         else:
             print("pressed to unsynchronise")
-            self.node_crosshair.RemoveAllObservers()
+            self._remove_crosshair_observers()
             self.ui.synchronise_views_with_transform.setText(
                 "Synchronise views (s)")
 
@@ -392,7 +738,7 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
 
         else:
             print("pressed to unsynchronise manually")
-            self.node_crosshair.RemoveAllObservers()
+            self._remove_crosshair_observers()
             self.ui.synchronise_views_manually.setText("Link views (l)")
 
         # get view offset differences between Red1 and Red2, Green1 and Green2, Yellow1 and Yellow2
@@ -407,17 +753,104 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
             offset_diff_red, offset_diff_green, offset_diff_yellow]
         self.crosshair.apply_offsets = self.synchronise_manually_pressed
 
-    def update_cursor_view(self) -> None:
+    def update_cursor_view(self, crosshair) -> None:
+        position = self.node_crosshair.GetCursorPositionXYZ([0]*3)
+        if position is not None:
+            crosshair.cursor_view = position.GetName()
+
+    def _on_cursor_moved(self) -> None:
+        """
+        Called by the cursor event coalescer at most once per frame with the latest cursor position.
+        The comparison layout has its own crosshairs.
+        """
+
+        if self.current_layout == view_logic.Layout.L_COMPARISON:
+            crosshair = self.comparison
+        elif self.synchronise_with_displacement_pressed or self.synchronise_manually_pressed:
+            crosshair = self.crosshair
+        else:
+            # the crosshair is kept while the views are unsynchronised, but must not move them
+            crosshair = None
+
+        if crosshair is None:
+            return
+
+        self.update_cursor_view(crosshair)
+        crosshair.on_mouse_moved_place_crosshair(None, None)
+
+    def on_compare_transformations(self, nodes: List[Any]) -> None:
+        """
+        Shows the fixed volume and, in one row per transformation, the moving volume, with the
+        cursor mapped through all transformations at once.
+        """
+
+        if not nodes:
+            slicer.util.errorDisplay("Please check the transformations to compare")
+            return
+
+        if self.node_fixed is None or self.node_moving is None:
+            slicer.util.errorDisplay("Please select fixed and moving volumes")
+            return
+
+        self._remove_comparison()
+
+        with view_logic.batched_view_update():
+            view_rows = view_logic.set_comparison_layout(["Fixed"] + [node.GetName() for node in nodes])
+
+            for row, views in enumerate(view_rows):
+                view_logic.update_views_with_volume(views, self.node_fixed if row == 0 else self.node_moving)
+
+                # every row follows its own position, so the rows must not share a view group
+                for view in views:
+                    handles = view_logic.registry.view(view)
+                    handles.slice_node.SetViewGroup(view_logic.COMPARISON_VIEW_GROUP + row)
+                    handles.fit_slice_to_background()
+
+        self.comparison = comparison.ComparisonCrosshairs(node_cursor=self.node_crosshair,
+                                                          node_transformations=nodes,
+                                                          view_rows=view_rows,
+                                                          latency_recorder=self.latency_recorder,
+                                                          node_reference=self.node_fixed)
+
+        self._observe_cursor()
+
+    def _remove_comparison(self) -> None:
+        if self.comparison is not None:
+            self.comparison.delete_crosshairs()
+            self.comparison = None
+
+            if not (self.synchronise_with_displacement_pressed or self.synchronise_manually_pressed):
+                self._stop_observing_cursor()
+
+    def _observe_cursor(self) -> None:
+        if self._cursor_observer_tag is None:
+            self._cursor_observer_tag = self.node_crosshair.AddObserver(
+                slicer.vtkMRMLCrosshairNode.CursorPositionModifiedEvent, self.cursor_coalescer.on_event)
+
+    def _stop_observing_cursor(self) -> None:
+        if self._cursor_observer_tag is not None:
+            self.node_crosshair.RemoveObserver(self._cursor_observer_tag)
+            self._cursor_observer_tag = None
+
+        self.cursor_coalescer.stop()
 
-        def wrapper(self, callee, event):  # pylint: disable=unused-argument
-            position = self.node_crosshair.GetCursorPositionXYZ([0]*3)
-            if position is not None:
-                self.crosshair.cursor_view = position.GetName()
+    def _remove_crosshair_observers(self) -> None:
+        # the comparison layout keeps following the cursor
+        if self.comparison is None:
+            self._stop_observing_cursor()
 
-        self.node_crosshair.AddObserver(slicer.vtkMRMLCrosshairNode.CursorPositionModifiedEvent,
-                                        functools.partial(wrapper, self))
+        if self.cursor_coalescer.received_events:
+            logging.info(f"Cursor events: {self.cursor_coalescer.processed_events} processed, "
+                         f"{self.cursor_coalescer.dropped_events} dropped")
+        self.cursor_coalescer.reset_counters()
 
     def _remove_custom_nodes(self) -> None:
+        # the images of the removed nodes are freed, no job may still write into them
+        self.diff_runner.cancel(wait=True)
+        self.plane_difference = None
+        self._warped_key = None
+        self._diff_inputs = None
+        self._input_keys = {}
         if self.node_diff is not None:
             slicer.mrmlScene.RemoveNode(self.node_diff)
             self.node_diff = None
@@ -425,8 +858,9 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
             slicer.mrmlScene.RemoveNode(self.node_warped)
             self.node_warped = None
         if self.crosshair is not None:
-            self.crosshair.delete_crosshairs_and_folder()
+            self.crosshair.delete_crosshairs()
             self.crosshair = None
+        self._remove_comparison()
 
     def _are_nodes_selected(self) -> bool:
         return self.ui.inputSelector_fixed.currentNode() is not None and \
@@ -439,12 +873,12 @@ class registrationViewerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
                                                    node_transformation=self.node_transformation,
                                                    use_transform=self.use_transform,
                                                    offset_diffs=self.current_offset,
-                                                   apply_offsets=self.synchronise_manually_pressed,)
+                                                   apply_offsets=self.synchronise_manually_pressed,
+                                                   latency_recorder=self.latency_recorder,
+                                                   node_reference=self.node_fixed)
 
         if turn_synchronisation_on:
-            self.node_crosshair.AddObserver(slicer.vtkMRMLCrosshairNode.CursorPositionModifiedEvent,
-                                            self.crosshair.on_mouse_moved_place_crosshair)
-            self.update_cursor_view()
+            self._observe_cursor()
 
     def _update_crosshair_transformation(self) -> None:
         if self.crosshair:
@@ -0,0 +1,150 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+from typing import Any, Callable, Optional
+
+import qt
+
+
+class JobCancelledError(Exception):
+    """
+    Raised inside a job when it notices that it was cancelled.
+    """
+
+
+class Job:
+    """
+    Handle shared between the worker running a job and the main thread.
+    The worker reports progress through it and learns about cancellation.
+    """
+
+    def __init__(self) -> None:
+        self.progress = 0.0
+        self.future = None
+        self._cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def report_progress(self, fraction: float) -> None:
+        """
+        Called by the worker. Raises JobCancelledError if the job was cancelled, so the
+        worker stops at the next progress report.
+        """
+
+        if self.cancelled:
+            raise JobCancelledError()
+
+        self.progress = fraction
+
+
+class BackgroundRunner:
+    """
+    Runs one job at a time on a worker thread and hands its result back on the main thread.
+
+    Submitting a new job cancels the current one instead of queueing behind it: the
+    cancelled job stops at its next progress report and its result is dropped. Until
+    then it keeps writing to its outputs, see cancel(wait=True).
+    """
+
+    def __init__(self,
+                 on_progress: Optional[Callable[[Optional[float]], None]] = None,
+                 poll_interval_ms: int = 50) -> None:
+        """
+        @param on_progress: Called on the main thread with the progress of the current job,
+                            or with None once no job is running.
+        @param poll_interval_ms: How often the main thread checks the worker.
+        """
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._job: Optional[Job] = None
+        # the last submitted job, also after it was cancelled, the worker runs jobs in order
+        self._last_future: Optional[Future] = None
+        self._on_done: Optional[Callable[[Any], None]] = None
+        self._on_progress = on_progress
+
+        self._timer = qt.QTimer()
+        self._timer.setInterval(poll_interval_ms)
+        self._timer.connect('timeout()', self._poll)
+
+    @property
+    def running(self) -> bool:
+        return self._job is not None
+
+    def submit(self, function: Callable[..., Any], on_done: Callable[[Any], None], *args) -> Job:
+        """
+        Runs function(job, *args) on the worker thread and calls on_done(result) on the
+        main thread once it finished. Any running job is superseded.
+
+        The function must not touch MRML, only NumPy data.
+        """
+
+        self.cancel()
+
+        job = Job()
+        job.future = self._executor.submit(function, job, *args)
+        self._last_future = job.future
+
+        self._job = job
+        self._on_done = on_done
+        self._timer.start()
+
+        return job
+
+    def cancel(self, wait: bool = False) -> None:
+        """
+        Cancels the current job, its result will be dropped.
+
+        @param wait: Block until the worker stopped, also for jobs cancelled earlier, so the
+                     arrays the jobs write into can be reused or freed afterwards. A
+                     cancelled job stops at its next progress report, e.g. after one slab.
+        """
+
+        if self._job is not None:
+            self._job.cancel()
+
+        self._finish()
+
+        if wait and self._last_future is not None:
+            wait_futures([self._last_future])
+            self._last_future = None
+
+    def shutdown(self) -> None:
+        self.cancel(wait=True)
+        self._executor.shutdown(wait=False)
+
+    def _finish(self) -> None:
+        self._job = None
+        self._on_done = None
+        self._timer.stop()
+
+        if self._on_progress is not None:
+            self._on_progress(None)
+
+    def _poll(self) -> None:
+        job = self._job
+        if job is None:
+            self._timer.stop()
+            return
+
+        if not job.future.done():
+            if self._on_progress is not None:
+                self._on_progress(job.progress)
+            return
+
+        on_done = self._on_done
+        self._finish()
+
+        try:
+            result = job.future.result()
+        except JobCancelledError:
+            return
+        except Exception as e:
+            logging.error(f"Background job failed: {str(e)}")
+            return
+
+        on_done(result)
@@ -1,8 +1,7 @@
 import os
-import glob
 import logging
 
-from typing import List
+from typing import Dict, List, Optional
 
 import ctk
 import qt
@@ -10,6 +9,12 @@ import slicer
 from slicer.ScriptedLoadableModule import *
 
 import registrationViewerLib.utils as utils
+import registrationViewerLib.parallel_loading as parallel_loading
+import registrationViewerLib.dataset_index as dataset_index
+import registrationViewerLib.lazy_groups as lazy_groups
+import registrationViewerLib.nifti_cache as nifti_cache
+import registrationViewerLib.loaded_originals as loaded_originals
+import registrationViewerLib.folder_watch as folder_watch
 
 
 def create_loading_ui(self) -> None:
@@ -40,6 +45,42 @@ def create_loading_ui(self) -> None:
     controlsLayout.addWidget(indicesLabel)
     controlsLayout.addWidget(self.indicesInput)
 
+    # Add lazy loading toggle
+    self.lazyLoadingCheckBox = qt.QCheckBox("Load on selection")
+    self.lazyLoadingCheckBox.setToolTip(
+        "Only register the groups and load the data of a group when its transformation is selected")
+    self.lazyLoadingCheckBox.setChecked(True)
+    controlsLayout.addWidget(self.lazyLoadingCheckBox)
+
+    # Add folder watching
+    self.watchFolderCheckBox = qt.QCheckBox("Watch folder")
+    self.watchFolderCheckBox.setToolTip(
+        "Keep polling the dropped folder and load registration results that appear or change")
+    controlsLayout.addWidget(self.watchFolderCheckBox)
+
+    # Add field storage
+    fieldStorageLabel = qt.QLabel("Field storage:")
+    self.fieldStorageComboBox = qt.QComboBox()
+    for storage in utils.FieldStorage:
+        self.fieldStorageComboBox.addItem(storage.value)
+    self.fieldStorageComboBox.setCurrentText(
+        slicer.util.settingsValue("registrationViewer/FieldStorage", utils.FieldStorage.FLOAT32.value))
+    self.fieldStorageComboBox.setToolTip(
+        "Type displacement fields are kept in. int16 is quantised with a scale factor,\n"
+        "the resulting error bound is logged and stored on the transform node")
+    controlsLayout.addWidget(fieldStorageLabel)
+    controlsLayout.addWidget(self.fieldStorageComboBox)
+
+    compactButton = qt.QPushButton("Compact loaded fields")
+    compactButton.setToolTip("Convert the displacement fields in the scene to the field storage type")
+    controlsLayout.addWidget(compactButton)
+
+    # Add index rebuild
+    rebuildIndexButton = qt.QPushButton("Rebuild index")
+    rebuildIndexButton.setToolTip(
+        "List the data directory again instead of refreshing the index of its case names")
+    controlsLayout.addWidget(rebuildIndexButton)
+
     # Add stretch to push everything to the left
     controlsLayout.addStretch()
 
@@ -48,9 +89,29 @@ def create_loading_ui(self) -> None:
     controlWidget.setLayout(controlsLayout)
     collapsibleLayout.addWidget(controlWidget)
 
+    # Add index statistics
+    self.indexStatsLabel = qt.QLabel("")
+    collapsibleLayout.addWidget(self.indexStatsLabel)
+
     # Add drop zone
     self.dropWidget = DropWidget(self)
     collapsibleLayout.addWidget(self.dropWidget)
+    rebuildIndexButton.connect("clicked(bool)", self.dropWidget.rebuild_dataset_index)
+    self.fieldStorageComboBox.connect("currentTextChanged(QString)", self.dropWidget.set_field_storage)
+    compactButton.connect("clicked(bool)", self.dropWidget.compact_loaded_fields)
+    self.watchFolderCheckBox.connect("toggled(bool)", self.dropWidget.set_watching)
+
+    # Add loading progress, hidden while nothing is loading
+    loadingLayout = qt.QHBoxLayout()
+    self.loadingProgressBar = qt.QProgressBar()
+    self.loadingProgressBar.setFormat("%v / %m files")
+    self.loadingProgressBar.hide()
+    self.loadingCancelButton = qt.QPushButton("Cancel")
+    self.loadingCancelButton.hide()
+    self.loadingCancelButton.connect("clicked(bool)", self.dropWidget.cancel_loading)
+    loadingLayout.addWidget(self.loadingProgressBar)
+    loadingLayout.addWidget(self.loadingCancelButton)
+    collapsibleLayout.addLayout(loadingLayout)
 
     # Add final stretch to the collapsible layout
     collapsibleLayout.addStretch(1)
@@ -79,6 +140,53 @@ class DropWidget(qt.QFrame):
         # Store reference to parent widget for accessing configuration
         self.moduleWidget = parent
 
+        # files are read on worker threads, the nodes are created on the main thread
+        self.loader = parallel_loading.ParallelLoader(
+            max_workers=slicer.util.settingsValue("registrationViewer/LoadingThreads",
+                                                  parallel_loading.DEFAULT_MAX_WORKERS,
+                                                  converter=int),
+            on_progress=self._on_loading_progress,
+            on_finished=self._on_loading_finished,
+            cache=nifti_cache.NiftiCache(
+                os.path.join(slicer.app.cachePath, "registrationViewer", "nifti"),
+                max_bytes=slicer.util.settingsValue("registrationViewer/NiftiCacheMegabytes",
+                                                    nifti_cache.DEFAULT_CACHE_BYTES // 1024 ** 2,
+                                                    converter=int) * 1024 ** 2),
+            field_dtype=utils.FieldStorage(parent.fieldStorageComboBox.currentText).dtype
+            if parent is not None else None)
+
+        # (group, -index) of the originals currently set in the selectors, the last group wins
+        self._selected_originals = {}
+
+        # case name -> paths of the original data, instead of globbing for every case
+        self._dataset_index: Optional[dataset_index.DatasetIndex] = None
+
+        # originals shared by several groups are loaded once
+        self.loaded_originals = loaded_originals.LoadedOriginals()
+
+        # groups registered as placeholders, loaded when their transformation is selected
+        self.lazy_groups = lazy_groups.LazyGroupRegistry(
+            max_bytes=slicer.util.settingsValue("registrationViewer/GroupMemoryMegabytes",
+                                                lazy_groups.DEFAULT_BUDGET_BYTES // 1024 ** 2,
+                                                converter=int) * 1024 ** 2,
+            originals=self.loaded_originals)
+        self._original_data_path = ""
+
+        # displacement field path -> group, groups whose files did not change are not loaded again
+        self.loaded_groups: Dict[str, folder_watch.LoadedGroup] = {}
+
+        # loads what is written into the dropped folder later
+        self._dropped_folder = ""
+        self.watcher = folder_watch.FolderWatcher(
+            self._on_watched_folder_changed,
+            interval_seconds=slicer.util.settingsValue("registrationViewer/WatchIntervalSeconds",
+                                                       folder_watch.DEFAULT_INTERVAL_SECONDS,
+                                                       converter=float))
+
+        if parent is not None:
+            parent.ui.inputSelector_transformation.connect(
+                "currentNodeChanged(vtkMRMLNode*)", self._on_transformation_selected)
+
     def dragEnterEvent(self, event) -> None:
         if event.mimeData().hasUrls():
             event.accept()
@@ -107,13 +215,31 @@ class DropWidget(qt.QFrame):
                 self.moduleWidget.indicesInput.text.strip()
             )
 
-        utils.collapse_all_segmentations()
+            self._dropped_folder = paths[0]
+            if self.moduleWidget.watchFolderCheckBox.checked:
+                self.watcher.start(self._dropped_folder)
+
+    def set_watching(self, watching: bool) -> None:
+        if not watching:
+            self.watcher.stop()
+        elif self._dropped_folder != "":
+            self.watcher.start(self._dropped_folder)
+
+    def _on_watched_folder_changed(self, folder: str) -> None:
+        self.load_data_from_dropped_folder(folder,
+                                           self.moduleWidget.pathLineEdit.currentPath,
+                                           self.moduleWidget.indicesInput.text.strip(),
+                                           select_originals=False)
 
     def load_data_from_dropped_folder(self, dropped_folder_path: str,
                                       original_data_path: str,
-                                      indices_text: str) -> None:
+                                      indices_text: str,
+                                      select_originals: bool = True) -> None:
         """
-        Load data from the specified directory structure
+        Load data from the specified directory structure.
+        Groups that are loaded already from unchanged files are skipped.
+
+        @param select_originals: Set the loaded originals in the fixed and moving selectors.
         """
         try:
             # First count how many groups we have
@@ -144,67 +270,312 @@ class DropWidget(qt.QFrame):
                         "Invalid indices format. Please use comma-separated numbers.")
                     return
 
-            # Load the selected groups
+            # one incremental refresh per drop, the cases are then looked up in the index
+            if os.path.isdir(original_data_path):
+                self.get_dataset_index(original_data_path).refresh()
+
+            lazy = self.moduleWidget.lazyLoadingCheckBox.checked
+            self._original_data_path = original_data_path
+
+            # originals that are loaded already are selected while the tasks are collected
+            self._selected_originals = {}
+
+            tasks: List[parallel_loading.LoadTask] = []
+            changed_lazy_groups = []
             for i in groups_to_load:
-                # Load displacement field
+                # Displacement field
                 filepath = os.path.join(deformationsPath, deformation_files[i])
-                logging.info(f"Loading displacement field: {filepath}")
-                slicer.util.loadTransform(filepath)
+                data_paths = []
 
                 # Get base name for matching deformed files
                 base_name = deformation_files[i].replace(
                     '_deformation_', '_deformed_')
                 deformedPath = os.path.join(dropped_folder_path, "deformed")
 
-                # Load volume
+                # Volume
                 volume_name = base_name
                 volume_path = os.path.join(deformedPath, volume_name)
                 if os.path.exists(volume_path):
-                    logging.info(f"Loading volume: {volume_path}")
-                    slicer.util.loadVolume(volume_path)
+                    data_paths.append((volume_path, parallel_loading.LoadKind.VOLUME))
 
-                # Load segmentation
+                # Segmentation
                 seg_name = base_name.replace('.nii.gz', '_seg.nii.gz')
                 seg_path = os.path.join(deformedPath, seg_name)
                 if os.path.exists(seg_path):
-                    logging.info(f"Loading segmentation: {seg_path}")
-                    slicer.util.loadSegmentation(seg_path)
-
-                self.load_orignal_data(volume_name,
-                                       original_data_path)
+                    data_paths.append((seg_path, parallel_loading.LoadKind.SEGMENTATION))
+
+                signature = folder_watch.group_signature([filepath] + [path for path, _ in data_paths])
+                loaded_group = self.loaded_groups.get(filepath)
+                if loaded_group is not None and loaded_group.removed:
+                    loaded_group = None
+                if loaded_group is not None and loaded_group.signature == signature:
+                    continue
+
+                if lazy:
+                    if loaded_group is not None and loaded_group.lazy_group is not None:
+                        self.lazy_groups.reset(loaded_group.lazy_group, data_paths)
+                        lazy_group = loaded_group.lazy_group
+                        changed_lazy_groups.append(lazy_group)
+                    else:
+                        self._remove_group(loaded_group)
+                        lazy_group = self.lazy_groups.add(i, filepath, data_paths, volume_name)
+
+                    self.loaded_groups[filepath] = folder_watch.LoadedGroup(signature, lazy_group)
+                    continue
+
+                node_transform = None
+                if loaded_group is not None and loaded_group.lazy_group is None:
+                    # reload into the same transform node, so it stays selected
+                    node_transform = loaded_group.node_transform
+                    for node in loaded_group.nodes:
+                        if node.GetScene() is not None:
+                            slicer.mrmlScene.RemoveNode(node)
+                else:
+                    self._remove_group(loaded_group)
+
+                loaded_group = folder_watch.LoadedGroup(signature)
+                self.loaded_groups[filepath] = loaded_group
+
+                tasks.append(parallel_loading.LoadTask(
+                    filepath,
+                    parallel_loading.LoadKind.TRANSFORM,
+                    on_loaded=loaded_group.set_transform,
+                    node=node_transform))
+                tasks.extend(parallel_loading.LoadTask(path, kind, on_loaded=loaded_group.nodes.append)
+                             for path, kind in data_paths)
+                tasks.extend(self.original_data_tasks(volume_name,
+                                                      original_data_path,
+                                                      group=i,
+                                                      select=select_originals))
+
+            self._update_index_statistics()
+            if tasks:
+                self.loader.load(tasks)
+                self._on_loading_progress(self.loader.done, self.loader.total, "")
+
+            # the selected group was reset, load its new files right away
+            selected = self.moduleWidget.ui.inputSelector_transformation.currentNode()
+            if any(selected is lazy_group.node_transform for lazy_group in changed_lazy_groups):
+                self._on_transformation_selected(selected)
 
         except Exception as e:
             logging.error(f"Error loading data: {str(e)}")
             slicer.util.errorDisplay(f"Error loading data: {str(e)}")
 
-    def load_orignal_data(self, file_name: str, data_path: str) -> None:
+    def original_data_tasks(self,
+                            file_name: str,
+                            data_path: str,
+                            group: int,
+                            select: bool = True,
+                            user=loaded_originals.PERMANENT) -> List[parallel_loading.LoadTask]:
+        """
+        Returns the load tasks of the original fixed and moving data of a deformed volume.
+        The first fixed and moving volume of the group are set in the input selectors unless
+        select is False. Originals that are loaded or loading already get no task, their
+        nodes are reused.
+
+        @param user: The placeholder group the originals count for, see LoadedOriginals.release().
+        """
+
         file_name = file_name.replace('.nii.gz', '')
         moving_name, fixed_name = file_name.split('_deformed_to_')
 
-        if data_path == "":
+        if data_path == "" or not os.path.isdir(data_path):
+            return []
+
+        index = self.get_dataset_index(data_path)
+
+        tasks = []
+        for role, name in (('moving', moving_name), ('fixed', fixed_name)):
+            volume_index = 0
+
+            # find all files of the case in the subdirectories of data_path
+            for file in index.find(name):
+                if dataset_index.is_segmentation_path(file):
+                    task = self.loaded_originals.task(file,
+                                                      parallel_loading.LoadKind.SEGMENTATION,
+                                                      user=user)
+                elif select:
+                    priority = (group, -volume_index)
+                    task = self.loaded_originals.task(
+                        file,
+                        parallel_loading.LoadKind.VOLUME,
+                        on_loaded=lambda node, role=role, priority=priority: self._select_original(role, priority, node),
+                        user=user)
+                    volume_index += 1
+                else:
+                    task = self.loaded_originals.task(file, parallel_loading.LoadKind.VOLUME, user=user)
+
+                if task is not None:
+                    tasks.append(task)
+
+        return tasks
+
+    def _remove_group(self, loaded_group: Optional[folder_watch.LoadedGroup]) -> None:
+        """
+        Removes the nodes of a group that is loaded again the other way (lazy or eager).
+        """
+
+        if loaded_group is None:
             return
 
-        fixed_volumes = []
-        moving_volumes = []
+        if loaded_group.lazy_group is not None:
+            self.lazy_groups.remove(loaded_group.lazy_group)
+            return
 
-        # find all files recrusively in data_path
-        for file in glob.glob(data_path + f"/*/{moving_name}.nii.gz", recursive=True):
-            if any([x in file.lower() for x in ['mask', 'seg', 'label']]):
-                slicer.util.loadSegmentation(file)
-            else:
-                moving_volumes.append(slicer.util.loadVolume(file))
+        for node in loaded_group.nodes + [loaded_group.node_transform]:
+            if node is not None and node.GetScene() is not None:
+                slicer.mrmlScene.RemoveNode(node)
 
-        for file in glob.glob(data_path + f"/*/{fixed_name}.nii.gz", recursive=True):
-            if any([x in file.lower() for x in ['mask', 'seg', 'label']]):
-                slicer.util.loadSegmentation(file)
-            else:
-                fixed_volumes.append(slicer.util.loadVolume(file))
+    def clear_loaded_groups(self) -> None:
+        """
+        Forgets the groups and originals of the closed scene and stops watching their folder.
+        """
+
+        self.watcher.stop()
+        self._dropped_folder = ""
+
+        self.lazy_groups.clear()
+        self.loaded_originals.clear()
+        self.loaded_groups = {}
+
+    def get_dataset_index(self, data_path: str) -> dataset_index.DatasetIndex:
+        """
+        Returns the index of the data directory, read from the cache directory of Slicer.
+        """
+
+        if self._dataset_index is None or self._dataset_index.data_path != data_path:
+            index_path = dataset_index.default_index_path(
+                data_path, os.path.join(slicer.app.cachePath, "registrationViewer"))
+            self._dataset_index = dataset_index.DatasetIndex(data_path, index_path)
+
+        return self._dataset_index
+
+    def rebuild_dataset_index(self) -> None:
+        data_path = self.moduleWidget.pathLineEdit.currentPath
+        if not os.path.isdir(data_path):
+            slicer.util.errorDisplay(f"Data directory does not exist: {data_path}")
+            return
+
+        with slicer.util.tryWithErrorDisplay("Could not rebuild the index", waitCursor=True):
+            self.get_dataset_index(data_path).rebuild()
+
+        self._update_index_statistics()
+
+    def _update_index_statistics(self) -> None:
+        if self._dataset_index is not None:
+            self.moduleWidget.indexStatsLabel.setText(
+                f"{self._dataset_index.statistics}, "
+                f"{self.loaded_originals.avoided_loads} original loads avoided")
+
+    def _select_original(self, role: str, priority, node) -> None:
+        """
+        Sets the node in the fixed or moving selector unless a node of a later group (or an
+        earlier file of the same group) is already set, as when loading sequentially.
+        """
+
+        if role in self._selected_originals and self._selected_originals[role] > priority:
+            return
+
+        self._selected_originals[role] = priority
+
+        if role == 'fixed':
+            self.moduleWidget.ui.inputSelector_fixed.setCurrentNode(node)
+        else:
+            self.moduleWidget.ui.inputSelector_moving.setCurrentNode(node)
+
+    def set_field_storage(self, storage_text: str) -> None:
+        """
+        Sets the type displacement fields are loaded into from now on.
+        """
+
+        self.loader.field_dtype = utils.FieldStorage(storage_text).dtype
+        qt.QSettings().setValue("registrationViewer/FieldStorage", storage_text)
+
+    def compact_loaded_fields(self) -> None:
+        """
+        Converts the displacement fields already in the scene to the selected field storage.
+        """
+
+        dtype = utils.FieldStorage(self.moduleWidget.fieldStorageComboBox.currentText).dtype
+        if dtype is None:
+            return
+
+        error_bounds = []
+        for node in slicer.util.getNodesByClass("vtkMRMLGridTransformNode"):
+            error_bound = utils.compact_transform_node(node, dtype)
+            if error_bound:
+                node.SetAttribute(parallel_loading.FIELD_ERROR_ATTRIBUTE, f"{error_bound:.6g}")
+                logging.info(f"{node.GetName()} stored as {dtype.name}, "
+                             f"displacement error at most {error_bound:.3g} mm")
+                error_bounds.append(error_bound)
+
+        slicer.util.showStatusMessage(
+            f"Compacted {len(error_bounds)} fields to {dtype.name}, "
+            f"displacement error at most {max(error_bounds, default=0.0):.3g} mm", 5000)
+
+    def _on_transformation_selected(self, node) -> None:
+        """
+        Loads the data of a placeholder group once its transformation is selected.
+        """
+
+        lazy_group = self.lazy_groups.find(node)
+        if lazy_group is None:
+            return
+
+        tasks = self.lazy_groups.materialise_tasks(lazy_group, self._on_group_ready, self._on_group_stale)
+        if not tasks:
+            return
+
+        self._selected_originals = {}
+        tasks.extend(self.original_data_tasks(lazy_group.volume_name,
+                                              self._original_data_path,
+                                              group=lazy_group.group,
+                                              user=lazy_group))
+        self._update_index_statistics()
+
+        self.loader.load(tasks)
+        self._on_loading_progress(self.loader.done, self.loader.total, "")
+
+    def _on_group_ready(self, lazy_group: lazy_groups.LazyGroup) -> None:
+        selected = self.moduleWidget.ui.inputSelector_transformation.currentNode()
+        self.lazy_groups.evict(keep=self.lazy_groups.find(selected))
+
+        # the views were set up while the transformation was still empty
+        if selected is lazy_group.node_transform:
+            self.moduleWidget._update_from_gui()  # pylint: disable=protected-access
+
+    def _on_group_stale(self, lazy_group: lazy_groups.LazyGroup) -> None:
+        # the files changed while the group was loading, the selected group is loaded again
+        if self.moduleWidget.ui.inputSelector_transformation.currentNode() is lazy_group.node_transform:
+            self._on_transformation_selected(lazy_group.node_transform)
+
+    def cancel_loading(self) -> None:
+        self.loader.cancel()
+        self._on_loading_finished(None)
+
+    def _on_loading_progress(self, done: int, total: int, path: str) -> None:
+        progressBar = self.moduleWidget.loadingProgressBar
+        progressBar.setMaximum(total)
+        progressBar.setValue(done)
+        progressBar.setToolTip(os.path.basename(path))
+        progressBar.show()
+        self.moduleWidget.loadingCancelButton.show()
+
+    def _on_loading_finished(self, failed: Optional[List[str]]) -> None:
+        self.lazy_groups.abort_loading()
+        self.loaded_originals.abort_pending()
+
+        # groups whose field did not arrive (cancelled or failed) are loaded again next time
+        self.loaded_groups = {path: loaded_group for path, loaded_group in self.loaded_groups.items()
+                              if loaded_group.lazy_group is not None or loaded_group.node_transform is not None}
+
+        self.moduleWidget.loadingProgressBar.hide()
+        self.moduleWidget.loadingCancelButton.hide()
+
+        utils.collapse_all_segmentations()
 
-        # Set the first fixed volume in the fixed volume input selector (same for moving)
-        if fixed_volumes:
-            self.moduleWidget.ui.inputSelector_fixed.setCurrentNode(
-                fixed_volumes[0])
+        logging.info(f"Decompressed image cache: {self.loader.cache.statistics}")
 
-        if moving_volumes:
-            self.moduleWidget.ui.inputSelector_moving.setCurrentNode(
-                moving_volumes[0])
+        if failed:
+            slicer.util.errorDisplay("Error loading data:\n" + "\n".join(failed))
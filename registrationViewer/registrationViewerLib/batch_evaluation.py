@@ -0,0 +1,344 @@
+"""
+Headless evaluation of a folder of registration results.
+
+Reads the same layout as the drop area of the module: <folder>/deformations/ with the
+displacement fields, and the original fixed and moving images of every group in the
+subdirectories of a data directory. For every group the moving image is warped with the
+field and subtracted from the fixed image, with the same engines the viewer uses, and
+quality metrics are written to one row of a CSV or Parquet summary. The groups are
+evaluated in parallel worker processes.
+
+Nothing here needs Slicer or Qt:
+
+    cd registrationViewer
+    python -m registrationViewerLib.batch_evaluation <result folder> --data-path <data directory> --output results.csv
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from registrationViewerLib import dataset_index, difference, image_io, warping
+
+DEFORMATION_SUFFIX = ".nii.gz"
+
+COLUMNS = ["group", "name", "moving", "fixed",
+           "mae", "rmse", "ncc",
+           "dice", "labels",
+           "jacobian_min", "jacobian_max", "jacobian_mean", "folding_fraction",
+           "seconds", "error"]
+
+
+def find_groups(folder: str, data_path: str, index_cache: str, indices: Optional[List[int]] = None) -> List[Dict]:
+    """
+    Lists the groups of a result folder, numbered like in the viewer, with the paths of their
+    displacement field and of the original fixed and moving images and segmentations.
+
+    @param indices: Only these groups, all groups if None.
+    """
+
+    deformations_path = os.path.join(folder, "deformations")
+    deformation_files = sorted(f for f in os.listdir(deformations_path)
+                               if f.endswith(DEFORMATION_SUFFIX))
+
+    index = dataset_index.DatasetIndex(data_path,
+                                       dataset_index.default_index_path(data_path, index_cache))
+    index.refresh()
+
+    groups = []
+    for i, file_name in enumerate(deformation_files):
+        if indices is not None and i not in indices:
+            continue
+
+        base_name = file_name.replace('_deformation_', '_deformed_')[:-len(DEFORMATION_SUFFIX)]
+        moving_name, fixed_name = base_name.split('_deformed_to_')
+
+        group = {"group": i,
+                 "name": base_name,
+                 "moving": moving_name,
+                 "fixed": fixed_name,
+                 "field_path": os.path.join(deformations_path, file_name)}
+
+        for role, case_name in (("moving", moving_name), ("fixed", fixed_name)):
+            paths = index.find(case_name)
+            images = [p for p in paths if not dataset_index.is_segmentation_path(p)]
+            segmentations = [p for p in paths if dataset_index.is_segmentation_path(p)]
+
+            # the first volume and segmentation of a case, like the input selectors of the viewer
+            group[f"{role}_path"] = images[0] if images else None
+            group[f"{role}_segmentation_path"] = segmentations[0] if segmentations else None
+
+        groups.append(group)
+
+    return groups
+
+
+def _slabs(shape, chunk_voxels: int):
+    slab = max(1, chunk_voxels // max(1, shape[1] * shape[2]))
+    for k_start in range(0, shape[0], slab):
+        yield k_start, min(shape[0], k_start + slab)
+
+
+def intensity_metrics(array_fixed: np.ndarray,
+                      array_warped: np.ndarray,
+                      array_diff: np.ndarray,
+                      chunk_voxels: int = warping.DEFAULT_CHUNK_VOXELS) -> Dict[str, float]:
+    """
+    Mean absolute and root mean square difference, and normalised cross-correlation of
+    the fixed and the warped image, accumulated slab by slab in float64.
+    """
+
+    sums = np.zeros(7)
+    for k_start, k_stop in _slabs(array_fixed.shape, chunk_voxels):
+        diff = array_diff[k_start:k_stop].astype(np.float64)
+        fixed = array_fixed[k_start:k_stop].astype(np.float64)
+        warped = array_warped[k_start:k_stop].astype(np.float64)
+
+        sums += (np.abs(diff).sum(), (diff * diff).sum(),
+                 fixed.sum(), warped.sum(),
+                 (fixed * fixed).sum(), (warped * warped).sum(), (fixed * warped).sum())
+
+    n = array_fixed.size
+    abs_sum, square_sum, fixed_sum, warped_sum, fixed_square_sum, warped_square_sum, cross_sum = sums
+
+    covariance = cross_sum / n - fixed_sum / n * warped_sum / n
+    variance_fixed = fixed_square_sum / n - (fixed_sum / n) ** 2
+    variance_warped = warped_square_sum / n - (warped_sum / n) ** 2
+    denominator = np.sqrt(max(variance_fixed, 0.0) * max(variance_warped, 0.0))
+
+    return {"mae": float(abs_sum / n),
+            "rmse": float(np.sqrt(square_sum / n)),
+            "ncc": float(covariance / denominator) if denominator > 0 else float("nan")}
+
+
+def dice_overlap(labels_fixed: np.ndarray,
+                 labels_warped: np.ndarray,
+                 chunk_voxels: int = warping.DEFAULT_CHUNK_VOXELS) -> Dict[str, float]:
+    """
+    Mean Dice coefficient over the labels (other than 0) of either label map.
+    """
+
+    size = int(max(labels_fixed.max(), labels_warped.max())) + 1
+    counts_fixed = np.zeros(size, dtype=np.int64)
+    counts_warped = np.zeros(size, dtype=np.int64)
+    counts_both = np.zeros(size, dtype=np.int64)
+
+    for k_start, k_stop in _slabs(labels_fixed.shape, chunk_voxels):
+        fixed = labels_fixed[k_start:k_stop].ravel().astype(np.intp)
+        warped = labels_warped[k_start:k_stop].ravel().astype(np.intp)
+
+        counts_fixed += np.bincount(fixed, minlength=size)
+        counts_warped += np.bincount(warped, minlength=size)
+        counts_both += np.bincount(fixed[fixed == warped], minlength=size)
+
+    present = (counts_fixed + counts_warped)[1:] > 0
+    if not present.any():
+        return {"dice": float("nan"), "labels": 0}
+
+    dice = 2 * counts_both[1:][present] / (counts_fixed + counts_warped)[1:][present]
+
+    return {"dice": float(dice.mean()), "labels": int(present.sum())}
+
+
+def jacobian_metrics(field: warping.DisplacementField,
+                     chunk_voxels: int = warping.DEFAULT_CHUNK_VOXELS // 4) -> Dict[str, float]:
+    """
+    Statistics of the Jacobian determinant of p -> p + u(p) on the grid of the field,
+    with central differences computed slab by slab over a one-slice halo.
+    A determinant <= 0 is a folding of the transform.
+    """
+
+    array = field.array
+    shape = array.shape[:3]
+
+    # d(ijk)/d(ras), to turn derivatives along the grid axes into spatial ones
+    ras_to_ijk = field.ras_to_ijk[:3, :3]
+
+    minimum = np.inf
+    maximum = -np.inf
+    total = 0.0
+    folded = 0
+
+    for k_start, k_stop in _slabs(shape, chunk_voxels):
+        halo_start = max(0, k_start - 1)
+        halo_stop = min(shape[0], k_stop + 1)
+
+        block = array[halo_start:halo_stop].astype(np.float32)
+        if field.displacement_scale != 1.0:
+            block *= field.displacement_scale
+
+        # derivatives of every component along i, j, k: [..., component, axis]
+        gradients = np.empty(block.shape[:3] + (3, 3), dtype=np.float32)
+        for column, axis in enumerate((2, 1, 0)):
+            if block.shape[axis] > 1:
+                gradients[..., column] = np.gradient(block, axis=axis)
+            else:
+                gradients[..., column] = 0
+
+        gradients = gradients[k_start - halo_start:k_stop - halo_start]
+
+        jacobian = gradients @ ras_to_ijk.astype(np.float32)
+        jacobian += np.eye(3, dtype=np.float32)
+        determinant = np.linalg.det(jacobian)
+
+        minimum = min(minimum, float(determinant.min()))
+        maximum = max(maximum, float(determinant.max()))
+        total += float(determinant.sum(dtype=np.float64))
+        folded += int(np.count_nonzero(determinant <= 0))
+
+    n = shape[0] * shape[1] * shape[2]
+
+    return {"jacobian_min": minimum,
+            "jacobian_max": maximum,
+            "jacobian_mean": total / n,
+            "folding_fraction": folded / n}
+
+
+def evaluate_group(group: Dict) -> Dict:
+    """
+    Evaluates one group, see find_groups(). Failures are reported in the "error" column.
+    """
+
+    start = time.perf_counter()
+    row = {column: group.get(column) for column in ("group", "name", "moving", "fixed")}
+
+    try:
+        field_array, field_ijk_to_ras = image_io.read_displacement_field(group["field_path"])
+        field = warping.DisplacementField(field_array, field_ijk_to_ras)
+        row.update(jacobian_metrics(field))
+
+        if group["fixed_path"] is not None and group["moving_path"] is not None:
+            array_fixed, fixed_ijk_to_ras = image_io.read_image(group["fixed_path"])
+            array_moving, moving_ijk_to_ras = image_io.read_image(group["moving_path"])
+
+            array_warped = np.empty(array_fixed.shape, dtype=array_moving.dtype)
+            array_diff = np.empty(array_fixed.shape,
+                                  dtype=difference.difference_dtype(array_fixed.dtype, array_moving.dtype))
+
+            difference.warp_and_subtract(array_fixed,
+                                         fixed_ijk_to_ras,
+                                         array_moving,
+                                         np.linalg.inv(moving_ijk_to_ras),
+                                         field,
+                                         array_warped,
+                                         array_diff)
+
+            row.update(intensity_metrics(array_fixed, array_warped, array_diff))
+            del array_moving, array_warped, array_diff
+
+        if group["fixed_segmentation_path"] is not None and group["moving_segmentation_path"] is not None:
+            labels_fixed, labels_fixed_ijk_to_ras = image_io.read_image(group["fixed_segmentation_path"])
+            labels_moving, labels_moving_ijk_to_ras = image_io.read_image(group["moving_segmentation_path"])
+
+            labels_warped = np.empty(labels_fixed.shape, dtype=labels_moving.dtype)
+            warping.warp_labels(labels_moving,
+                                np.linalg.inv(labels_moving_ijk_to_ras),
+                                field,
+                                labels_fixed_ijk_to_ras,
+                                labels_warped)
+
+            row.update(dice_overlap(labels_fixed, labels_warped))
+
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {str(e)}"
+
+    row["seconds"] = time.perf_counter() - start
+
+    return row
+
+
+def write_rows(rows: List[Dict], output_path: str) -> None:
+    """
+    Writes the rows as CSV, or as Parquet if the output ends with .parquet (needs pandas).
+    """
+
+    rows = sorted(rows, key=lambda row: row["group"])
+
+    if output_path.endswith(".parquet"):
+        try:
+            import pandas as pd
+        except ImportError:
+            raise RuntimeError("Writing Parquet needs pandas and pyarrow, or write a .csv instead")
+
+        pd.DataFrame(rows, columns=COLUMNS).to_parquet(output_path, index=False)
+        return
+
+    with open(output_path, "w", newline="") as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def evaluate_folder(folder: str,
+                    data_path: str,
+                    output_path: str,
+                    index_cache: str,
+                    indices: Optional[List[int]] = None,
+                    workers: Optional[int] = None) -> List[Dict]:
+    """
+    Evaluates all groups of a result folder in worker processes and writes the summary.
+    """
+
+    groups = find_groups(folder, data_path, index_cache, indices)
+    logging.info(f"Evaluating {len(groups)} groups of {folder}")
+
+    rows = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(evaluate_group, group) for group in groups]
+
+        for future in concurrent.futures.as_completed(futures):
+            row = future.result()
+            rows.append(row)
+
+            status = row["error"] if row.get("error") else f"mae {row.get('mae')}, dice {row.get('dice')}"
+            logging.info(f"[{len(rows)}/{len(groups)}] {row['name']}: {status} ({row['seconds']:.1f} s)")
+
+    write_rows(rows, output_path)
+    logging.info(f"Wrote {output_path}")
+
+    return rows
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("folder", help="Result folder with a deformations/ subdirectory")
+    parser.add_argument("--data-path", required=True,
+                        help="Directory with the original images in subdirectories")
+    parser.add_argument("--output", default="results.csv", help="Summary, .csv or .parquet")
+    parser.add_argument("--indices", default="",
+                        help="Comma-separated group indices, all groups if empty")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1),
+                        help="Number of worker processes")
+    parser.add_argument("--index-cache",
+                        default=os.path.join(os.path.expanduser("~"), ".cache", "registrationViewer"),
+                        help="Directory of the dataset index file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    indices = None
+    if args.indices != "":
+        try:
+            indices = [int(index.strip()) for index in args.indices.split(',')]
+        except ValueError:
+            parser.error("Invalid indices format. Please use comma-separated numbers.")
+
+    rows = evaluate_folder(args.folder,
+                           args.data_path,
+                           args.output,
+                           args.index_cache,
+                           indices=indices,
+                           workers=args.workers)
+
+    return 1 if any(row.get("error") for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
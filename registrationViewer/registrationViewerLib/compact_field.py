@@ -0,0 +1,66 @@
+"""
+Compact storage of displacement fields.
+
+Fields are stored as float32, or quantised to int16 with a displacement scale and
+shift, the representation vtkGridTransform interpolates natively (displacement =
+value * scale + shift). Both VTK and warping.DisplacementField interpolate the compact
+array directly, so the only error is the rounding of the stored values, which is
+bounded and returned.
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+from registrationViewerLib import warping
+
+
+def _slabs(array: np.ndarray, chunk_voxels: int):
+    slab = max(1, chunk_voxels // max(1, array.shape[1] * array.shape[2]))
+    for k_start in range(0, array.shape[0], slab):
+        yield slice(k_start, min(array.shape[0], k_start + slab))
+
+
+def compact_displacements(array: np.ndarray,
+                          dtype,
+                          chunk_voxels: int = warping.DEFAULT_CHUNK_VOXELS
+                          ) -> Tuple[np.ndarray, float, float, float]:
+    """
+    Converts a [k, j, i, 3] displacement array to a compact dtype.
+
+    @param array: Displacements in mm, float.
+    @param dtype: np.float32 or np.int16 (any float or signed integer dtype works).
+    @param chunk_voxels: Approximate number of grid points converted at once.
+    @return: The compact array, the displacement scale and shift to apply to it, and
+             the bound on the absolute error of every displacement component in mm.
+    """
+
+    dtype = np.dtype(dtype)
+    if dtype == array.dtype:
+        return array, 1.0, 0.0, 0.0
+
+    lowest = np.inf
+    highest = -np.inf
+    for slab in _slabs(array, chunk_voxels):
+        lowest = min(lowest, float(array[slab].min()))
+        highest = max(highest, float(array[slab].max()))
+
+    out = np.empty(array.shape, dtype=dtype)
+
+    if dtype.kind == 'f':
+        for slab in _slabs(array, chunk_voxels):
+            out[slab] = array[slab]
+
+        # round to nearest: relative error of half a unit in the last place
+        largest = max(abs(lowest), abs(highest))
+        return out, 1.0, 0.0, largest * float(np.finfo(dtype).eps) / 2
+
+    # symmetric range of the integer type, so the shift maps to 0
+    levels = int(np.iinfo(dtype).max)
+    shift = (highest + lowest) / 2
+    scale = (highest - lowest) / (2 * levels) if highest > lowest else 1.0
+
+    for slab in _slabs(array, chunk_voxels):
+        out[slab] = np.rint((array[slab] - shift) / scale)
+
+    return out, scale, shift, scale / 2
@@ -0,0 +1,236 @@
+"""
+Side by side comparison of several registration results of the same image pair.
+
+The comparison layout has one row of views for the fixed image and one for the moving
+image of every compared transformation. A cursor move is mapped into the fixed space
+once and from there through all transformations together (warping.MappingStack). The
+slice nodes of all views are modified in one batch, with one modified event per node at
+its end, and the markers of all views are placed with one solve, so a move does not
+cost K separate lookups and renders. Each view still reslices once.
+"""
+
+import functools
+from typing import Dict, List, Optional, Tuple
+
+import ctk
+import numpy as np
+import qt
+import slicer
+
+from registrationViewerLib import background, crosshair_renderer, latency, lazy_groups, transform_analysis, \
+    transform_lookup, view_logic, warping
+
+
+class _LookupMapping:
+    """
+    A transform that only VTK can evaluate, with the transform_point() MappingStack expects.
+    """
+
+    def __init__(self, lookup: transform_lookup.TransformLookup) -> None:
+        self._lookup = lookup
+
+    def transform_point(self, point_ras) -> np.ndarray:
+        return np.asarray(self._lookup.fixed_to_moving(list(point_ras)))
+
+
+class ComparisonCrosshairs:
+    """
+    Keeps the views of the comparison layout at the cursor.
+
+    Row 0 shows the fixed image, row r the moving image under node_transformations[r - 1].
+    """
+
+    def __init__(self,
+                 node_cursor,
+                 node_transformations: List[slicer.vtkMRMLTransformNode],
+                 view_rows: List[List[str]],
+                 latency_recorder: Optional[latency.LatencyRecorder] = None,
+                 node_reference: Optional[slicer.vtkMRMLVolumeNode] = None) -> None:
+        """
+        @param node_reference: Volume composite transforms are flattened on, the fixed volume.
+        """
+
+        assert node_cursor is not None, "Cursor node is None"
+        assert len(view_rows) == len(node_transformations) + 1, "Expected one row per transformation and the fixed row"
+
+        self.node_cursor = node_cursor
+        self.node_transformations = list(node_transformations)
+        self.node_reference = node_reference
+        self.view_rows = view_rows
+        self.views = [view for row in view_rows for view in row]
+        self.cursor_view: str = ""
+
+        self._row_of_view = {view: row for row, views in enumerate(view_rows) for view in views}
+
+        self._lookups: List[Optional[transform_lookup.TransformLookup]] = [None] * len(self.node_transformations)
+        self._stack: Optional[warping.MappingStack] = None
+        # one field is flattened or inverted at a time, the next job starts when the previous one is done
+        self._field_runner = background.BackgroundRunner()
+
+        self.latency = latency_recorder if latency_recorder is not None else latency.LatencyRecorder()
+        self._render_observers: List[Tuple] = []
+
+        self.crosshair_markers: Dict[str, crosshair_renderer.SliceViewMarker] = {
+            view: crosshair_renderer.SliceViewMarker(view) for view in self.views
+        }
+        for view, marker in self.crosshair_markers.items():
+            render_window = marker.slice_view.renderWindow()
+            for tag in latency.observe_render_window(self.latency, render_window, view):
+                self._render_observers.append((render_window, tag))
+
+        self._update_lookups()
+
+    def delete_crosshairs(self) -> None:
+        """
+        Delete the crosshair markers and shut down the worker flattening and inverting the fields.
+        """
+
+        self._field_runner.shutdown()
+
+        for render_window, tag in self._render_observers:
+            render_window.RemoveObserver(tag)
+        self._render_observers = []
+
+        for marker in self.crosshair_markers.values():
+            marker.remove()
+
+        self.crosshair_markers = {}
+
+    def _update_lookups(self) -> None:
+        """
+        Rebuilds the lookups of transformations whose content changed, and the mapping stack with them.
+        """
+
+        changed = False
+        for n, node_transformation in enumerate(self.node_transformations):
+            lookup = self._lookups[n]
+            if lookup is None or not lookup.is_current(node_transformation):
+                self._lookups[n] = transform_lookup.TransformLookup(node_transformation,
+                                                                     self.node_reference)
+                changed = True
+
+        if changed or self._stack is None:
+            self._stack = warping.MappingStack(
+                [lookup.field if lookup.field is not None else _LookupMapping(lookup) for lookup in self._lookups])
+
+        self._submit_next_job()
+
+    def _submit_next_job(self) -> None:
+        """
+        Starts flattening the next composite transform, or else inverting the next field that
+        has no inverse yet. Until then, the transform is evaluated with VTK.
+        """
+
+        if self._field_runner.running:
+            return
+
+        for lookup in self._lookups:
+            if lookup.needs_flatten:
+                self._field_runner.submit(transform_analysis.flatten_job,
+                                          functools.partial(self._on_flattened, lookup),
+                                          lookup.pending_flatten)
+                return
+
+        for lookup in self._lookups:
+            if lookup.needs_inverse:
+                self._field_runner.submit(transform_lookup.compute_inverse_job,
+                                          functools.partial(self._on_inverse_done, lookup),
+                                          lookup.field)
+                return
+
+    def _on_flattened(self, lookup: transform_lookup.TransformLookup, field) -> None:
+        lookup.set_field(field)
+
+        # the stack evaluates the new field from the next move on
+        self._stack = None
+        self._submit_next_job()
+
+    def _on_inverse_done(self, lookup: transform_lookup.TransformLookup, result) -> None:
+        lookup.set_inverse(result)
+        self._submit_next_job()
+
+    def on_mouse_moved_place_crosshair(self, observer, eventid) -> None:  # pylint: disable=unused-argument
+        """
+        When the mouse moves in a view, the views of every row follow the cursor.
+        The whole update is recorded as the "total" stage of self.latency.
+        """
+
+        with self.latency.measure("total"), self.latency.update(), view_logic.batched_view_update(self.views):
+            self._place_crosshairs()
+
+        if self.cursor_view in self._row_of_view:
+            self.latency.expect_renders(view for view, marker in self.crosshair_markers.items()
+                                        if marker.slice_view.isVisible())
+
+    def _place_crosshairs(self) -> None:
+        row = self._row_of_view.get(self.cursor_view)
+        if row is None:
+            return
+
+        self._update_lookups()
+
+        position: List[float] = [0., 0., 0.]
+        self.node_cursor.GetCursorPositionRAS(position)
+
+        with self.latency.measure("transform"):
+            fixed_position = position if row == 0 else self._lookups[row - 1].moving_to_fixed(position)
+
+            positions = np.vstack([fixed_position, self._stack.transform_point(fixed_position)])
+            # the row of the cursor stays exactly at the cursor
+            positions[row] = position
+
+        markers = [self.crosshair_markers[view] for view in self.views]
+        view_positions = positions[[self._row_of_view[view] for view in self.views]]
+
+        # the slice nodes are held by batched_view_update, their views reslice once it ends
+        with self.latency.measure("jump"):
+            for marker, view_position in zip(markers, view_positions):
+                marker.slice_node.JumpSliceByOffsetting(*view_position)
+
+        with self.latency.measure("markers"):
+            for marker in markers:
+                marker.set_visible(marker.view != self.cursor_view)
+
+            crosshair_renderer.SliceViewMarker.set_positions(markers, view_positions)
+
+
+def create_comparison_ui(self) -> None:
+    """
+    Adds a collapsible panel to pick the transformations shown by the comparison layout.
+    The Compare button calls self.on_compare_transformations(nodes).
+    """
+
+    comparisonCollapsible = ctk.ctkCollapsibleButton()
+    comparisonCollapsible.text = "Compare results"
+    comparisonCollapsible.collapsed = True
+    self.layout.addWidget(comparisonCollapsible)
+
+    collapsibleLayout = qt.QVBoxLayout(comparisonCollapsible)
+
+    self.comparisonSelector = slicer.qMRMLCheckableNodeComboBox()
+    self.comparisonSelector.nodeTypes = ["vtkMRMLTransformNode"]
+    self.comparisonSelector.addEnabled = False
+    self.comparisonSelector.removeEnabled = False
+    self.comparisonSelector.renameEnabled = False
+    self.comparisonSelector.setMRMLScene(slicer.mrmlScene)
+    self.comparisonSelector.setToolTip("Transformations shown in one row each, below the fixed image")
+    collapsibleLayout.addWidget(self.comparisonSelector)
+
+    buttonsLayout = qt.QHBoxLayout()
+    compareButton = qt.QPushButton("Compare")
+    buttonsLayout.addWidget(compareButton)
+    buttonsLayout.addStretch()
+    collapsibleLayout.addLayout(buttonsLayout)
+
+    def compare():
+        nodes = self.comparisonSelector.checkedNodes()
+
+        # placeholder groups have no field to look up
+        placeholders = [node.GetName() for node in nodes if lazy_groups.is_placeholder(node)]
+        if placeholders:
+            slicer.util.showStatusMessage(
+                f"Not loaded yet, select once to load: {', '.join(placeholders)}", 5000)
+
+        self.on_compare_transformations([node for node in nodes if not lazy_groups.is_placeholder(node)])
+
+    compareButton.connect("clicked(bool)", compare)
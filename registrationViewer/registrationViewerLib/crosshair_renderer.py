@@ -0,0 +1,115 @@
+from typing import List, Sequence
+
+import numpy as np
+import slicer
+import vtk
+
+from registrationViewerLib import view_logic
+
+# half size of the cross in pixels
+CROSS_HALF_SIZE = 8
+
+# same colour as the markups the crosshairs used to be drawn with
+CROSS_COLOR = (1.0, 0.5, 0.5)
+
+
+class SliceViewMarker:
+    """
+    Cross drawn directly into the renderer of one slice view.
+
+    Moving or hiding it changes a VTK actor only, so it fires no MRML events; the view
+    is asked to render once the position changed.
+    """
+
+    def __init__(self, view: str) -> None:
+        self.view = view
+
+        handles = view_logic.registry.view(view)
+        self.slice_view = handles.slice_view
+        self.slice_node = handles.slice_node
+
+        self.position_ras = np.zeros(3)
+        # XYToRAS the cross was placed with, its slice node may be modified without moving it
+        self._xy_to_ras_mtime = 0
+
+        points = vtk.vtkPoints()
+        points.InsertNextPoint(-CROSS_HALF_SIZE, 0, 0)
+        points.InsertNextPoint(CROSS_HALF_SIZE, 0, 0)
+        points.InsertNextPoint(0, -CROSS_HALF_SIZE, 0)
+        points.InsertNextPoint(0, CROSS_HALF_SIZE, 0)
+
+        lines = vtk.vtkCellArray()
+        for start in (0, 2):
+            line = vtk.vtkLine()
+            line.GetPointIds().SetId(0, start)
+            line.GetPointIds().SetId(1, start + 1)
+            lines.InsertNextCell(line)
+
+        cross = vtk.vtkPolyData()
+        cross.SetPoints(points)
+        cross.SetLines(lines)
+
+        mapper = vtk.vtkPolyDataMapper2D()
+        mapper.SetInputData(cross)
+
+        self.actor = vtk.vtkActor2D()
+        self.actor.SetMapper(mapper)
+        self.actor.GetProperty().SetColor(*CROSS_COLOR)
+        self.actor.GetProperty().SetLineWidth(2)
+        self.actor.VisibilityOff()
+
+        self.renderer = self.slice_view.renderWindow().GetRenderers().GetFirstRenderer()
+        self.renderer.AddActor2D(self.actor)
+
+        # panning and zooming change XYToRAS, the cross has to follow
+        self._observer = self.slice_node.AddObserver(vtk.vtkCommand.ModifiedEvent,
+                                                     self._on_slice_node_modified)
+
+    def remove(self) -> None:
+        self.slice_node.RemoveObserver(self._observer)
+        self.renderer.RemoveActor2D(self.actor)
+        self.slice_view.scheduleRender()
+
+    def set_position(self, position_ras: List[float]) -> None:
+        self.position_ras = np.asarray(position_ras, dtype=np.float64)
+        self._update_display_position()
+
+    @staticmethod
+    def set_positions(markers: Sequence["SliceViewMarker"], positions: np.ndarray) -> None:
+        """
+        Moves several markers at once. The display positions of all views are solved together.
+
+        @param positions: One RAS position per marker, shape (len(markers), 3).
+        """
+
+        if not markers:
+            return
+
+        xy_to_ras = np.stack([slicer.util.arrayFromVTKMatrix(marker.slice_node.GetXYToRAS()) for marker in markers])
+        ras = np.hstack([np.asarray(positions, dtype=np.float64), np.ones((len(markers), 1))])
+        xy = np.linalg.solve(xy_to_ras, ras[..., np.newaxis])[..., 0]
+
+        for marker, position_ras, marker_xy in zip(markers, ras, xy):
+            marker.position_ras = position_ras[:3]
+            marker._move_actor(marker_xy)
+
+    def set_visible(self, visible: bool) -> None:
+        if bool(self.actor.GetVisibility()) == visible:
+            return
+
+        self.actor.SetVisibility(visible)
+        self.slice_view.scheduleRender()
+
+    def _on_slice_node_modified(self, caller=None, event=None) -> None:  # pylint: disable=unused-argument
+        if self.actor.GetVisibility() and self.slice_node.GetXYToRAS().GetMTime() != self._xy_to_ras_mtime:
+            self._update_display_position()
+
+    def _update_display_position(self) -> None:
+        xy_to_ras = slicer.util.arrayFromVTKMatrix(self.slice_node.GetXYToRAS())
+        self._move_actor(np.linalg.solve(xy_to_ras, np.append(self.position_ras, 1.0)))
+
+    def _move_actor(self, xy: np.ndarray) -> None:
+        self._xy_to_ras_mtime = self.slice_node.GetXYToRAS().GetMTime()
+
+        self.actor.SetPosition(xy[0], xy[1])
+        self.slice_view.scheduleRender()
@@ -1,7 +1,8 @@
-from typing import List, Literal
+import functools
+from typing import Dict, List, Literal, Optional
 
-import numpy as np
-import slicer
+from registrationViewerLib import background, crosshair_renderer, latency, transform_analysis, transform_lookup, \
+    view_logic
 
 
 class Crosshairs():
@@ -15,7 +16,9 @@ class Crosshairs():
                  node_transformation,
                  use_transform,
                  offset_diffs: List[float],
-                 apply_offsets: bool) -> None:
+                 apply_offsets: bool,
+                 latency_recorder: Optional[latency.LatencyRecorder] = None,
+                 node_reference=None) -> None:
 
         assert node_cursor is not None, "Cursor node is None"
         assert use_transform is not None, "Use transform is None"
@@ -23,7 +26,12 @@ class Crosshairs():
         self.node_cursor = node_cursor
         self.use_transform = use_transform
 
-        self.node_transformation = node_transformation
+        self._node_transformation = node_transformation
+        # composite transforms are flattened on the grid of this volume, see TransformLookup
+        self._node_reference = node_reference
+        self._lookup: Optional[transform_lookup.TransformLookup] = None
+        # flattens and inverts the field of the lookup
+        self._field_runner = background.BackgroundRunner()
         self.cursor_view: str = ""
         self.reverse_transf_direction: bool = False
 
@@ -35,72 +43,145 @@ class Crosshairs():
         self.offset_diffs = offset_diffs
         self.apply_offsets = apply_offsets
 
-        self.create_crosshairs_and_folder()
+        self.latency = latency_recorder if latency_recorder is not None else latency.LatencyRecorder()
+        self._render_observers: List[tuple] = []
 
-    def create_crosshairs_and_folder(self) -> None:
+        self.crosshair_markers: Dict[str, crosshair_renderer.SliceViewMarker] = {}
+        self.create_crosshairs()
 
-        self.crosshair_nodes = {
-            view: self.create_crosshair(view) for view in self.views
-        }
+        _ = self.lookup
 
-        # create a folder to put the crosshairs in
-        self.sh_node = slicer.mrmlScene.GetSubjectHierarchyNode()
-        self.crosshair_folder_id = self.sh_node.CreateFolderItem(
-            self.sh_node.GetSceneItemID(), "crosshairs")
+    def create_crosshairs(self) -> None:
+        """
+        Create one crosshair marker per view.
+        """
 
-        for _, crosshair_node in self.crosshair_nodes.items():
-            self.sh_node.SetItemParent(self.sh_node.GetItemByDataNode(
-                crosshair_node), self.crosshair_folder_id)
+        self.crosshair_markers = {
+            view: crosshair_renderer.SliceViewMarker(view) for view in self.views
+        }
 
-        # collapse folder
-        self.sh_node.SetItemExpanded(self.crosshair_folder_id, False)
+        # the views render after the event returned, so their render time is observed separately
+        for view, marker in self.crosshair_markers.items():
+            render_window = marker.slice_view.renderWindow()
+            for tag in latency.observe_render_window(self.latency, render_window, view):
+                self._render_observers.append((render_window, tag))
 
-    def delete_crosshairs_and_folder(self) -> None:
+    def delete_crosshairs(self) -> None:
         """
-        Delete the crosshairs and the folder.
+        Delete the crosshair markers and shut down the worker of the fields.
         """
 
-        for _, node in self.crosshair_nodes.items():
-            slicer.mrmlScene.RemoveNode(node)
+        self._field_runner.shutdown()
 
-        self.sh_node.RemoveItem(self.crosshair_folder_id)
+        for render_window, tag in self._render_observers:
+            render_window.RemoveObserver(tag)
+        self._render_observers = []
 
-    @staticmethod
-    def create_crosshair(view: str) -> slicer.vtkMRMLMarkupsFiducialNode:
+        for _, marker in self.crosshair_markers.items():
+            marker.remove()
+
+        self.crosshair_markers = {}
+
+    def jump_slices_to_location(self, view_group: int, position: List[float]) -> None:
         """
-        Create a crosshair in the given views.
+        Moves the slices of the given view group to the position.
+        Equivalent to JumpSlicesToLocation without centering.
+
+        Called within on_mouse_moved_place_crosshair(), whose batched_view_update holds the
+        modified events of all slice nodes until every view group has moved.
         """
 
-        crosshair_node = slicer.mrmlScene.AddNewNodeByClass(
-            "vtkMRMLMarkupsFiducialNode")
-        crosshair_node.SetName("")
+        views = {1: self.views_1, 2: self.views_2, 3: self.views_3}[view_group]
 
-        crosshair_node.AddControlPoint(0, 0, 0, "")
-        crosshair_node.SetNthControlPointLabel(0, "")
-        crosshair_node.GetDisplayNode().SetGlyphScale(1)
+        for view in views:
+            self.crosshair_markers[view].slice_node.JumpSliceByOffsetting(position[0],
+                                                                          position[1],
+                                                                          position[2])
 
-        slice_node_IDs = [slicer.app.layoutManager().sliceWidget(
-            view).mrmlSliceNode().GetID()]
+    @property
+    def node_transformation(self):
+        return self._node_transformation
 
-        crosshair_node.GetDisplayNode().SetViewNodeIDs(
-            slice_node_IDs)
+    @node_transformation.setter
+    def node_transformation(self, node_transformation) -> None:
+        self._node_transformation = node_transformation
+        self._lookup = None
 
-        return crosshair_node
+        # start inverting the new field right away instead of on the next mouse move
+        _ = self.lookup
 
-    @staticmethod
-    def reverse_transformation_direction(position, new_position):
+    @property
+    def node_reference(self):
+        return self._node_reference
+
+    @node_reference.setter
+    def node_reference(self, node_reference) -> None:
+        self._node_reference = node_reference
+        self._lookup = None
+
+        _ = self.lookup
+
+    @property
+    def lookup(self) -> Optional[transform_lookup.TransformLookup]:
         """
-        Reverse the transformation direction.
+        Point lookup for the current transformation, rebuilt when the transformation changes.
         """
 
-        position_difference = np.array(new_position) - np.array(position)
-        new_position = np.array(new_position) - 2*position_difference
+        if self._node_transformation is None:
+            self._lookup = None
+        elif self._lookup is None or not self._lookup.is_current(self._node_transformation):
+            self._lookup = transform_lookup.TransformLookup(
+                self._node_transformation, self._node_reference)
+            self._submit_field_job(self._lookup)
 
-        return new_position
+        return self._lookup
+
+    def _submit_field_job(self, lookup: transform_lookup.TransformLookup) -> None:
+        """
+        Flattens, then inverts the field of the lookup on the worker. Until the field and its
+        inverse are ready, the lookup evaluates the transform with VTK.
+        """
+
+        if lookup.needs_flatten:
+            self._field_runner.submit(transform_analysis.flatten_job,
+                                      functools.partial(self._on_flattened, lookup),
+                                      lookup.pending_flatten)
+        elif lookup.needs_inverse:
+            self._field_runner.submit(transform_lookup.compute_inverse_job,
+                                      lookup.set_inverse,
+                                      lookup.field)
+        else:
+            self._field_runner.cancel()
+
+    def _on_flattened(self, lookup: transform_lookup.TransformLookup, field) -> None:
+        lookup.set_field(field)
+
+        if lookup is self._lookup:
+            self._submit_field_job(lookup)
+
+    def transform_position(self,
+                           position: List[float],
+                           reverse_transf_direction: bool) -> List[float]:
+        """
+        Maps the cursor position into the other space of the current transformation.
+
+        @param position: The cursor position in RAS.
+        @param reverse_transf_direction: False maps fixed -> moving, True maps moving -> fixed.
+        """
+
+        lookup = self.lookup
+        if lookup is None:
+            print("No transformation available")
+            return list(position)
+
+        if reverse_transf_direction:
+            return lookup.moving_to_fixed(position)
+
+        return lookup.fixed_to_moving(position)
 
     def place_crosshair_with_transformation(self,
                                             view_group: int,
-                                            crosshair_nodes: list[slicer.vtkMRMLMarkupsFiducialNode],
+                                            crosshair_markers: list[crosshair_renderer.SliceViewMarker],
                                             reverse_transf_direction: bool,
                                             offset_direction: Literal['pos',
                                                                       'neg', 'nan']
@@ -112,23 +193,13 @@ class Crosshairs():
         initial_position: list[float] = [0., 0., 0.]
         self.node_cursor.GetCursorPositionRAS(initial_position)
 
-        # now we set the position of our crosshair and then transform it to the new position
-        self.set_crosshair_nodes_to_position(crosshair_nodes,
-                                             initial_position)
-
-        # now transform the crosshair to the new position
+        # the position is looked up directly, the markers are only used for display
         if self.use_transform:
-            self.transform_crosshair_nodes(crosshair_nodes)
-
-        new_position: list[float] = [0., 0., 0.]
-        crosshair_nodes[0].GetNthControlPointPositionWorld(0,
-                                                           new_position)
-
-        if not reverse_transf_direction:
-            # the new_position should be moved in the opposite direction
-            # for some reason the displacement is applied in the opposite direction
-            new_position = self.reverse_transformation_direction(initial_position,
-                                                                 new_position)
+            with self.latency.measure("transform"):
+                new_position = self.transform_position(initial_position,
+                                                       reverse_transf_direction)
+        else:
+            new_position = list(initial_position)
 
         # Apply offset
         if not self.apply_offsets or offset_direction == 'nan':
@@ -145,125 +216,111 @@ class Crosshairs():
                         new_position[2] + offset[0]]
 
         # in plus views we should follow the transformed cursor (that's why group 2)
-        slicer.modules.markups.logic().JumpSlicesToLocation(new_position[0],
-                                                            new_position[1],
-                                                            new_position[2],
-                                                            False,
-                                                            view_group)
+        with self.latency.measure("jump"):
+            self.jump_slices_to_location(view_group, new_position)
 
-        self.set_crosshair_visibility()
+        with self.latency.measure("markers"):
+            self.set_crosshair_visibility()
 
-        self.set_crosshair_nodes_to_position(crosshair_nodes,
-                                             new_position)
+            self.set_crosshair_markers_to_position(crosshair_markers,
+                                                   new_position)
 
     def place_crosshair_without_transformation(self,
                                                view_group: int,
-                                               crosshair_nodes: list[slicer.vtkMRMLMarkupsFiducialNode],
+                                               crosshair_markers: list[crosshair_renderer.SliceViewMarker],
                                                ) -> None:
 
         initial_position: list[float] = [0., 0., 0.]
         self.node_cursor.GetCursorPositionRAS(initial_position)
 
         # in plus views we should follow the cursor (that's why group 2)
-        slicer.modules.markups.logic().JumpSlicesToLocation(initial_position[0],
-                                                            initial_position[1],
-                                                            initial_position[2],
-                                                            False,
-                                                            view_group)
+        with self.latency.measure("jump"):
+            self.jump_slices_to_location(view_group, initial_position)
 
-        self.set_crosshair_visibility()
+        with self.latency.measure("markers"):
+            self.set_crosshair_visibility()
 
-        self.set_crosshair_nodes_to_position(crosshair_nodes,
-                                             initial_position)
+            self.set_crosshair_markers_to_position(crosshair_markers,
+                                                   initial_position)
 
     def on_mouse_moved_place_crosshair(self, observer, eventid) -> None:  # pylint: disable=unused-argument
         """
         When the mouse moves in a view, the crosshair should follow the cursor.
-
+        The whole update is recorded as the "total" stage of self.latency, and every other
+        stage once per update, summed over the view groups.
         """
 
+        # the markers and slices of all nine views change, each slice node is modified and
+        # each view rendered once at the end
+        with self.latency.measure("total"), self.latency.update(), view_logic.batched_view_update(self.views):
+            self._place_crosshairs()
+
+        if self.cursor_view in self.views:
+            self.latency.expect_renders(view for view, marker in self.crosshair_markers.items()
+                                        if marker.slice_view.isVisible())
+
+    def _place_crosshairs(self) -> None:
         if self.cursor_view in self.views_1:
             self.place_crosshair_without_transformation(view_group=1,
-                                                        crosshair_nodes=self.crosshairs_1)
+                                                        crosshair_markers=self.crosshairs_1)
             self.place_crosshair_with_transformation(view_group=2,
-                                                     crosshair_nodes=self.crosshairs_2,
+                                                     crosshair_markers=self.crosshairs_2,
                                                      reverse_transf_direction=self.reverse_transf_direction,
                                                      offset_direction='neg')
             self.place_crosshair_without_transformation(view_group=3,
-                                                        crosshair_nodes=self.crosshairs_3)
+                                                        crosshair_markers=self.crosshairs_3)
 
         elif self.cursor_view in self.views_2:
             self.place_crosshair_with_transformation(view_group=1,
-                                                     crosshair_nodes=self.crosshairs_1,
+                                                     crosshair_markers=self.crosshairs_1,
                                                      reverse_transf_direction=not self.reverse_transf_direction,
                                                      offset_direction='pos')
             self.place_crosshair_without_transformation(view_group=2,
-                                                        crosshair_nodes=self.crosshairs_2)
+                                                        crosshair_markers=self.crosshairs_2)
             self.place_crosshair_with_transformation(view_group=3,
-                                                     crosshair_nodes=self.crosshairs_3,
+                                                     crosshair_markers=self.crosshairs_3,
                                                      reverse_transf_direction=not self.reverse_transf_direction,
                                                      offset_direction='pos')
 
         elif self.cursor_view in self.views_3:
             self.place_crosshair_without_transformation(view_group=1,
-                                                        crosshair_nodes=self.crosshairs_1)
+                                                        crosshair_markers=self.crosshairs_1)
             self.place_crosshair_with_transformation(view_group=2,
-                                                     crosshair_nodes=self.crosshairs_2,
+                                                     crosshair_markers=self.crosshairs_2,
                                                      reverse_transf_direction=self.reverse_transf_direction,
                                                      offset_direction='neg')
             self.place_crosshair_without_transformation(view_group=3,
-                                                        crosshair_nodes=self.crosshairs_3)
+                                                        crosshair_markers=self.crosshairs_3)
 
-    def transform_crosshair_nodes(self, crosshair_nodes: list[slicer.vtkMRMLMarkupsFiducialNode]) -> None:
-        """
-        Transform every crosshair from the list of nodes with the current transformation.
-        """
-
-        for node in crosshair_nodes:
-            if self.node_transformation:
-                node.ApplyTransform(
-                    self.node_transformation.GetTransformToParent())
-            else:
-                print("No transformation available")
-
-    @ staticmethod
-    def set_crosshair_nodes_to_position(crosshair_nodes: list[slicer.vtkMRMLMarkupsFiducialNode],
-                                        position: list[float]) -> None:
+    @staticmethod
+    def set_crosshair_markers_to_position(crosshair_markers: list[crosshair_renderer.SliceViewMarker],
+                                          position: list[float]) -> None:
         """
-        Set every crosshair from the list of nodes to the given position.
+        Set every crosshair from the list of markers to the given position.
         """
 
-        for node in crosshair_nodes:
-            node.SetNthControlPointPositionWorld(
-                0, position[0], position[1], position[2])
+        for marker in crosshair_markers:
+            marker.set_position(position)
 
     def set_crosshair_visibility(self) -> None:
         """
         Turns off the crosshair in the current view
         """
 
-        for _, node in self.crosshair_nodes.items():
-            display_node = node.GetDisplayNode()
-            if display_node is not None:
-                display_node.SetVisibility(True)
-
-        if self.cursor_view in self.crosshair_nodes:
-            display_node = self.crosshair_nodes[self.cursor_view].GetDisplayNode(
-            )
-            if display_node is not None:
-                display_node.SetVisibility(False)
+        for view, marker in self.crosshair_markers.items():
+            marker.set_visible(view != self.cursor_view)
 
     @property
-    def crosshairs_1(self) -> list[slicer.vtkMRMLMarkupsFiducialNode]:
+    def crosshairs_1(self) -> list[crosshair_renderer.SliceViewMarker]:
 
-        return [self.crosshair_nodes[view] for view in self.views_1]
+        return [self.crosshair_markers[view] for view in self.views_1]
 
     @property
-    def crosshairs_2(self) -> list[slicer.vtkMRMLMarkupsFiducialNode]:
+    def crosshairs_2(self) -> list[crosshair_renderer.SliceViewMarker]:
 
-        return [self.crosshair_nodes[view] for view in self.views_2]
+        return [self.crosshair_markers[view] for view in self.views_2]
 
     @property
-    def crosshairs_3(self) -> list[slicer.vtkMRMLMarkupsFiducialNode]:
+    def crosshairs_3(self) -> list[crosshair_renderer.SliceViewMarker]:
 
-        return [self.crosshair_nodes[view] for view in self.views_3]
+        return [self.crosshair_markers[view] for view in self.views_3]
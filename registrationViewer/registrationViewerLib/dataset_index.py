@@ -0,0 +1,167 @@
+"""
+On-disk index of the original-data directory.
+
+The originals are stored as <data directory>/<subdirectory>/<case name>.nii.gz. Instead of
+globbing the tree for every case, the index maps case names to their paths and is kept
+in a JSON file. On refresh only subdirectories whose mtime changed are listed again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, List
+
+# bump when the layout of the index file changes
+INDEX_VERSION = 1
+
+IMAGE_EXTENSION = ".nii.gz"
+
+
+def is_segmentation_path(path: str) -> bool:
+    """
+    Returns True for masks, segmentations and label maps, by their path.
+    """
+
+    return any(x in path.lower() for x in ['mask', 'seg', 'label'])
+
+
+def default_index_path(data_path: str, cache_directory: str) -> str:
+    """
+    Index file of a data directory inside the cache directory, one file per data directory.
+    """
+
+    digest = hashlib.sha1(os.path.realpath(data_path).encode()).hexdigest()[:16]
+
+    return os.path.join(cache_directory, f"dataset_index_{digest}.json")
+
+
+class DatasetIndex:
+    """
+    Case name -> image paths of a data directory, persisted as JSON.
+    """
+
+    def __init__(self, data_path: str, index_path: str) -> None:
+        self.data_path = data_path
+        self.index_path = index_path
+
+        # subdirectory -> {"mtime": ..., "files": [...]}
+        self._directories: Dict[str, Dict] = {}
+        self._cases: Dict[str, List[str]] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.rescanned_directories = 0
+
+        self._read()
+
+    def find(self, case_name: str) -> List[str]:
+        """
+        Paths of all <subdirectory>/<case_name>.nii.gz files, like
+        glob(data_path + "/*/<case_name>.nii.gz") at the time of the last refresh.
+        """
+
+        paths = self._cases.get(case_name)
+        if paths is None:
+            self.misses += 1
+            return []
+
+        self.hits += 1
+        return list(paths)
+
+    def refresh(self) -> None:
+        """
+        Lists again the subdirectories that were added or modified since the last refresh and
+        drops the removed ones. Writes the index file if anything changed.
+        """
+
+        changed = False
+        seen = set()
+
+        with os.scandir(self.data_path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_dir():
+                    continue
+
+                seen.add(entry.name)
+                mtime = entry.stat().st_mtime
+
+                known = self._directories.get(entry.name)
+                if known is not None and known["mtime"] == mtime:
+                    continue
+
+                self._directories[entry.name] = {"mtime": mtime,
+                                                 "files": self._list_images(entry.path)}
+                self.rescanned_directories += 1
+                changed = True
+
+        for name in set(self._directories) - seen:
+            del self._directories[name]
+            changed = True
+
+        if changed:
+            self._build_cases()
+            self._write()
+
+    def rebuild(self) -> None:
+        """
+        Forgets the index and lists every subdirectory again.
+        """
+
+        self._directories = {}
+        self._cases = {}
+        self.reset_statistics()
+        self.refresh()
+
+    def reset_statistics(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.rescanned_directories = 0
+
+    @property
+    def statistics(self) -> str:
+        return (f"{len(self._cases)} cases in {len(self._directories)} folders, "
+                f"{self.hits} hits, {self.misses} misses, "
+                f"{self.rescanned_directories} folders rescanned")
+
+    @staticmethod
+    def _list_images(directory: str) -> List[str]:
+        return sorted(name for name in os.listdir(directory)
+                      if name.endswith(IMAGE_EXTENSION) and not name.startswith('.'))
+
+    def _build_cases(self) -> None:
+        self._cases = {}
+        for directory in sorted(self._directories):
+            for file_name in self._directories[directory]["files"]:
+                case_name = file_name[:-len(IMAGE_EXTENSION)]
+                self._cases.setdefault(case_name, []).append(
+                    os.path.join(self.data_path, directory, file_name))
+
+    def _read(self) -> None:
+        if not os.path.exists(self.index_path):
+            return
+
+        try:
+            with open(self.index_path, "r") as index_file:
+                content = json.load(index_file)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable dataset index {self.index_path}: {str(e)}")
+            return
+
+        if content.get("version") != INDEX_VERSION or content.get("data_path") != self.data_path:
+            return
+
+        self._directories = content["directories"]
+        self._build_cases()
+
+    def _write(self) -> None:
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+
+        # write next to the index and rename, so a crash never leaves a truncated index
+        temporary_path = self.index_path + ".tmp"
+        with open(temporary_path, "w") as index_file:
+            json.dump({"version": INDEX_VERSION,
+                       "data_path": self.data_path,
+                       "directories": self._directories}, index_file)
+
+        os.replace(temporary_path, self.index_path)
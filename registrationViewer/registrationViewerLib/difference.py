@@ -0,0 +1,119 @@
+"""
+Difference between the fixed and the warped image, computed tile by tile.
+"""
+
+from typing import Callable, Optional
+
+import numpy as np
+
+from registrationViewerLib import warping
+
+# bytes of output written per tile, bounds the work between two progress reports
+DEFAULT_TILE_BYTES = 64 * 1024 ** 2
+
+
+def difference_dtype(dtype_fixed, dtype_warped) -> np.dtype:
+    """
+    Returns the smallest dtype that holds fixed - warped without wrapping around.
+
+    @param dtype_fixed: The dtype of the fixed image.
+    @param dtype_warped: The dtype of the warped image.
+    """
+
+    dtype_fixed = np.dtype(dtype_fixed)
+    dtype_warped = np.dtype(dtype_warped)
+
+    if dtype_fixed.kind == 'f' or dtype_warped.kind == 'f':
+        return np.result_type(dtype_fixed, dtype_warped, np.float32)
+
+    lowest = int(np.iinfo(dtype_fixed).min) - int(np.iinfo(dtype_warped).max)
+    highest = int(np.iinfo(dtype_fixed).max) - int(np.iinfo(dtype_warped).min)
+
+    for candidate in (np.int8, np.int16, np.int32, np.int64):
+        limits = np.iinfo(candidate)
+        if limits.min <= lowest and highest <= limits.max:
+            return np.dtype(candidate)
+
+    return np.dtype(np.float64)
+
+
+def subtract_tiled(array_fixed: np.ndarray,
+                   array_warped: np.ndarray,
+                   out: np.ndarray,
+                   max_tile_bytes: int = DEFAULT_TILE_BYTES,
+                   progress_callback: Optional[Callable[[float], None]] = None) -> np.ndarray:
+    """
+    Writes fixed - warped into `out`, one z-slab at a time.
+
+    Every slab is subtracted in a dtype that cannot overflow for the two inputs, so
+    int16 CT data does not wrap around. The ufunc casts the inputs through its own
+    fixed-size buffers (np.getbufsize() elements), so no promoted temporaries are
+    created at all and the slab size only sets how often progress is reported and
+    cancellation is checked.
+
+    @param array_fixed: The fixed image, indexed [k, j, i].
+    @param array_warped: The warped moving image on the same grid.
+    @param out: Preallocated output on the same grid, e.g. the array of the difference node.
+    @param max_tile_bytes: Bytes of output written per slab.
+    @param progress_callback: Called with the finished fraction after every slab.
+    """
+
+    assert array_fixed.shape == array_warped.shape == out.shape, "Arrays must share the grid"
+
+    accumulator = difference_dtype(array_fixed.dtype, array_warped.dtype)
+
+    slice_bytes = out.itemsize * out.shape[1] * out.shape[2]
+    slab = max(1, max_tile_bytes // max(1, slice_bytes))
+
+    for k_start in range(0, out.shape[0], slab):
+        k_stop = min(out.shape[0], k_start + slab)
+
+        np.subtract(array_fixed[k_start:k_stop],
+                    array_warped[k_start:k_stop],
+                    out=out[k_start:k_stop],
+                    dtype=accumulator,
+                    casting='unsafe')
+
+        if progress_callback is not None:
+            progress_callback(k_stop / out.shape[0])
+
+    return out
+
+
+def warp_and_subtract(array_fixed: np.ndarray,
+                      fixed_ijk_to_ras: np.ndarray,
+                      array_moving: np.ndarray,
+                      moving_ras_to_ijk: np.ndarray,
+                      mapping,
+                      out_warped: np.ndarray,
+                      out_diff: np.ndarray,
+                      max_tile_bytes: int = DEFAULT_TILE_BYTES,
+                      progress_callback: Optional[Callable[[float], None]] = None) -> None:
+    """
+    Warps the moving image onto the fixed grid and subtracts it from the fixed image,
+    writing both results in place.
+
+    @param out_warped: Preallocated warped image on the fixed grid.
+    @param out_diff: Preallocated difference on the fixed grid, see difference_dtype().
+    """
+
+    def warp_progress(fraction: float) -> None:
+        if progress_callback is not None:
+            progress_callback(0.9 * fraction)
+
+    def subtract_progress(fraction: float) -> None:
+        if progress_callback is not None:
+            progress_callback(0.9 + 0.1 * fraction)
+
+    warping.warp_volume(array_moving,
+                        moving_ras_to_ijk,
+                        mapping,
+                        fixed_ijk_to_ras,
+                        out_warped,
+                        progress_callback=warp_progress)
+
+    subtract_tiled(array_fixed,
+                   out_warped,
+                   out_diff,
+                   max_tile_bytes=max_tile_bytes,
+                   progress_callback=subtract_progress)
@@ -0,0 +1,83 @@
+from typing import Callable
+
+import qt
+
+# about one display frame at 60 Hz
+DEFAULT_FRAME_INTERVAL_MS = 16
+
+
+class CursorEventCoalescer:
+    """
+    Sits between the crosshair node observer and the crosshair placement.
+
+    Only the latest cursor event matters, so events arriving faster than the display
+    refreshes are merged: the first event is processed right away, further events within
+    the same frame only mark that work is pending, and the pending work is processed
+    once by a single-shot timer at the end of the frame.
+    """
+
+    def __init__(self,
+                 callback: Callable[[], None],
+                 frame_interval_ms: int = DEFAULT_FRAME_INTERVAL_MS) -> None:
+        """
+        @param callback: Processes the current cursor position, called on the main thread.
+        @param frame_interval_ms: Minimum time between two calls of the callback.
+        """
+
+        self._callback = callback
+        self._pending = False
+
+        self.received_events = 0
+        self.processed_events = 0
+
+        self._timer = qt.QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(frame_interval_ms)
+        self._timer.connect('timeout()', self._on_frame)
+
+    @property
+    def dropped_events(self) -> int:
+        """
+        Number of events that were merged into a later one.
+        """
+
+        return self.received_events - self.processed_events - int(self._pending)
+
+    def on_event(self, caller=None, event=None) -> None:  # pylint: disable=unused-argument
+        """
+        Observer for CursorPositionModifiedEvent.
+        """
+
+        self.received_events += 1
+
+        if self._timer.isActive():
+            self._pending = True
+            return
+
+        self._process()
+
+    def stop(self) -> None:
+        """
+        Drops any pending event.
+        """
+
+        self._timer.stop()
+        self._pending = False
+
+    def reset_counters(self) -> None:
+        self.received_events = 0
+        self.processed_events = 0
+
+    def _on_frame(self) -> None:
+        if self._pending:
+            self._process()
+
+    def _process(self) -> None:
+        self._pending = False
+        self.processed_events += 1
+
+        try:
+            self._callback()
+        finally:
+            # leave the rest of the frame to rendering, later events are merged meanwhile
+            self._timer.start()
@@ -0,0 +1,135 @@
+"""
+Watching a dropped result folder for registration groups written while it is viewed.
+
+The deformations/ and deformed/ subdirectories are polled: listing two directories is
+cheap and, unlike file system notifications, works on network shares. A change is only
+reported once the listing stayed the same for a whole poll interval, so files that are
+still being written are not read half-way.
+
+Every group remembers the signatures of the files it was loaded from, so loading the
+folder again only loads groups that are new or whose files changed.
+"""
+
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import qt
+
+from registrationViewerLib import loaded_originals
+
+# default time between two listings of the watched folder
+DEFAULT_INTERVAL_SECONDS = 5
+
+WATCHED_SUBDIRECTORIES = ("deformations", "deformed")
+
+
+def group_signature(paths: List[str]) -> Tuple:
+    """
+    Signatures of the files of a group, see loaded_originals.file_signature().
+    """
+
+    return tuple(loaded_originals.file_signature(path) for path in paths)
+
+
+def folder_snapshot(folder: str) -> Dict[str, Tuple[int, int]]:
+    """
+    (size, mtime) of the images in the watched subdirectories of a result folder.
+    """
+
+    snapshot = {}
+    for subdirectory in WATCHED_SUBDIRECTORIES:
+        path = os.path.join(folder, subdirectory)
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.nii.gz') and entry.is_file():
+                        stat = entry.stat()
+                        snapshot[os.path.join(subdirectory, entry.name)] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            continue
+
+    return snapshot
+
+
+class LoadedGroup:
+    """
+    The files a group was loaded from and the nodes created for it.
+
+    Placeholder groups keep their nodes in their LazyGroup, eagerly loaded groups here.
+    """
+
+    def __init__(self, signature: Tuple, lazy_group=None) -> None:
+        self.signature = signature
+        self.lazy_group = lazy_group
+
+        self.node_transform: Optional[Any] = None
+        self.nodes: List[Any] = []
+
+    def set_transform(self, node) -> None:
+        self.node_transform = node
+
+    @property
+    def transform(self) -> Optional[Any]:
+        if self.lazy_group is not None:
+            return self.lazy_group.node_transform
+        return self.node_transform
+
+    @property
+    def removed(self) -> bool:
+        """
+        True if the transform node was deleted from the scene since it was loaded.
+        """
+
+        node = self.transform
+        return node is not None and node.GetScene() is None
+
+
+class FolderWatcher:
+    """
+    Polls a folder on the main thread and calls on_settled(folder) after its content changed.
+    """
+
+    def __init__(self,
+                 on_settled: Callable[[str], None],
+                 interval_seconds: float = DEFAULT_INTERVAL_SECONDS) -> None:
+        self.folder: Optional[str] = None
+
+        self._on_settled = on_settled
+        self._snapshot: Dict[str, Tuple[int, int]] = {}
+        self._changed = False
+
+        self._timer = qt.QTimer()
+        self._timer.setInterval(int(interval_seconds * 1000))
+        self._timer.connect('timeout()', self._poll)
+
+    @property
+    def watching(self) -> bool:
+        return self._timer.isActive()
+
+    def start(self, folder: str) -> None:
+        """
+        Watches the folder, whose current content counts as loaded.
+        """
+
+        self.folder = folder
+        self._snapshot = folder_snapshot(folder)
+        self._changed = False
+        self._timer.start()
+
+        logging.info(f"Watching {folder} for new registration results")
+
+    def stop(self) -> None:
+        self._timer.stop()
+
+    def _poll(self) -> None:
+        snapshot = folder_snapshot(self.folder)
+
+        if snapshot != self._snapshot:
+            self._snapshot = snapshot
+            self._changed = True
+            return
+
+        if self._changed:
+            self._changed = False
+            self._on_settled(self.folder)
@@ -0,0 +1,48 @@
+"""
+Reading of image files with SimpleITK into NumPy arrays in Slicer's conventions.
+
+Nothing here needs MRML or Qt, so it runs on worker threads and without Slicer.
+"""
+
+from typing import Tuple
+
+import numpy as np
+import SimpleITK as sitk
+
+# ITK images and displacements are in LPS, Slicer works in RAS
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def read_image(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reads a 3D image.
+
+    @return: The voxels indexed [k, j, i] (or [k, j, i, component]) and the IJK to RAS matrix.
+    """
+
+    image = sitk.ReadImage(path)
+    assert image.GetDimension() == 3, f"Only 3D images are supported: {path}"
+
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+
+    ijk_to_lps = np.eye(4)
+    ijk_to_lps[:3, :3] = direction @ np.diag(image.GetSpacing())
+    ijk_to_lps[:3, 3] = image.GetOrigin()
+
+    return sitk.GetArrayFromImage(image), LPS_TO_RAS @ ijk_to_lps
+
+
+def read_displacement_field(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reads an ITK displacement field, with the displacement vectors converted to RAS.
+
+    @return: The displacements indexed [k, j, i, 3] and the IJK to RAS matrix of the grid.
+    """
+
+    array, ijk_to_ras = read_image(path)
+    assert array.ndim == 4 and array.shape[3] == 3, f"Not a 3D displacement field: {path}"
+
+    # the displacement vectors are LPS as well
+    array[..., :2] *= -1
+
+    return array, ijk_to_ras
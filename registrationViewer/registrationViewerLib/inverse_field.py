@@ -0,0 +1,72 @@
+"""
+Inversion of displacement fields by fixed-point iteration.
+
+For a field u mapping fixed points x to moving points x + u(x), the inverse field v
+maps moving points y back with y + v(y). It satisfies v(y) = -u(y + v(y)), which is
+iterated on every grid point at once.
+"""
+
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from registrationViewerLib import warping
+
+DEFAULT_ITERATIONS = 20
+
+# stop iterating once no displacement changes by more than this (mm)
+DEFAULT_TOLERANCE = 1e-3
+
+
+def invert_displacement_field(field: warping.DisplacementField,
+                              iterations: int = DEFAULT_ITERATIONS,
+                              tolerance: float = DEFAULT_TOLERANCE,
+                              chunk_voxels: int = warping.DEFAULT_CHUNK_VOXELS,
+                              progress_callback: Optional[Callable[[float], None]] = None
+                              ) -> Tuple[warping.DisplacementField, float, float]:
+    """
+    Computes the inverse of a displacement field on the grid of the field.
+
+    @param field: The field to invert.
+    @param iterations: Maximum number of fixed-point iterations per slab.
+    @param tolerance: Convergence threshold on the update of the displacements (mm).
+    @param chunk_voxels: Approximate number of grid points processed at once.
+    @param progress_callback: Called with the finished fraction after every slab.
+    @return: The inverse field and the maximum and mean inverse-consistency residual
+             |v(y) + u(y + v(y))| in mm.
+    """
+
+    shape = field.array.shape[:3]
+    inverse = np.empty(shape + (3,), dtype=np.float32)
+
+    slab = max(1, chunk_voxels // max(1, shape[1] * shape[2]))
+    residual_max = 0.0
+    residual_sum = 0.0
+
+    for k_start in range(0, shape[0], slab):
+        k_stop = min(shape[0], k_start + slab)
+
+        points = warping.voxel_grid_ras(field.ijk_to_ras, shape, k_start, k_stop)
+
+        displacement = -field.displacements_at(points)
+        for _ in range(iterations):
+            updated = -field.displacements_at(points + displacement)
+            change = np.abs(updated - displacement).max()
+            displacement = updated
+
+            if change < tolerance:
+                break
+
+        residual = np.linalg.norm(displacement + field.displacements_at(points + displacement),
+                                  axis=1)
+        residual_max = max(residual_max, float(residual.max()))
+        residual_sum += float(residual.sum())
+
+        inverse[k_start:k_stop] = displacement.reshape(k_stop - k_start, shape[1], shape[2], 3)
+
+        if progress_callback is not None:
+            progress_callback(k_stop / shape[0])
+
+    residual_mean = residual_sum / max(1, int(np.prod(shape)))
+
+    return warping.DisplacementField(inverse, field.ijk_to_ras), residual_max, residual_mean
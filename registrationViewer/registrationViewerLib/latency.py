@@ -0,0 +1,236 @@
+"""
+Timing of the crosshair update and its stages, with an on-screen summary.
+"""
+
+import contextlib
+import csv
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import ctk
+import numpy as np
+import qt
+
+# number of samples kept per stage
+DEFAULT_WINDOW = 2000
+
+# upper bin edges of the on-screen histogram (ms)
+HISTOGRAM_EDGES_MS = [1, 2, 4, 8, 16, 33, 66, np.inf]
+
+
+class LatencyRecorder:
+    """
+    Rolling per-stage latency samples, e.g. for the stages of a crosshair update.
+    """
+
+    def __init__(self, window: int = DEFAULT_WINDOW) -> None:
+        self.window = window
+        self.samples: Dict[str, Deque[float]] = {}
+
+        # stage times summed over the open update, see update()
+        self._update_samples: Optional[Dict[str, float]] = None
+        # views whose next render is caused by an update
+        self._expected_renders: Set[str] = set()
+
+    @contextlib.contextmanager
+    def update(self) -> Iterator[None]:
+        """
+        Context manager grouping the measurements of one update. A stage measured several
+        times in its body, e.g. once per view group, is recorded once with the summed time.
+        Renders still expected from the previous update are no longer attributed to it.
+        """
+
+        if self._update_samples is not None:
+            yield
+            return
+
+        self._expected_renders.clear()
+        self._update_samples = {}
+        try:
+            yield
+        finally:
+            update_samples, self._update_samples = self._update_samples, None
+            for stage, milliseconds in update_samples.items():
+                self.record(stage, milliseconds)
+
+    def expect_renders(self, views: Iterable[str]) -> None:
+        """
+        Marks the next render of the views as caused by the update, see observe_render_window().
+        Only pass views that are shown, hidden views do not render.
+        """
+
+        self._expected_renders.update(views)
+
+    def take_expected_render(self, view: str) -> bool:
+        """
+        Returns True if the render of the view that starts now was caused by an update.
+        """
+
+        if view not in self._expected_renders:
+            return False
+
+        self._expected_renders.discard(view)
+        return True
+
+    @contextlib.contextmanager
+    def measure(self, stage: str) -> Iterator[None]:
+        """
+        Context manager recording the time spent in its body under the given stage.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, 1000 * (time.perf_counter() - start))
+
+    def record(self, stage: str, milliseconds: float) -> None:
+        if self._update_samples is not None:
+            self._update_samples[stage] = self._update_samples.get(stage, 0.0) + milliseconds
+            return
+
+        if stage not in self.samples:
+            self.samples[stage] = deque(maxlen=self.window)
+
+        self.samples[stage].append(milliseconds)
+
+    def reset(self) -> None:
+        self.samples.clear()
+        self._expected_renders.clear()
+
+    def summary(self) -> List[Tuple[str, int, float, float, float]]:
+        """
+        Returns (stage, number of samples, p50, p95, p99) for every stage, in ms.
+        """
+
+        rows = []
+        for stage, samples in self.samples.items():
+            if not samples:
+                continue
+
+            p50, p95, p99 = np.percentile(np.fromiter(samples, dtype=np.float64), [50, 95, 99])
+            rows.append((stage, len(samples), float(p50), float(p95), float(p99)))
+
+        return rows
+
+    def histogram(self, stage: str) -> List[int]:
+        """
+        Returns the number of samples of the stage per bin of HISTOGRAM_EDGES_MS.
+        """
+
+        samples = np.fromiter(self.samples.get(stage, ()), dtype=np.float64)
+        bins = np.searchsorted(HISTOGRAM_EDGES_MS, samples, side='left')
+
+        return np.bincount(bins, minlength=len(HISTOGRAM_EDGES_MS)).tolist()
+
+    def format_report(self, histogram_stage: str = "total", bar_width: int = 30) -> str:
+        """
+        Plain text table of the percentiles and a histogram of one stage.
+        """
+
+        lines = [f"{'stage':<12}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}   (ms)"]
+        for stage, count, p50, p95, p99 in self.summary():
+            lines.append(f"{stage:<12}{count:>6}{p50:>9.2f}{p95:>9.2f}{p99:>9.2f}")
+
+        counts = self.histogram(histogram_stage)
+        if sum(counts):
+            lines.append("")
+            lines.append(f"{histogram_stage} histogram")
+
+            lower = 0
+            for edge, count in zip(HISTOGRAM_EDGES_MS, counts):
+                label = f"{lower}-{edge:g}" if np.isfinite(edge) else f">{lower}"
+                bar = "#" * int(round(bar_width * count / max(counts)))
+                lines.append(f"{label:>8} ms {count:>6} {bar}")
+                lower = edge
+
+        return "\n".join(lines)
+
+    def to_csv(self, path: str) -> None:
+        """
+        Writes every recorded sample as a (stage, sample, latency_ms) row.
+        """
+
+        with open(path, "w", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(["stage", "sample", "latency_ms"])
+
+            for stage, samples in self.samples.items():
+                for index, milliseconds in enumerate(samples):
+                    writer.writerow([stage, index, f"{milliseconds:.4f}"])
+
+
+def observe_render_window(recorder: LatencyRecorder,
+                          render_window,
+                          view: str,
+                          stage: str = "render") -> List[int]:
+    """
+    Records the duration of the renders of the window under the given stage, only those
+    the recorder expects (LatencyRecorder.expect_renders), not e.g. renders for panning.
+
+    @param view: The name of the view of the window.
+    @return: The observer tags, to be removed with RemoveObserver.
+    """
+
+    started = [0.0]
+
+    def on_start(caller, event):  # pylint: disable=unused-argument
+        if recorder.take_expected_render(view):
+            started[0] = time.perf_counter()
+
+    def on_end(caller, event):  # pylint: disable=unused-argument
+        if started[0]:
+            recorder.record(stage, 1000 * (time.perf_counter() - started[0]))
+            started[0] = 0.0
+
+    return [render_window.AddObserver("StartEvent", on_start),
+            render_window.AddObserver("EndEvent", on_end)]
+
+
+def create_latency_ui(self) -> None:
+    """
+    Adds a collapsible panel showing the crosshair latency of self.latency_recorder.
+    """
+
+    latencyCollapsible = ctk.ctkCollapsibleButton()
+    latencyCollapsible.text = "Crosshair latency"
+    latencyCollapsible.collapsed = True
+    self.layout.addWidget(latencyCollapsible)
+
+    collapsibleLayout = qt.QVBoxLayout(latencyCollapsible)
+
+    self.latencyLabel = qt.QLabel()
+    self.latencyLabel.setFont(qt.QFontDatabase.systemFont(qt.QFontDatabase.FixedFont))
+    self.latencyLabel.setTextInteractionFlags(qt.Qt.TextSelectableByMouse)
+    collapsibleLayout.addWidget(self.latencyLabel)
+
+    buttonsLayout = qt.QHBoxLayout()
+    exportButton = qt.QPushButton("Export CSV")
+    resetButton = qt.QPushButton("Reset")
+    buttonsLayout.addWidget(exportButton)
+    buttonsLayout.addWidget(resetButton)
+    buttonsLayout.addStretch()
+    collapsibleLayout.addLayout(buttonsLayout)
+
+    def update_report():
+        if not latencyCollapsible.collapsed:
+            self.latencyLabel.setText(self.latency_recorder.format_report())
+
+    def export_csv():
+        path = qt.QFileDialog.getSaveFileName(None, "Export crosshair latency", "latency.csv",
+                                              "CSV files (*.csv)")
+        if path:
+            self.latency_recorder.to_csv(path)
+
+    def reset():
+        self.latency_recorder.reset()
+        update_report()
+
+    exportButton.connect("clicked(bool)", export_csv)
+    resetButton.connect("clicked(bool)", reset)
+
+    self.latencyTimer = qt.QTimer()
+    self.latencyTimer.setInterval(1000)
+    self.latencyTimer.connect("timeout()", update_report)
+    self.latencyTimer.start()
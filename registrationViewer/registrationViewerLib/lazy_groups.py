@@ -0,0 +1,268 @@
+"""
+Placeholders for the registration groups of a dropped folder.
+
+Every group gets an empty grid transform node right away. Its data (displacement field,
+deformed volume and segmentation) is only read once the transform is selected, and the
+data of groups that are not selected is dropped again when the loaded groups exceed the
+memory budget. The budget includes the original fixed and moving data loaded for the
+groups; originals shared by several groups count once and stay until the last of them
+is evicted.
+"""
+
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+import slicer
+
+from registrationViewerLib import loaded_originals, parallel_loading
+
+# default memory budget for the data of materialised groups
+DEFAULT_BUDGET_BYTES = 4 * 1024 ** 3
+
+# set to "1" on transform nodes whose field is not loaded
+PLACEHOLDER_ATTRIBUTE = "registrationViewer.Placeholder"
+SOURCE_PATH_ATTRIBUTE = "registrationViewer.SourcePath"
+
+
+def is_placeholder(node) -> bool:
+    """
+    Returns True if the node is a group transform whose field is not loaded (yet).
+    """
+
+    return node is not None and node.GetAttribute(PLACEHOLDER_ATTRIBUTE) == "1"
+
+
+class LazyGroup:
+    """
+    One registration result: its transform node and the files loaded with it.
+    """
+
+    def __init__(self,
+                 group: int,
+                 node_transform: slicer.vtkMRMLGridTransformNode,
+                 transform_path: str,
+                 data_paths: List[Tuple[str, parallel_loading.LoadKind]],
+                 volume_name: str) -> None:
+        self.group = group
+        self.node_transform = node_transform
+        self.transform_path = transform_path
+        self.data_paths = data_paths
+        self.volume_name = volume_name
+
+        # nodes loaded with the group besides the transform, and the size of all its data
+        self.nodes = []
+        self.nbytes = 0
+
+        self.loading = False
+        self.last_used = 0
+
+        # counts the resets of the files, results of loads started before a reset are dropped
+        self.generation = 0
+
+    @property
+    def loaded(self) -> bool:
+        return not is_placeholder(self.node_transform)
+
+
+class LazyGroupRegistry:
+    """
+    Keeps the placeholders of all registered groups and evicts the data of the least
+    recently selected ones when the budget is exceeded.
+    """
+
+    def __init__(self,
+                 max_bytes: int = DEFAULT_BUDGET_BYTES,
+                 originals: Optional[loaded_originals.LoadedOriginals] = None) -> None:
+        """
+        @param originals: Where the originals of the groups are loaded, with the groups as users.
+        """
+
+        self.max_bytes = max_bytes
+        self.originals = originals
+
+        self._groups: Dict[str, LazyGroup] = {}
+        self._clock = 0
+
+        self.evictions = 0
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Size of the data of the groups and of the originals only they use.
+        """
+
+        originals_bytes = self.originals.nbytes if self.originals is not None else 0
+
+        return sum(lazy_group.nbytes for lazy_group in self._groups.values()) + originals_bytes
+
+    def add(self,
+            group: int,
+            transform_path: str,
+            data_paths: List[Tuple[str, parallel_loading.LoadKind]],
+            volume_name: str) -> LazyGroup:
+        """
+        Creates the placeholder transform node of a group. Nothing is read from disk.
+        """
+
+        node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLGridTransformNode",
+                                                  parallel_loading.node_name_from_path(transform_path))
+        node.SetAttribute(PLACEHOLDER_ATTRIBUTE, "1")
+        node.SetAttribute(SOURCE_PATH_ATTRIBUTE, transform_path)
+
+        lazy_group = LazyGroup(group, node, transform_path, data_paths, volume_name)
+        self._groups[node.GetID()] = lazy_group
+
+        return lazy_group
+
+    def find(self, node) -> Optional[LazyGroup]:
+        if node is None:
+            return None
+
+        return self._groups.get(node.GetID())
+
+    def clear(self) -> None:
+        self._groups = {}
+
+    def reset(self,
+              lazy_group: LazyGroup,
+              data_paths: List[Tuple[str, parallel_loading.LoadKind]]) -> None:
+        """
+        Drops the data of a group whose files changed, it is read again on the next selection.
+        A load in flight reads the old files, its results are dropped as they arrive and the
+        group is loaded again, see materialise_tasks().
+        """
+
+        lazy_group.generation += 1
+
+        if lazy_group.loaded and not lazy_group.loading:
+            self._evict(lazy_group)
+
+        lazy_group.data_paths = data_paths
+
+    def remove(self, lazy_group: LazyGroup) -> None:
+        """
+        Removes the group with its transform and data nodes from the scene.
+        """
+
+        for node in lazy_group.nodes + [lazy_group.node_transform] + self._release_originals(lazy_group):
+            if node.GetScene() is not None:
+                slicer.mrmlScene.RemoveNode(node)
+
+        self._groups = {node_id: other for node_id, other in self._groups.items() if other is not lazy_group}
+
+    def materialise_tasks(self,
+                          lazy_group: LazyGroup,
+                          on_ready: Callable[[LazyGroup], None],
+                          on_stale: Callable[[LazyGroup], None]) -> List[parallel_loading.LoadTask]:
+        """
+        Marks the group as used and returns the tasks that load its data, or nothing if it
+        is loaded or loading already.
+
+        @param on_ready: Called once the displacement field is in the transform node.
+        @param on_stale: Called instead of on_ready if the files were reset while loading.
+                         The group is a placeholder again and can be materialised anew.
+        """
+
+        self._clock += 1
+        lazy_group.last_used = self._clock
+
+        if lazy_group.loaded or lazy_group.loading:
+            return []
+
+        lazy_group.loading = True
+        generation = lazy_group.generation
+
+        def transform_loaded(task: parallel_loading.LoadTask, node) -> None:
+            lazy_group.loading = False
+
+            if generation != lazy_group.generation:
+                logging.info(f"Registration group {lazy_group.group} changed while loading, loading it again")
+                self._drop_data(lazy_group)
+                on_stale(lazy_group)
+                return
+
+            node.SetAttribute(PLACEHOLDER_ATTRIBUTE, "0")
+            lazy_group.nbytes += task.nbytes
+            on_ready(lazy_group)
+
+        def data_loaded(task: parallel_loading.LoadTask, node) -> None:
+            if generation != lazy_group.generation:
+                slicer.mrmlScene.RemoveNode(node)
+                return
+
+            lazy_group.nodes.append(node)
+            lazy_group.nbytes += task.nbytes
+
+        tasks = [parallel_loading.LoadTask(lazy_group.transform_path,
+                                           parallel_loading.LoadKind.TRANSFORM,
+                                           node=lazy_group.node_transform)]
+        tasks[0].on_loaded = lambda node, task=tasks[0]: transform_loaded(task, node)
+
+        for path, kind in lazy_group.data_paths:
+            task = parallel_loading.LoadTask(path, kind)
+            task.on_loaded = lambda node, task=task: data_loaded(task, node)
+            tasks.append(task)
+
+        return tasks
+
+    def abort_loading(self) -> None:
+        """
+        Lets groups whose field did not arrive (cancelled or failed) be loaded again.
+        """
+
+        for lazy_group in self._groups.values():
+            lazy_group.loading = False
+
+    def evict(self, keep: Optional[LazyGroup] = None) -> None:
+        """
+        Drops the data of the least recently used groups until the budget is met.
+        The kept group and groups that are still loading, also their originals, are not evicted.
+        """
+
+        candidates = sorted((lazy_group for lazy_group in self._groups.values()
+                             if lazy_group.loaded and not lazy_group.loading and lazy_group is not keep
+                             and not (self.originals is not None and self.originals.is_loading(lazy_group))),
+                            key=lambda lazy_group: lazy_group.last_used)
+
+        for lazy_group in candidates:
+            # shared originals are only freed with their last group, so the total is counted again
+            if self.nbytes <= self.max_bytes:
+                break
+
+            self._evict(lazy_group)
+
+    def _evict(self, lazy_group: LazyGroup) -> None:
+        logging.info(f"Evicting registration group {lazy_group.group} ({lazy_group.nbytes / 1024 ** 2:.0f} MB)")
+
+        for node in self._release_originals(lazy_group):
+            if node.GetScene() is not None:
+                slicer.mrmlScene.RemoveNode(node)
+
+        self._drop_data(lazy_group)
+        self.evictions += 1
+
+    @staticmethod
+    def _drop_data(lazy_group: LazyGroup) -> None:
+        """
+        Turns the group back into a placeholder. Its originals are kept.
+        """
+
+        for node in lazy_group.nodes:
+            if node.GetScene() is not None:
+                slicer.mrmlScene.RemoveNode(node)
+
+        lazy_group.node_transform.SetAndObserveTransformFromParent(slicer.vtkOrientedGridTransform())
+        lazy_group.node_transform.SetAttribute(PLACEHOLDER_ATTRIBUTE, "1")
+
+        lazy_group.nodes = []
+        lazy_group.nbytes = 0
+
+    def _release_originals(self, lazy_group: LazyGroup) -> list:
+        """
+        The original nodes no other group uses any more.
+        """
+
+        if self.originals is None:
+            return []
+
+        return self.originals.release(lazy_group)
@@ -0,0 +1,152 @@
+"""
+Registry of the original fixed and moving files that are loaded in the scene.
+
+Groups that share a fixed or moving case refer to the same original files. They are
+identified by resolved path and file signature, and loaded only once.
+
+Every file counts the groups using it. Files only placeholder groups use are part of the
+memory budget of those groups and are removed with the last of them, see release().
+"""
+
+import os
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from registrationViewerLib import parallel_loading
+
+# user of the originals of eagerly loaded groups, which are never evicted
+PERMANENT = "permanent"
+
+
+def file_signature(path: str) -> Optional[Tuple[str, int, int]]:
+    """
+    (resolved path, size, mtime) of a file, or None if it does not exist.
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class LoadedOriginals:
+    """
+    Maps original files to the nodes loaded from them, including files that are still loading.
+    """
+
+    def __init__(self) -> None:
+        self._nodes: Dict[Tuple[str, int, int], Any] = {}
+        self._pending: Dict[Tuple[str, int, int], List[Callable[[Any], None]]] = {}
+
+        # groups using a file, PERMANENT for eagerly loaded groups
+        self._users: Dict[Tuple[str, int, int], Set[Any]] = {}
+        # size of the decoded file
+        self._nbytes: Dict[Tuple[str, int, int], int] = {}
+
+        self.avoided_loads = 0
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Size of the loaded files that are only used by placeholder groups.
+        """
+
+        return sum(self._nbytes.get(signature, 0) for signature, users in self._users.items()
+                   if signature in self._nodes and PERMANENT not in users)
+
+    def task(self,
+             path: str,
+             kind: parallel_loading.LoadKind,
+             on_loaded: Optional[Callable[[Any], None]] = None,
+             user: Any = PERMANENT) -> Optional[parallel_loading.LoadTask]:
+        """
+        Returns the task loading the file, or None if the file is loaded or loading already.
+        In that case on_loaded is called with the existing node, now or once it is loaded.
+
+        @param user: The group the file is loaded for, e.g. a LazyGroup. PERMANENT files are
+                     never released.
+        """
+
+        signature = file_signature(path)
+        if signature is None:
+            return parallel_loading.LoadTask(path, kind, on_loaded)
+
+        self._users.setdefault(signature, set()).add(user)
+
+        callbacks = [on_loaded] if on_loaded is not None else []
+
+        node = self._nodes.get(signature)
+        if node is not None and node.GetScene() is not None:
+            self.avoided_loads += 1
+            for callback in callbacks:
+                callback(node)
+            return None
+
+        if signature in self._pending:
+            self.avoided_loads += 1
+            self._pending[signature].extend(callbacks)
+            return None
+
+        self._pending[signature] = callbacks
+
+        task = parallel_loading.LoadTask(path, kind)
+        task.on_loaded = lambda node: self._loaded(signature, node, task.nbytes)
+
+        return task
+
+    def is_loading(self, user: Any) -> bool:
+        """
+        Returns True if a file used by the user is still loading.
+        """
+
+        return any(user in self._users.get(signature, ()) for signature in self._pending)
+
+    def release(self, user: Any) -> List[Any]:
+        """
+        Stops counting the user for all its files.
+
+        @return: The nodes of the files no group uses any more, for the caller to remove.
+        """
+
+        unused = []
+        for signature, users in list(self._users.items()):
+            if user not in users:
+                continue
+
+            users.discard(user)
+            if users:
+                continue
+
+            del self._users[signature]
+            self._nbytes.pop(signature, None)
+
+            node = self._nodes.pop(signature, None)
+            if node is not None and node.GetScene() is not None:
+                unused.append(node)
+
+        return unused
+
+    def abort_pending(self) -> None:
+        """
+        Forgets files whose loading was cancelled or failed, so they are loaded again.
+        """
+
+        for signature in self._pending:
+            if signature not in self._nodes:
+                self._users.pop(signature, None)
+
+        self._pending = {}
+
+    def clear(self) -> None:
+        self._nodes = {}
+        self._pending = {}
+        self._users = {}
+        self._nbytes = {}
+
+    def _loaded(self, signature: Tuple[str, int, int], node, nbytes: int) -> None:
+        self._nodes[signature] = node
+        self._nbytes[signature] = nbytes
+
+        for callback in self._pending.pop(signature, []):
+            callback(node)
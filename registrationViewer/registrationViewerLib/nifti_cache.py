@@ -0,0 +1,171 @@
+"""
+Local cache of decoded compressed images.
+
+A .nii.gz is decompressed once. Its voxels are then kept as an uncompressed .npy file
+that later loads map into memory with np.load(mmap_mode='c'), so they pay neither the
+gzip decompression nor a copy. Entries are keyed by path, size and mtime of the source
+file, and the least recently used ones are removed when the cache grows over its budget.
+
+The mapping is copy-on-write: VTK may write into the voxels it borrows, which never
+reaches the cache file.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# default size budget of the cache directory
+DEFAULT_CACHE_BYTES = 10 * 1024 ** 3
+
+COMPRESSED_EXTENSIONS = ('.gz',)
+
+
+def is_compressed(path: str) -> bool:
+    return path.endswith(COMPRESSED_EXTENSIONS)
+
+
+class NiftiCache:
+    """
+    Decoded arrays and their IJK to RAS matrix, stored as <key>.npy and <key>.json.
+
+    The methods are thread-safe, the loader calls them from its worker threads.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_CACHE_BYTES) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+
+    def key(self, path: str, variant: str = "") -> Optional[str]:
+        """
+        Key of the current content of a file, or None if it does not exist.
+
+        @param variant: Distinguishes different decodings of the same file.
+        """
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        signature = f"{os.path.realpath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{variant}"
+
+        return hashlib.sha1(signature.encode()).hexdigest()
+
+    def get(self, path: str, variant: str = "") -> Optional[Tuple[np.ndarray, np.ndarray, Dict]]:
+        """
+        Returns the memory-mapped voxels, the IJK to RAS matrix and the metadata stored
+        with a file, or None.
+        """
+
+        key = self.key(path, variant)
+        if key is None:
+            return None
+
+        array_path, header_path = self._paths(key)
+
+        # another load may evict the entry meanwhile, the file is then decoded again
+        try:
+            with open(header_path, "r") as header_file:
+                header = json.load(header_file)
+            array = np.load(array_path, mmap_mode='c')
+
+            # the header time is the LRU time of the entry
+            os.utime(header_path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        return array, np.array(header["ijk_to_ras"]), header.get("metadata", {})
+
+    def put(self,
+            path: str,
+            array: np.ndarray,
+            ijk_to_ras: np.ndarray,
+            variant: str = "",
+            metadata: Optional[Dict] = None) -> None:
+        """
+        Stores the decoded voxels of a file and evicts old entries if needed.
+
+        @param metadata: JSON-serialisable values returned with the voxels by get().
+        """
+
+        key = self.key(path, variant)
+        if key is None or array.nbytes > self.max_bytes:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        array_path, header_path = self._paths(key)
+
+        # the header is written last, an entry without one is never read
+        try:
+            temporary_path = f"{array_path}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "wb") as array_file:
+                np.save(array_file, np.ascontiguousarray(array))
+            os.replace(temporary_path, array_path)
+
+            temporary_path = f"{header_path}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "w") as header_file:
+                json.dump({"source": path,
+                           "ijk_to_ras": np.asarray(ijk_to_ras).tolist(),
+                           "metadata": metadata or {}}, header_file)
+            os.replace(temporary_path, header_path)
+        except OSError as e:
+            logging.warning(f"Could not cache {path}: {str(e)}")
+            return
+
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache fits its budget.
+        """
+
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".json"):
+                    continue
+
+                array_path, header_path = self._paths(name[:-len(".json")])
+                try:
+                    entries.append((os.stat(header_path).st_mtime,
+                                    os.stat(array_path).st_size,
+                                    array_path,
+                                    header_path))
+                except OSError:
+                    continue
+
+            total = sum(entry[1] for entry in entries)
+            for _, size, array_path, header_path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+
+                # removing a file that is mapped somewhere keeps the mapping valid on POSIX
+                for file_path in (header_path, array_path):
+                    try:
+                        os.remove(file_path)
+                    except OSError:
+                        pass
+                total -= size
+
+    @property
+    def statistics(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses"
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        return (os.path.join(self.directory, key + ".npy"),
+                os.path.join(self.directory, key + ".json"))
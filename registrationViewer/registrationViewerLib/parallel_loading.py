@@ -0,0 +1,322 @@
+"""
+Loading of image files on worker threads.
+
+Reading and decompressing runs in a bounded thread pool. Only the creation of the MRML
+nodes from the decoded arrays runs on the main thread.
+"""
+
+import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
+from typing import Any, Callable, Deque, List, Optional, Tuple
+
+import numpy as np
+import qt
+import slicer
+
+from registrationViewerLib import compact_field, image_io, nifti_cache, zero_copy
+
+DEFAULT_MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+# node attribute with the bound on the error of a compacted field in mm
+FIELD_ERROR_ATTRIBUTE = "registrationViewer.FieldErrorBound"
+
+
+class LoadKind(Enum):
+    VOLUME = "volume"
+    SEGMENTATION = "segmentation"
+    TRANSFORM = "transform"
+
+
+class LoadTask:
+    """
+    One file to load. on_loaded is called on the main thread with the created node.
+    A transform can be loaded into an existing node instead of a new one.
+    """
+
+    def __init__(self,
+                 path: str,
+                 kind: LoadKind,
+                 on_loaded: Optional[Callable[[Any], None]] = None,
+                 node: Optional[Any] = None) -> None:
+        self.path = path
+        self.kind = kind
+        self.on_loaded = on_loaded
+        self.node = node
+        self.name = node_name_from_path(path)
+
+        # size of the decoded voxels, known once the file is read
+        self.nbytes = 0
+
+
+class DecodedImage:
+    """
+    Voxels read on a worker thread, indexed [k, j, i] or [k, j, i, component].
+    Displacements are array * displacement_scale + displacement_shift.
+    """
+
+    def __init__(self,
+                 array: np.ndarray,
+                 ijk_to_ras: np.ndarray,
+                 displacement_scale: float = 1.0,
+                 displacement_shift: float = 0.0,
+                 error_bound: float = 0.0) -> None:
+        self.array = array
+        self.ijk_to_ras = ijk_to_ras
+        self.displacement_scale = displacement_scale
+        self.displacement_shift = displacement_shift
+        self.error_bound = error_bound
+
+
+def node_name_from_path(path: str) -> str:
+    """
+    Node name Slicer would give the file, i.e. the file name without its extensions.
+    """
+
+    name = os.path.basename(path)
+    for extension in ('.gz', '.nii', '.nrrd', '.mha', '.mhd'):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+
+    return name
+
+
+def read_task(task: LoadTask,
+              cache: Optional[nifti_cache.NiftiCache] = None,
+              field_dtype: Optional[np.dtype] = None) -> DecodedImage:
+    """
+    Reads the file of a task, from the decompressed cache if it holds the file.
+
+    @param field_dtype: Compact dtype displacement fields are stored in, see
+                        compact_field.compact_displacements(). None keeps the file's dtype.
+    """
+
+    variant = task.kind.value
+    if task.kind == LoadKind.TRANSFORM and field_dtype is not None:
+        variant += "-" + np.dtype(field_dtype).name
+
+    use_cache = cache is not None and nifti_cache.is_compressed(task.path)
+    if use_cache:
+        cached = cache.get(task.path, variant=variant)
+        if cached is not None:
+            array, ijk_to_ras, metadata = cached
+            return DecodedImage(array, ijk_to_ras, **metadata)
+
+    if task.kind == LoadKind.TRANSFORM:
+        decoded = DecodedImage(*image_io.read_displacement_field(task.path))
+
+        if field_dtype is not None:
+            decoded.array, decoded.displacement_scale, decoded.displacement_shift, decoded.error_bound = \
+                compact_field.compact_displacements(decoded.array, field_dtype)
+    else:
+        decoded = DecodedImage(*image_io.read_image(task.path))
+
+    if use_cache:
+        cache.put(task.path, decoded.array, decoded.ijk_to_ras, variant=variant,
+                  metadata={"displacement_scale": decoded.displacement_scale,
+                            "displacement_shift": decoded.displacement_shift,
+                            "error_bound": decoded.error_bound})
+
+    return decoded
+
+
+def create_grid_transform_node(decoded: DecodedImage,
+                               name: str,
+                               node: Optional[slicer.vtkMRMLGridTransformNode] = None
+                               ) -> slicer.vtkMRMLGridTransformNode:
+    """
+    Creates a grid transform node from a decoded displacement field, like loadTransform
+    does for ITK displacement fields: the grid is the resampling (from parent) transform.
+    The grid shares the buffer of the decoded array.
+
+    @param node: Existing node that receives the field instead of a new node.
+    """
+
+    array = decoded.array
+    spacing = np.linalg.norm(decoded.ijk_to_ras[:3, :3], axis=0)
+
+    grid = zero_copy.image_from_array(array, components=3)
+    grid.SetSpacing(*spacing)
+    grid.SetOrigin(*decoded.ijk_to_ras[:3, 3])
+
+    direction = np.eye(4)
+    direction[:3, :3] = decoded.ijk_to_ras[:3, :3] / spacing
+
+    transform = slicer.vtkOrientedGridTransform()
+    transform.SetDisplacementGridData(grid)
+    transform.SetDisplacementScale(decoded.displacement_scale)
+    transform.SetDisplacementShift(decoded.displacement_shift)
+    transform.SetGridDirectionMatrix(slicer.util.vtkMatrixFromArray(direction))
+
+    if node is None:
+        node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLGridTransformNode", name)
+    node.SetAndObserveTransformFromParent(transform)
+
+    if decoded.error_bound:
+        node.SetAttribute(FIELD_ERROR_ATTRIBUTE, f"{decoded.error_bound:.6g}")
+        logging.info(f"{name} stored as {decoded.array.dtype.name}, "
+                     f"displacement error at most {decoded.error_bound:.3g} mm")
+
+    return node
+
+
+def create_node(task: LoadTask, decoded: DecodedImage) -> Any:
+    """
+    Creates the MRML node of a decoded file. Must run on the main thread.
+    Volumes and transforms use the decoded voxels without copying them.
+    """
+
+    if task.kind == LoadKind.VOLUME:
+        return zero_copy.add_volume_from_array(decoded.array, decoded.ijk_to_ras, task.name)
+
+    if task.kind == LoadKind.SEGMENTATION:
+        # the segmentation copies the labels into its own representation
+        labelmap = zero_copy.add_volume_from_array(decoded.array, decoded.ijk_to_ras, task.name,
+                                                   node_class_name="vtkMRMLLabelMapVolumeNode")
+        segmentation = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", task.name)
+        segmentation.CreateDefaultDisplayNodes()
+        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmap, segmentation)
+        slicer.mrmlScene.RemoveNode(labelmap)
+        return segmentation
+
+    return create_grid_transform_node(decoded, task.name, task.node)
+
+
+class ParallelLoader:
+    """
+    Reads files on a thread pool and creates their nodes on the main thread.
+
+    At most max_workers files are being read or waiting for their node at any time, so
+    the memory held by decoded images is bounded as well.
+    """
+
+    def __init__(self,
+                 max_workers: int = DEFAULT_MAX_WORKERS,
+                 on_progress: Optional[Callable[[int, int, str], None]] = None,
+                 on_finished: Optional[Callable[[List[str]], None]] = None,
+                 cache: Optional[nifti_cache.NiftiCache] = None,
+                 field_dtype: Optional[np.dtype] = None,
+                 poll_interval_ms: int = 50) -> None:
+        """
+        @param max_workers: Number of files read at the same time.
+        @param on_progress: Called on the main thread with (files done, files total, last file)
+                            after every file.
+        @param on_finished: Called on the main thread with the paths that failed once all
+                            files are loaded. Not called after cancel().
+        @param cache: Decompressed copies of compressed files, filled on the first load.
+        @param field_dtype: Compact dtype of loaded displacement fields, None keeps the file's dtype.
+        @param poll_interval_ms: How often the main thread checks the workers.
+        """
+
+        self.max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._pending: Deque[LoadTask] = deque()
+        self._running: List[Tuple[LoadTask, Future]] = []
+        # reads dropped by cancel() that are still decoding, they hold a worker until they finish
+        self._cancelled: List[Future] = []
+        self._on_progress = on_progress
+        self._on_finished = on_finished
+        self.cache = cache
+        self.field_dtype = field_dtype
+
+        self.done = 0
+        self.total = 0
+        self.failed: List[str] = []
+
+        self._timer = qt.QTimer()
+        self._timer.setInterval(poll_interval_ms)
+        self._timer.connect('timeout()', self._poll)
+
+    @property
+    def running(self) -> bool:
+        return bool(self._pending or self._running)
+
+    def load(self, tasks: List[LoadTask]) -> None:
+        """
+        Queues the tasks behind the ones that are still loading.
+        """
+
+        if not self.running:
+            self.done = 0
+            self.total = 0
+            self.failed = []
+
+        self._pending.extend(tasks)
+        self.total += len(tasks)
+
+        self._submit_pending()
+        self._timer.start()
+
+    def cancel(self) -> None:
+        """
+        Drops the files that are not loaded yet. Files being read finish in the
+        background, their results are discarded. Until then they count against max_workers.
+        """
+
+        self._pending.clear()
+        for _, future in self._running:
+            if not future.cancel():
+                self._cancelled.append(future)
+        self._running = []
+
+        self._timer.stop()
+
+    def shutdown(self) -> None:
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _submit_pending(self) -> None:
+        self._cancelled = [future for future in self._cancelled if not future.done()]
+
+        while self._pending and len(self._running) + len(self._cancelled) < self.max_workers:
+            task = self._pending.popleft()
+            self._running.append((task, self._executor.submit(read_task, task, self.cache, self.field_dtype)))
+
+    def _poll(self) -> None:
+        finished = []
+        running = []
+        for task, future in self._running:
+            (finished if future.done() else running).append((task, future))
+
+        self._running = running
+
+        # the decoded volumes are turned into nodes and freed before more are read
+        for task, future in finished:
+            self._create_node(task, future)
+            self.done += 1
+
+            if self._on_progress is not None:
+                self._on_progress(self.done, self.total, task.path)
+
+            # a callback may have cancelled the loading
+            if not self._timer.isActive():
+                return
+
+        self._submit_pending()
+
+        if not self.running:
+            self._timer.stop()
+
+            if self._on_finished is not None:
+                self._on_finished(self.failed)
+
+    def _create_node(self, task: LoadTask, future: Future) -> None:
+        try:
+            decoded = future.result()
+            task.nbytes = decoded.array.nbytes
+            logging.info(f"Loading {task.kind.value}: {task.path}")
+            node = create_node(task, decoded)
+        except Exception as e:
+            logging.error(f"Error loading {task.path}: {str(e)}")
+            self.failed.append(task.path)
+            return
+
+        if task.on_loaded is not None:
+            # a failing callback must not keep the other files from being delivered
+            try:
+                task.on_loaded(node)
+            except Exception as e:
+                logging.error(f"Error handling loaded {task.path}: {str(e)}")
+                self.failed.append(task.path)
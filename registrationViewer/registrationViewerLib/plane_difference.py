@@ -0,0 +1,102 @@
+from typing import List, Set, Tuple
+
+import numpy as np
+
+from registrationViewerLib import difference, warping
+
+
+class PlaneDifference:
+    """
+    Computes the difference between the fixed and the warped moving image only on the
+    planes that are currently shown, and remembers which planes are already done.
+
+    The difference array is filled in place; planes that were never shown stay untouched.
+    """
+
+    def __init__(self,
+                 array_fixed: np.ndarray,
+                 fixed_ijk_to_ras: np.ndarray,
+                 array_moving: np.ndarray,
+                 moving_ras_to_ijk: np.ndarray,
+                 mapping,
+                 array_diff: np.ndarray) -> None:
+
+        assert array_fixed.shape == array_diff.shape, "Difference must have the fixed geometry"
+
+        self.array_fixed = array_fixed
+        self.fixed_ijk_to_ras = fixed_ijk_to_ras
+        self.fixed_ras_to_ijk = np.linalg.inv(fixed_ijk_to_ras)
+        self.array_moving = array_moving
+        self.moving_ras_to_ijk = moving_ras_to_ijk
+        self.mapping = mapping
+        self.array_diff = array_diff
+
+        self.computed: Set[Tuple[int, int]] = set()
+
+    def planes_for_slice(self, slice_to_ras: np.ndarray) -> List[Tuple[int, int]]:
+        """
+        Returns the (array axis, index) of the voxel planes needed to display the given slice.
+        Both neighbouring planes are returned, because the slice is interpolated between them.
+
+        @param slice_to_ras: The 4x4 SliceToRAS matrix of the slice node.
+        """
+
+        normal_ijk = self.fixed_ras_to_ijk[:3, :3] @ slice_to_ras[:3, 2]
+        axis_ijk = int(np.argmax(np.abs(normal_ijk)))
+
+        position = warping.apply_matrix(self.fixed_ras_to_ijk,
+                                        slice_to_ras[None, :3, 3])[0, axis_ijk]
+
+        # array axes are ordered [k, j, i]
+        axis = 2 - axis_ijk
+        size = self.array_fixed.shape[axis]
+
+        indices = {int(np.floor(position)), int(np.ceil(position))}
+
+        return [(axis, index) for index in sorted(indices) if 0 <= index < size]
+
+    def compute_plane(self, axis: int, index: int) -> None:
+        """
+        Warps one plane of the moving image and writes the difference into the difference array.
+        """
+
+        region: List = [slice(None)] * 3
+        region[axis] = slice(index, index + 1)
+        region_tuple = tuple(region)
+
+        points = warping.voxel_plane_ras(self.fixed_ijk_to_ras,
+                                         self.array_fixed.shape,
+                                         axis,
+                                         index)
+
+        warped = np.empty(points.shape[0], dtype=self.array_moving.dtype)
+        warping.warp_points(points,
+                            self.array_moving,
+                            self.moving_ras_to_ijk,
+                            self.mapping,
+                            out=warped)
+
+        fixed = self.array_fixed[region_tuple]
+        difference.subtract_tiled(fixed,
+                                  warped.reshape(fixed.shape),
+                                  self.array_diff[region_tuple])
+
+        self.computed.add((axis, index))
+
+    def update(self, slices_to_ras: List[np.ndarray]) -> bool:
+        """
+        Computes the planes needed for the given slices that are not computed yet.
+
+        @param slices_to_ras: The SliceToRAS matrices of the displayed slices.
+        @return: True if any plane was computed.
+        """
+
+        missing = [plane
+                   for slice_to_ras in slices_to_ras
+                   for plane in self.planes_for_slice(slice_to_ras)
+                   if plane not in self.computed]
+
+        for axis, index in missing:
+            self.compute_plane(axis, index)
+
+        return bool(missing)
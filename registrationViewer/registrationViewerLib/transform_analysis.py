@@ -0,0 +1,221 @@
+"""
+Analysis of transform nodes into mappings the NumPy warp and the point lookup can use.
+
+A transform is analysed once per content of its node:
+
+- a displacement grid is used as it is (utils.displacement_field_from_transform),
+- a linear transform, also a chain of linear ones such as rigid.h5, becomes one 4x4 matrix,
+- anything else, e.g. a rigid + deformable composite, an inverted grid or a B-spline, is
+  evaluated by VTK once on a dense grid and flattened into a cached displacement field,
+  so no query walks the transform chain again. The grid is the one of the reference
+  (fixed) volume when one is given, as that is where the mapping is queried.
+
+Flattening a 512^3 grid takes seconds, so analyse_transform() only prepares it
+(PendingFlatten) and the sampling runs on a background worker, see flatten_job().
+"""
+
+import logging
+from typing import Callable, Hashable, Optional, Tuple, Union
+
+import numpy as np
+import slicer
+import vtk
+from vtk.util import numpy_support
+
+from registrationViewerLib import utils, volume_cache, warping
+
+# default byte budget of the cached flattened fields
+DEFAULT_FLATTENED_CACHE_BYTES = 1024 ** 3
+
+# flattened fields are kept per transform content and grid; a field larger than the budget
+# is kept on its own, as a dropped field would be sampled again on every use
+_flattened_cache = volume_cache.VolumeCache(
+    max_bytes=slicer.util.settingsValue("registrationViewer/FlattenedCacheMegabytes",
+                                        DEFAULT_FLATTENED_CACHE_BYTES // 1024 ** 2,
+                                        converter=int) * 1024 ** 2)
+
+Mapping = Union[warping.DisplacementField, warping.AffineMapping]
+
+
+class PendingFlatten:
+    """
+    A transform that still has to be sampled on a grid. It holds its own copy of the VTK
+    transform, so the sampling can run on a worker thread while the node is in use.
+    """
+
+    def __init__(self,
+                 key: Hashable,
+                 transform: vtk.vtkAbstractTransform,
+                 ijk_to_ras: np.ndarray,
+                 shape: Tuple[int, int, int],
+                 name: str) -> None:
+        self.key = key
+        self.transform = transform
+        self.ijk_to_ras = ijk_to_ras
+        self.shape = shape
+        self.name = name
+
+
+def linear_mapping(node_transform: slicer.vtkMRMLTransformNode) -> Optional[warping.AffineMapping]:
+    """
+    The matrix of a linear transform in the resampling (from parent) direction, or None.
+    """
+
+    if not node_transform.IsLinear():
+        return None
+
+    matrix = vtk.vtkMatrix4x4()
+    node_transform.GetMatrixTransformFromParent(matrix)
+
+    return warping.AffineMapping(slicer.util.arrayFromVTKMatrix(matrix))
+
+
+def chain_grid(transform: vtk.vtkAbstractTransform) -> Optional[Tuple[np.ndarray, Tuple[int, int, int]]]:
+    """
+    IJK to RAS matrix and (k, j, i) shape of the finest displacement grid in a transform chain.
+    """
+
+    transforms = vtk.vtkCollection()
+    slicer.vtkMRMLTransformNode.FlattenGeneralTransform(transforms, transform)
+
+    best = None
+    for index in range(transforms.GetNumberOfItems()):
+        item = transforms.GetItemAsObject(index)
+        if not item.IsA("vtkOrientedGridTransform") or item.GetDisplacementGrid() is None:
+            continue
+
+        grid = item.GetDisplacementGrid()
+        dimensions = grid.GetDimensions()
+        if best is not None and np.prod(dimensions) <= np.prod(best[1]):
+            continue
+
+        direction = np.eye(3)
+        if item.GetGridDirectionMatrix() is not None:
+            direction = slicer.util.arrayFromVTKMatrix(item.GetGridDirectionMatrix())[:3, :3]
+
+        ijk_to_ras = np.eye(4)
+        ijk_to_ras[:3, :3] = direction @ np.diag(grid.GetSpacing())
+        ijk_to_ras[:3, 3] = grid.GetOrigin()
+
+        best = (ijk_to_ras, (dimensions[2], dimensions[1], dimensions[0]))
+
+    return best
+
+
+def flatten_transform(transform: vtk.vtkAbstractTransform,
+                      ijk_to_ras: np.ndarray,
+                      shape: Tuple[int, int, int],
+                      chunk_voxels: int = warping.DEFAULT_CHUNK_VOXELS,
+                      progress_callback: Optional[Callable[[float], None]] = None) -> warping.DisplacementField:
+    """
+    Samples any VTK transform on a grid into a float32 displacement field.
+
+    @param transform: The transform in the resampling direction.
+    @param ijk_to_ras: IJK to RAS matrix of the grid.
+    @param shape: (k, j, i) shape of the grid.
+    @param progress_callback: Called with the finished fraction after every slab.
+    """
+
+    array = np.empty(tuple(shape) + (3,), dtype=np.float32)
+    slab = max(1, chunk_voxels // max(1, shape[1] * shape[2]))
+
+    points = vtk.vtkPoints()
+    mapped = vtk.vtkPoints()
+    mapped.SetDataTypeToDouble()
+
+    for k_start in range(0, shape[0], slab):
+        k_stop = min(shape[0], k_start + slab)
+
+        grid_points = np.ascontiguousarray(warping.voxel_grid_ras(ijk_to_ras, shape, k_start, k_stop))
+        points.SetData(numpy_support.numpy_to_vtk(grid_points, deep=False))
+
+        mapped.Reset()
+        transform.TransformPoints(points, mapped)
+
+        displacements = numpy_support.vtk_to_numpy(mapped.GetData()) - grid_points
+        array[k_start:k_stop] = displacements.reshape(k_stop - k_start, shape[1], shape[2], 3)
+
+        if progress_callback is not None:
+            progress_callback(k_stop / shape[0])
+
+    return warping.DisplacementField(array, ijk_to_ras)
+
+
+def flatten_job(job, pending: PendingFlatten) -> warping.DisplacementField:
+    """
+    Background job sampling a pending transform, see background.BackgroundRunner.
+    Pass the result to store_flattened() on the main thread.
+    """
+
+    return flatten_transform(pending.transform, pending.ijk_to_ras, pending.shape,
+                             progress_callback=job.report_progress)
+
+
+def store_flattened(pending: PendingFlatten, field: warping.DisplacementField) -> None:
+    """
+    Caches a flattened field, so analyse_transform() returns it from now on.
+    """
+
+    _flattened_cache.put(pending.key, {"field": field.array}, keep_oversize=True)
+
+    logging.info("Flattened transform %s into a %s displacement field",
+                 pending.name, "x".join(str(n) for n in pending.shape[::-1]))
+
+
+def clear_cache() -> None:
+    """
+    Drops the cached flattened fields, e.g. when the scene is closed.
+    """
+
+    _flattened_cache.clear()
+
+
+def analyse_transform(node_transform: slicer.vtkMRMLTransformNode,
+                      node_reference: Optional[slicer.vtkMRMLVolumeNode] = None
+                      ) -> Union[Mapping, PendingFlatten, None]:
+    """
+    Returns the mapping of a transform node in the resampling direction, or what is needed
+    to flatten it on a worker if it is not cached yet.
+
+    @param node_transform: The transform node.
+    @param node_reference: Volume whose grid the transform is flattened on, usually the fixed
+                           volume. Without it the finest displacement grid of the chain is used.
+    @return: A DisplacementField or AffineMapping, a PendingFlatten for flatten_job(), or None
+             if the transform cannot be flattened (no displacement grid in its chain and no
+             reference volume).
+    """
+
+    field = utils.displacement_field_from_transform(node_transform)
+    if field is not None:
+        return field
+
+    mapping = linear_mapping(node_transform)
+    if mapping is not None:
+        return mapping
+
+    transform = node_transform.GetTransformFromParent()
+    if transform is None:
+        return None
+
+    # the finest grid of a rigid + deformable chain lives in the space after the rigid step,
+    # fixed points outside its box would get clamped displacements and lose the rigid part
+    if node_reference is not None and node_reference.GetImageData() is not None:
+        dimensions = node_reference.GetImageData().GetDimensions()
+        grid = (utils.get_ijk_to_ras_matrix(node_reference), (dimensions[2], dimensions[1], dimensions[0]))
+    else:
+        grid = chain_grid(transform)
+    if grid is None:
+        return None
+
+    ijk_to_ras, shape = grid
+    key = (volume_cache.node_key(node_transform), ijk_to_ras.tobytes(), shape)
+
+    cached = _flattened_cache.get(key)
+    if cached is not None:
+        return warping.DisplacementField(cached["field"], ijk_to_ras)
+
+    # the grids of the copy share the displacement images, only the chain is copied
+    transform_copy = transform.NewInstance()
+    transform_copy.DeepCopy(transform)
+
+    return PendingFlatten(key, transform_copy, ijk_to_ras, shape, node_transform.GetName())
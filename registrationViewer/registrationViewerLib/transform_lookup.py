@@ -0,0 +1,152 @@
+import logging
+from typing import Hashable, List, Optional, Tuple
+
+import numpy as np
+import slicer
+
+from registrationViewerLib import inverse_field, transform_analysis, volume_cache, warping
+
+# default byte budget of the cached inverse fields
+DEFAULT_INVERSE_CACHE_BYTES = 1024 ** 3
+
+# inverse fields are kept per transform content, so switching back to a transform is free
+_inverse_cache = volume_cache.VolumeCache(
+    max_bytes=slicer.util.settingsValue("registrationViewer/InverseCacheMegabytes",
+                                        DEFAULT_INVERSE_CACHE_BYTES // 1024 ** 2,
+                                        converter=int) * 1024 ** 2)
+
+
+def clear_cache() -> None:
+    """
+    Drops the cached inverse fields, e.g. when the scene is closed.
+    """
+
+    _inverse_cache.clear()
+
+
+class TransformLookup:
+    """
+    Maps single points between the fixed and the moving space of a transform node
+    without applying the transform to any MRML node.
+
+    Displacement fields are held as NumPy arrays with a cached RAS to IJK matrix, so a
+    fixed -> moving query is a single trilinear interpolation. Once the inverse field is
+    available (see compute_inverse_job), moving -> fixed queries are one interpolation as
+    well. Linear transforms are a matrix product both ways, composites are flattened into
+    a displacement field (see transform_analysis) by a background job, see set_field().
+    Until then, and for transforms that cannot be flattened, points are evaluated with VTK.
+    """
+
+    def __init__(self,
+                 node_transformation: slicer.vtkMRMLTransformNode,
+                 node_reference: Optional[slicer.vtkMRMLVolumeNode] = None) -> None:
+        """
+        @param node_reference: Volume a composite transform is flattened on, usually the fixed
+                               volume, see transform_analysis.analyse_transform().
+        """
+
+        assert node_transformation is not None, "Transformation node is None"
+
+        self.node_transformation = node_transformation
+        self.key = volume_cache.node_key(node_transformation)
+
+        self.field: Optional[transform_analysis.Mapping] = None
+        self.pending_flatten: Optional[transform_analysis.PendingFlatten] = None
+
+        self.inverse: Optional[transform_analysis.Mapping] = None
+        self.inverse_residual: Optional[Tuple[float, float]] = None
+        self._inverse_key: Hashable = self.key
+
+        analysed = transform_analysis.analyse_transform(node_transformation, node_reference)
+        if isinstance(analysed, transform_analysis.PendingFlatten):
+            self.pending_flatten = analysed
+        elif analysed is not None:
+            self._use_field(analysed)
+
+    @property
+    def needs_flatten(self) -> bool:
+        return self.pending_flatten is not None
+
+    @property
+    def needs_inverse(self) -> bool:
+        return self.field is not None and self.inverse is None
+
+    def set_field(self, field: warping.DisplacementField) -> None:
+        """
+        Stores the result of transform_analysis.flatten_job() and caches it for this transform.
+        """
+
+        transform_analysis.store_flattened(self.pending_flatten, field)
+        self.pending_flatten = None
+
+        self._use_field(field)
+
+    def _use_field(self, field: transform_analysis.Mapping) -> None:
+        self.field = field
+
+        # the same transform flattened on another grid has another inverse
+        self._inverse_key = self.key
+        if isinstance(self.field, warping.DisplacementField):
+            self._inverse_key = (self.key, self.field.ijk_to_ras.tobytes(), self.field.array.shape)
+
+        cached = _inverse_cache.get(self._inverse_key)
+        if isinstance(self.field, warping.AffineMapping):
+            self.inverse = self.field.inverse()
+            self.inverse_residual = (0.0, 0.0)
+        elif cached is not None:
+            self.inverse = warping.DisplacementField(cached["inverse"],
+                                                     self.field.ijk_to_ras)
+            self.inverse_residual = (float(cached["residual"][0]),
+                                     float(cached["residual"][1]))
+
+    def set_inverse(self, result: Tuple[warping.DisplacementField, float, float]) -> None:
+        """
+        Stores the result of compute_inverse_job() and caches it for this transform.
+        """
+
+        self.inverse, residual_max, residual_mean = result
+        self.inverse_residual = (residual_max, residual_mean)
+
+        _inverse_cache.put(self._inverse_key, {"inverse": self.inverse.array,
+                                               "residual": np.array(self.inverse_residual)},
+                           keep_oversize=True)
+
+        logging.info("Inverse of %s: inverse-consistency residual max %.3f mm, mean %.3f mm",
+                     self.node_transformation.GetName(), residual_max, residual_mean)
+
+    def is_current(self, node_transformation: slicer.vtkMRMLTransformNode) -> bool:
+        """
+        Returns True if the lookup still describes the given transform node.
+        """
+
+        return node_transformation is self.node_transformation and \
+            volume_cache.node_key(node_transformation) == self.key
+
+    def fixed_to_moving(self, position: List[float]) -> List[float]:
+        """
+        Maps a point from the fixed space into the moving space (resampling direction).
+        """
+
+        if self.field is not None:
+            return self.field.transform_point(position).tolist()
+
+        return list(self.node_transformation.GetTransformFromParent().TransformPoint(position))
+
+    def moving_to_fixed(self, position: List[float]) -> List[float]:
+        """
+        Maps a point from the moving space into the fixed space.
+        """
+
+        if self.inverse is not None:
+            return self.inverse.transform_point(position).tolist()
+
+        return list(self.node_transformation.GetTransformToParent().TransformPoint(position))
+
+
+def compute_inverse_job(job, field: warping.DisplacementField) -> Tuple[warping.DisplacementField, float, float]:
+    """
+    Background job computing the inverse of a displacement field, see background.BackgroundRunner.
+    """
+
+    return inverse_field.invert_displacement_field(field,
+                                                   progress_callback=job.report_progress)
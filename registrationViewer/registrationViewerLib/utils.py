@@ -1,8 +1,40 @@
-from typing import Tuple, Callable, List
+from enum import Enum
+from typing import Tuple, Callable, List, Optional
 
+import numpy as np
 import qt
 import slicer
 import vtk
+from vtk.util import numpy_support
+
+from registrationViewerLib import compact_field, warping, zero_copy
+
+
+class WarpBackend(Enum):
+    NUMPY = "numpy"
+    CLI = "cli"
+
+
+class DiffMode(Enum):
+    FULL = "full"
+    PLANES = "planes"
+
+
+class FieldStorage(Enum):
+    ORIGINAL = "original"
+    FLOAT32 = "float32"
+    INT16 = "int16"
+
+    @property
+    def dtype(self) -> Optional[np.dtype]:
+        """
+        The dtype fields are stored in, None for the dtype of the file.
+        """
+
+        if self == FieldStorage.ORIGINAL:
+            return None
+
+        return np.dtype(self.value)
 
 
 def create_shortcuts(*shortcuts: Tuple[str, Callable]) -> None:
@@ -68,11 +100,168 @@ def resample_node_to_reference_node(node_input: slicer.vtkMRMLScalarVolumeNode,
 
 def warp_moving_with_transform(node_moving: slicer.vtkMRMLScalarVolumeNode,
                                node_transform: slicer.vtkMRMLTransformNode,
-                               node_warped):
+                               node_warped,
+                               node_reference: Optional[slicer.vtkMRMLScalarVolumeNode] = None):
+    """
+    @param node_reference: Volume whose grid the warped volume is resampled on, the moving
+                           volume if None.
+    """
 
     apply_and_harden_transform_to_node(node_warped, node_transform)
 
-    resample_node_to_reference_node(node_warped, node_moving)
+    resample_node_to_reference_node(node_warped, node_reference if node_reference is not None else node_moving)
+
+
+def get_ijk_to_ras_matrix(node: slicer.vtkMRMLVolumeNode) -> np.ndarray:
+    matrix = vtk.vtkMatrix4x4()
+    node.GetIJKToRASMatrix(matrix)
+
+    return slicer.util.arrayFromVTKMatrix(matrix)
+
+
+def get_ras_to_ijk_matrix(node: slicer.vtkMRMLVolumeNode) -> np.ndarray:
+    matrix = vtk.vtkMatrix4x4()
+    node.GetRASToIJKMatrix(matrix)
+
+    return slicer.util.arrayFromVTKMatrix(matrix)
+
+
+def displacement_field_from_transform(node_transform: slicer.vtkMRMLTransformNode) -> Optional[warping.DisplacementField]:
+    """
+    Returns the displacement field of a grid transform, or None if the transform is not a plain
+    displacement grid in the resampling (from parent) direction.
+
+    @param node_transform: The transform node.
+    """
+
+    transform = node_transform.GetTransformFromParent()
+    if transform is None or not transform.IsA("vtkOrientedGridTransform") or transform.GetInverseFlag():
+        return None
+
+    grid = transform.GetDisplacementGrid()
+    if grid is None:
+        return None
+
+    dimensions = grid.GetDimensions()
+    array = numpy_support.vtk_to_numpy(grid.GetPointData().GetScalars()).reshape(
+        dimensions[2], dimensions[1], dimensions[0], 3)
+
+    direction = np.eye(3)
+    direction_matrix = transform.GetGridDirectionMatrix()
+    if direction_matrix is not None:
+        direction = slicer.util.arrayFromVTKMatrix(direction_matrix)[:3, :3]
+
+    ijk_to_ras = np.eye(4)
+    ijk_to_ras[:3, :3] = direction @ np.diag(grid.GetSpacing())
+    ijk_to_ras[:3, 3] = grid.GetOrigin()
+
+    return warping.DisplacementField(array,
+                                     ijk_to_ras,
+                                     displacement_scale=transform.GetDisplacementScale(),
+                                     displacement_shift=transform.GetDisplacementShift())
+
+
+def compact_transform_node(node_transform: slicer.vtkMRMLTransformNode, dtype) -> Optional[float]:
+    """
+    Replaces the float displacement grid of a grid transform with a compact copy, e.g.
+    for fields loaded with slicer.util.loadTransform, which are float64.
+
+    @param node_transform: The transform node.
+    @param dtype: np.float32 or np.int16, see compact_field.compact_displacements().
+    @return: The bound on the displacement error in mm, or None if the transform has no
+             float displacement grid.
+    """
+
+    field = displacement_field_from_transform(node_transform)
+    if field is None or field.array.dtype.kind != 'f' or \
+            field.displacement_scale != 1.0 or field.displacement_shift != 0.0:
+        return None
+
+    array, scale, shift, error_bound = compact_field.compact_displacements(field.array, dtype)
+    if array is field.array:
+        return 0.0
+
+    transform = node_transform.GetTransformFromParent()
+    grid = transform.GetDisplacementGrid()
+
+    compact_grid = zero_copy.image_from_array(array, components=3)
+    compact_grid.SetOrigin(grid.GetOrigin())
+    compact_grid.SetSpacing(grid.GetSpacing())
+
+    transform.SetDisplacementGridData(compact_grid)
+    transform.SetDisplacementScale(scale)
+    transform.SetDisplacementShift(shift)
+    transform.Modified()
+
+    return error_bound
+
+
+def allocate_volume_like(node_target: slicer.vtkMRMLScalarVolumeNode,
+                         node_reference: slicer.vtkMRMLScalarVolumeNode,
+                         dtype: np.dtype) -> np.ndarray:
+    """
+    Makes sure the target node has a single-component image with the geometry of the
+    reference node and the given dtype, and returns its voxels as an array view, so it
+    can be filled in place.
+
+    The existing image is reused when dimensions and dtype already match, so a new
+    image is only allocated when the geometry changes.
+
+    @param node_target: The volume node that receives the image.
+    @param node_reference: The volume node whose geometry is copied.
+    @param dtype: The scalar type of the image.
+    """
+
+    dimensions = node_reference.GetImageData().GetDimensions()
+    vtk_type = numpy_support.get_vtk_array_type(np.dtype(dtype))
+
+    image = node_target.GetImageData()
+    if image is None or image.GetDimensions() != dimensions or \
+            image.GetScalarType() != vtk_type or image.GetNumberOfScalarComponents() != 1:
+        image = vtk.vtkImageData()
+        image.SetDimensions(dimensions)
+        image.AllocateScalars(vtk_type, 1)
+        node_target.SetAndObserveImageData(image)
+
+    if not np.array_equal(get_ijk_to_ras_matrix(node_target), get_ijk_to_ras_matrix(node_reference)):
+        node_target.CopyOrientation(node_reference)
+
+    return slicer.util.arrayFromVolume(node_target)
+
+
+def warp_moving_with_transform_into(node_moving: slicer.vtkMRMLScalarVolumeNode,
+                                    node_transform: slicer.vtkMRMLTransformNode,
+                                    node_warped: slicer.vtkMRMLScalarVolumeNode,
+                                    node_reference: slicer.vtkMRMLScalarVolumeNode) -> np.ndarray:
+    """
+    Warps the moving volume with the CLI resampler onto the grid of the reference volume
+    and copies the result into the existing warped node, reusing its image when the
+    geometry is unchanged.
+
+    The CLI needs a hardened copy of the moving volume, so a temporary node is still
+    created and removed here.
+
+    @param node_reference: The fixed volume, the warped volume is compared with it voxel by voxel.
+    @return: The array view of the warped node.
+    """
+
+    node_temporary = slicer.modules.volumes.logic(
+    ).CloneVolume(node_moving, "WarpedTemporary")
+
+    try:
+        warp_moving_with_transform(node_moving, node_transform, node_temporary, node_reference)
+
+        array_temporary = slicer.util.arrayFromVolume(node_temporary)
+        array_warped = allocate_volume_like(node_warped,
+                                            node_temporary,
+                                            array_temporary.dtype)
+        array_warped[...] = array_temporary
+    finally:
+        slicer.mrmlScene.RemoveNode(node_temporary)
+
+    slicer.util.arrayFromVolumeModified(node_warped)
+
+    return array_warped
 
 
 def collapse_all_segmentations() -> None:
@@ -1,8 +1,12 @@
 
 
+import contextlib
+import logging
+import time
 from enum import Enum
-from typing import List, Literal
+from typing import Dict, List, Literal, Optional, Set
 
+import numpy as np
 from qt import QEvent, QObject
 import slicer
 from slicer import vtkMRMLScalarVolumeNode
@@ -14,27 +18,69 @@ class Layout(Enum):
     L_1X2_YELLOW = 803
     L_2X3 = 701
     L_3X3 = 601
+    # one row of views per compared result, the layout ID is COMPARISON_LAYOUT_ID + rows
+    L_COMPARISON = 900
 
 
+COMPARISON_LAYOUT_ID = Layout.L_COMPARISON.value
+# view group of row 0 of the comparison layout, the rows of the module's layouts use 1 to 3
+COMPARISON_VIEW_GROUP = 10
+
+VIEW_COLORS = {"Red": ("Axial", "#F34A33"),
+               "Green": ("Coronal", "#6EB04B"),
+               "Yellow": ("Sagittal", "#EDD54C")}
+
 layout_callback = None
 
+# the layout shown, set by the set_*_layout functions
+current_layout: Optional[Layout] = None
+
 
 def register_layout_callback(callback):
     global layout_callback
     layout_callback = callback
 
 
+@contextlib.contextmanager
+def batched_view_update(views: Optional[List[str]] = None):
+    """
+    Pauses rendering while several views are changed, and holds back the modified events of
+    the slice and composite nodes of the given views until the block ends. Blocks nest, the
+    views render once when the outermost block ends. Also usable as a decorator.
+
+    Code that reads what the slice logic derives from a held back node (e.g.
+    fitSliceToBackground after a background change) must run after the inner block ended.
+
+    @param views: Views whose nodes are modified in the block, None only pauses rendering.
+    """
+
+    nodes = []
+    for view in views or []:
+        handles = registry.view(view)
+        if handles is not None:
+            nodes.extend([handles.composite_node, handles.slice_node])
+
+    slicer.app.pauseRender()
+    was_modifying = [node.StartModify() for node in nodes]
+    try:
+        yield
+    finally:
+        for node, was_modified in zip(reversed(nodes), reversed(was_modifying)):
+            node.EndModify(was_modified)
+        slicer.app.resumeRender()
+
+
 def update_views_with_volume(views: List[str], volume: vtkMRMLScalarVolumeNode) -> None:
-    for view in views:
-        slice_logic = slicer.app.layoutManager().sliceWidget(view).sliceLogic()
-        composite_node = slice_logic.GetSliceCompositeNode()
+    with batched_view_update(views):
+        for view in views:
+            composite_node = registry.view(view).composite_node
 
-        if volume:
-            composite_node.SetBackgroundVolumeID(volume.GetID())
-        else:
-            composite_node.SetBackgroundVolumeID(None)
+            if volume:
+                composite_node.SetBackgroundVolumeID(volume.GetID())
+            else:
+                composite_node.SetBackgroundVolumeID(None)
 
-        composite_node.SetForegroundVolumeID(None)
+            composite_node.SetForegroundVolumeID(None)
 
 
 def link_views(views: List[str]) -> None:
@@ -44,68 +90,157 @@ def link_views(views: List[str]) -> None:
     @param views: The views to link.
     """
 
-    for view in views:
-        sliceLogic = slicer.app.layoutManager().sliceWidget(view).sliceLogic()
-        compositeNode = sliceLogic.GetSliceCompositeNode()
-        compositeNode.SetLinkedControl(True)
+    with batched_view_update(views):
+        for view in views:
+            registry.view(view).composite_node.SetLinkedControl(True)
 
 
 def unlink_views(views: List[str]) -> None:
 
-    for view in views:
-        sliceLogic = slicer.app.layoutManager().sliceWidget(view).sliceLogic()
-        compositeNode = sliceLogic.GetSliceCompositeNode()
-        compositeNode.SetLinkedControl(False)
+    with batched_view_update(views):
+        for view in views:
+            registry.view(view).composite_node.SetLinkedControl(False)
 
 
 class ViewClickFilter(QObject):
-    def __init__(self, to_layout: Literal["set_1x2_layout", "set_2x3_layout", "set_3x3_layout"], parent=None):
+    """
+    Double-clicking a view opens its 1x2 layout, double-clicking in a 1x2 layout goes back
+    to the 2x3 layout. The comparison layout ignores double-clicks. One filter is installed
+    once on every view.
+    """
+
+    def __init__(self, parent=None):
         super().__init__(parent)
         self.view_widgets = {}
-        self.to_layout = to_layout
 
     def add_view(self, name, widget):
         self.view_widgets[widget] = name
 
     def eventFilter(self, watched, event):
-        if event.type() == QEvent.MouseButtonDblClick:
+        if event.type() == QEvent.MouseButtonDblClick and current_layout != Layout.L_COMPARISON:
             if watched in self.view_widgets:
                 view_name = self.view_widgets[watched]
 
-                if self.to_layout == "set_1x2_layout":
-                    set_1x2_layout(view_name[:-1])
-                elif self.to_layout == "set_2x3_layout":
+                if current_layout in (Layout.L_1X2_RED, Layout.L_1X2_GREEN, Layout.L_1X2_YELLOW):
                     set_2x3_layout()
-                elif self.to_layout == "set_3x3_layout":
-                    set_3x3_layout()
+                else:
+                    set_1x2_layout(view_name[:-1])
 
                 return True  # Event has been handled
         return QObject.eventFilter(self, watched, event)
 
 
-def set_1x2_layout(color: Literal["Red", "Green", "Yellow"]) -> None:
+class ViewHandles:
+    """
+    The objects of one slice view that are used over and over.
     """
-    Create a custom 1x2 layout for the given color.
-    The two views (e.g., Red1 and Red2) are shown side by side.
 
-    Parameters:
-    - color (str): The color of the slice view to use ("Red", "Green", or "Yellow").
+    def __init__(self, slice_widget) -> None:
+        self.slice_widget = slice_widget
+        self.slice_view = slice_widget.sliceView()
+        self.slice_logic = slice_widget.sliceLogic()
+        self.composite_node = self.slice_logic.GetSliceCompositeNode()
+        self.slice_node = self.slice_logic.GetSliceNode()
+
+    def fit_slice_to_background(self) -> None:
+        self.slice_widget.sliceController().fitSliceToBackground()
+
+
+class ViewRegistry:
     """
+    Registers the layouts of the module once and keeps the handles of every slice view,
+    so switching layouts only calls setLayout and no view is looked up twice.
 
-    if color not in ["Red", "Green", "Yellow"]:
-        raise ValueError("Invalid color. Must be 'Red', 'Green', or 'Yellow'.")
+    The slice widgets outlive layout switches; the handles are only dropped on scene close.
+    """
+
+    def __init__(self) -> None:
+        self._views: Dict[str, ViewHandles] = {}
+        self._layouts_registered = False
+        # comparison layouts are registered when first shown, one per number of rows
+        self._registered_comparisons: Set[int] = set()
+
+        # keep a reference to the event filter - it would be deleted otherwise
+        self._event_filter = ViewClickFilter()
+
+    def view(self, name: str) -> Optional[ViewHandles]:
+        """
+        Handles of the view, or None if the view was never created.
+        """
 
-    if color == "Red":
-        orientation = "Axial"
-        hexColor = "#F34A33"
-    elif color == "Green":
-        orientation = "Coronal"
-        hexColor = "#6EB04B"
-    else:
-        orientation = "Sagittal"
-        hexColor = "#EDD54C"
-
-    customLayout = f"""
+        handles = self._views.get(name)
+        if handles is not None:
+            return handles
+
+        slice_widget = slicer.app.layoutManager().sliceWidget(name)
+        if slice_widget is None:
+            return None
+
+        handles = ViewHandles(slice_widget)
+        self._views[name] = handles
+
+        self._event_filter.add_view(name, handles.slice_view)
+        handles.slice_view.installEventFilter(self._event_filter)
+
+        return handles
+
+    def set_layout(self, layout: Layout, view_names: List[str], comparison_rows: int = 0) -> None:
+        """
+        Shows a layout of the module, registering all of them on the first call.
+
+        @param comparison_rows: Number of rows of the comparison layout, see set_comparison_layout().
+        """
+
+        start = time.perf_counter()
+
+        layout_node = slicer.app.layoutManager().layoutLogic().GetLayoutNode()
+        if not self._layouts_registered:
+            for registered_layout, description in layout_descriptions().items():
+                layout_node.AddLayoutDescription(registered_layout.value, description)
+            self._layouts_registered = True
+
+        layout_id = layout.value
+        if layout == Layout.L_COMPARISON:
+            layout_id = COMPARISON_LAYOUT_ID + comparison_rows
+            if comparison_rows not in self._registered_comparisons:
+                if layout_node.IsLayoutDescription(layout_id):
+                    layout_node.SetLayoutDescription(layout_id, comparison_layout_description(comparison_rows))
+                else:
+                    layout_node.AddLayoutDescription(layout_id, comparison_layout_description(comparison_rows))
+                self._registered_comparisons.add(comparison_rows)
+
+        # Switch to the custom layout
+        slicer.app.layoutManager().setLayout(layout_id)
+
+        for name in view_names:
+            self.view(name)
+
+        global current_layout
+        current_layout = layout
+
+        logging.debug(f"Switched to layout {layout.name} in {1000 * (time.perf_counter() - start):.1f} ms")
+
+        if layout_callback:
+            layout_callback(layout)
+
+    def invalidate(self) -> None:
+        """
+        Forgets the handles and registers the layouts again on the next switch, after scene close.
+        """
+
+        for handles in self._views.values():
+            handles.slice_view.removeEventFilter(self._event_filter)
+
+        self._views = {}
+        self._event_filter.view_widgets = {}
+        self._layouts_registered = False
+        self._registered_comparisons = set()
+
+
+def layout_1x2_description(color: Literal["Red", "Green", "Yellow"]) -> str:
+    orientation, hexColor = VIEW_COLORS[color]
+
+    return f"""
     <layout type="vertical" split="true">
         <item>
             <layout type="horizontal">
@@ -128,42 +263,8 @@ def set_1x2_layout(color: Literal["Red", "Green", "Yellow"]) -> None:
     </layout>
     """
 
-    # Create a unique layout ID based on the color
-    layoutIdMap = {"Red": 801, "Green": 802, "Yellow": 803}
-    customLayoutId = layoutIdMap[color]
-
-    layoutManager = slicer.app.layoutManager()
-    layoutManager.layoutLogic().GetLayoutNode(
-    ).AddLayoutDescription(customLayoutId, customLayout)
-
-    # Switch to the new custom layout
-    layoutManager.setLayout(customLayoutId)
-
-    # Create event filter
-    event_filter = ViewClickFilter(to_layout="set_2x3_layout")
 
-    # Install filter on all views
-    view_names = [f"{color}1", f"{color}2"]
-    for view_name in view_names:
-        slice_widget = layoutManager.sliceWidget(view_name)
-        if slice_widget:
-            view_widget = slice_widget.sliceView()
-            event_filter.add_view(view_name, view_widget)
-            view_widget.installEventFilter(event_filter)
-
-    # Keep a reference to the event filter - needs to be global so it won't be deleted
-    global _event_filter
-    _event_filter = event_filter
-
-    global layout_callback
-    if layout_callback:
-        layout_callback(Layout.L_1X2_RED if color == "Red" else
-                        Layout.L_1X2_GREEN if color == "Green" else
-                        Layout.L_1X2_YELLOW)
-
-
-def set_2x3_layout() -> None:
-    customLayout = """
+LAYOUT_2X3_DESCRIPTION = """
     <layout type="vertical" split="true">
     <item>
         <layout type="horizontal">
@@ -219,41 +320,7 @@ def set_2x3_layout() -> None:
     </layout>
     """
 
-    # Built-in layout IDs are all below 100, so you can choose any large random number
-    # for your custom layout ID.
-    customLayoutId = 701
-
-    layoutManager = slicer.app.layoutManager()
-    layoutManager.layoutLogic().GetLayoutNode(
-    ).AddLayoutDescription(customLayoutId, customLayout)
-
-    # Switch to the new custom layout
-    layoutManager.setLayout(customLayoutId)
-
-    # Create event filter
-    event_filter = ViewClickFilter(to_layout="set_1x2_layout")
-
-    # Install filter on all views
-    view_names = ['Red1', 'Green1', 'Yellow1', 'Red2', 'Green2', 'Yellow2']
-    for view_name in view_names:
-        slice_widget = layoutManager.sliceWidget(view_name)
-        if slice_widget:
-            view_widget = slice_widget.sliceView()
-            event_filter.add_view(view_name, view_widget)
-            view_widget.installEventFilter(event_filter)
-
-    # Keep a reference to the event filter
-    global _event_filter
-    _event_filter = event_filter
-
-    global layout_callback
-    if layout_callback:
-        layout_callback(Layout.L_2X3)
-
-
-def set_3x3_layout() -> None:
-
-    customLayout = """
+LAYOUT_3X3_DESCRIPTION = """
     <layout type="vertical" split="true">
     <item>
         <layout type="horizontal">
@@ -335,40 +402,112 @@ def set_3x3_layout() -> None:
     </layout>
     """
 
-    # Built-in layout IDs are all below 100, so you can choose any large random number
-    # for your custom layout ID.
-    customLayoutId = 601
 
-    layoutManager = slicer.app.layoutManager()
-    layoutManager.layoutLogic().GetLayoutNode(
-    ).AddLayoutDescription(customLayoutId, customLayout)
+def comparison_view_names(rows: int) -> List[List[str]]:
+    """
+    Names of the axial, coronal and sagittal view of every row of the comparison layout.
+    """
+
+    return [[f"{color}C{row}" for color in VIEW_COLORS] for row in range(rows)]
+
+
+def comparison_layout_description(rows: int) -> str:
+    """
+    Layout XML with the given number of rows of axial, coronal and sagittal views.
+    The rows are labelled by set_comparison_layout().
+    """
+
+    row_items = []
+    for row, names in enumerate(comparison_view_names(rows)):
+        view_items = []
+        for name, (orientation, hexColor) in zip(names, VIEW_COLORS.values()):
+            view_items.append(f"""
+            <item>
+                <view class="vtkMRMLSliceNode" singletontag="{name}">
+                <property name="orientation" action="default">{orientation}</property>
+                <property name="viewlabel" action="default">{row} - {orientation.lower()}</property>
+                <property name="viewcolor" action="default">{hexColor}</property>
+                </view>
+            </item>""")
+
+        row_items.append(f"""
+    <item>
+        <layout type="horizontal">{"".join(view_items)}
+        </layout>
+    </item>""")
+
+    return f"""
+    <layout type="vertical" split="true">{"".join(row_items)}
+    </layout>
+    """
+
+
+def layout_descriptions() -> Dict[Layout, str]:
+    """
+    The layout XML of every layout of the module.
+    """
 
-    # Switch to the new custom layout
-    layoutManager.setLayout(customLayoutId)
+    # Built-in layout IDs are all below 100, so the IDs of Layout are free
+    return {Layout.L_1X2_RED: layout_1x2_description("Red"),
+            Layout.L_1X2_GREEN: layout_1x2_description("Green"),
+            Layout.L_1X2_YELLOW: layout_1x2_description("Yellow"),
+            Layout.L_2X3: LAYOUT_2X3_DESCRIPTION,
+            Layout.L_3X3: LAYOUT_3X3_DESCRIPTION}
 
-    # Create event filter
-    event_filter = ViewClickFilter(to_layout="set_1x2_layout")
 
-    view_names = [
+registry = ViewRegistry()
+
+
+@batched_view_update()
+def set_1x2_layout(color: Literal["Red", "Green", "Yellow"]) -> None:
+    """
+    Switch to the custom 1x2 layout for the given color.
+    The two views (e.g., Red1 and Red2) are shown side by side.
+
+    Parameters:
+    - color (str): The color of the slice view to use ("Red", "Green", or "Yellow").
+    """
+
+    if color not in ["Red", "Green", "Yellow"]:
+        raise ValueError("Invalid color. Must be 'Red', 'Green', or 'Yellow'.")
+
+    layout = {"Red": Layout.L_1X2_RED, "Green": Layout.L_1X2_GREEN, "Yellow": Layout.L_1X2_YELLOW}[color]
+
+    registry.set_layout(layout, [f"{color}1", f"{color}2"])
+
+
+@batched_view_update()
+def set_2x3_layout() -> None:
+    registry.set_layout(Layout.L_2X3, ['Red1', 'Green1', 'Yellow1', 'Red2', 'Green2', 'Yellow2'])
+
+
+@batched_view_update()
+def set_3x3_layout() -> None:
+    registry.set_layout(Layout.L_3X3, [
         "Red1", "Green1", "Yellow1",
         "Red2", "Green2", "Yellow2",
-        "Red3", "Green3", "Yellow3"]
+        "Red3", "Green3", "Yellow3"])
 
-    # Install filter on all views
-    for view_name in view_names:
-        slice_widget = layoutManager.sliceWidget(view_name)
-        if slice_widget:
-            view_widget = slice_widget.sliceView()
-            event_filter.add_view(view_name, view_widget)
-            view_widget.installEventFilter(event_filter)
 
-    # Keep a reference to the event filter
-    global _event_filter
-    _event_filter = event_filter
+@batched_view_update()
+def set_comparison_layout(labels: List[str]) -> List[List[str]]:
+    """
+    Switches to a layout with one row of axial, coronal and sagittal views per label.
 
-    global layout_callback
-    if layout_callback:
-        layout_callback(Layout.L_3X3)
+    @param labels: Label of every row, e.g. "Fixed" followed by the compared transformations.
+    @return: The view names of every row.
+    """
+
+    views = comparison_view_names(len(labels))
+
+    registry.set_layout(Layout.L_COMPARISON, [view for row in views for view in row],
+                        comparison_rows=len(labels))
+
+    for row, label in zip(views, labels):
+        for view, (orientation, _) in zip(row, VIEW_COLORS.values()):
+            registry.view(view).slice_node.SetLayoutLabel(f"{label} - {orientation.lower()}")
+
+    return views
 
 
 def get_view_offset(view: str) -> float:
@@ -376,10 +515,7 @@ def get_view_offset(view: str) -> float:
     Get the current offset of the given view.
     """
 
-    sliceLogic = slicer.app.layoutManager().sliceWidget(view).sliceLogic()
-    sliceNode = sliceLogic.GetSliceNode()
-
-    return sliceNode.GetSliceOffset()
+    return registry.view(view).slice_node.GetSliceOffset()
 
 
 def set_view_offset(view: str, offset: float) -> None:
@@ -387,7 +523,12 @@ def set_view_offset(view: str, offset: float) -> None:
     Set the offset for the given view.
     """
 
-    sliceLogic = slicer.app.layoutManager().sliceWidget(view).sliceLogic()
-    sliceNode = sliceLogic.GetSliceNode()
+    registry.view(view).slice_node.SetSliceOffset(offset)
+
+
+def get_slice_to_ras(view: str) -> np.ndarray:
+    """
+    Get the SliceToRAS matrix of the given view.
+    """
 
-    sliceNode.SetSliceOffset(offset)
+    return slicer.util.arrayFromVTKMatrix(registry.view(view).slice_node.GetSliceToRAS())
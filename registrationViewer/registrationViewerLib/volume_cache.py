@@ -0,0 +1,127 @@
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+# default byte budget of the warped/difference cache
+DEFAULT_CACHE_BYTES = 2 * 1024 ** 3
+
+
+def node_key(node) -> Tuple:
+    """
+    Key identifying the content of a volume or transform node: its ID, the modification
+    time of the data it holds and, for volumes, the geometry of the voxel grid. Renaming
+    the node or editing its attributes or display does not change the key.
+
+    @param node: The MRML node, can be None.
+    """
+
+    if node is None:
+        return (None,)
+
+    data = None
+    geometry: Tuple = ()
+    if node.IsA("vtkMRMLVolumeNode"):
+        data = node.GetImageData()
+
+        directions = [[0.0] * 3 for _ in range(3)]
+        node.GetIToRASDirection(directions[0])
+        node.GetJToRASDirection(directions[1])
+        node.GetKToRASDirection(directions[2])
+        geometry = (tuple(node.GetOrigin()), tuple(node.GetSpacing()), tuple(map(tuple, directions)))
+    elif node.IsA("vtkMRMLTransformNode"):
+        data = node.GetTransformFromParent()
+
+    return (node.GetID(), data.GetMTime() if data is not None else None) + geometry
+
+
+class VolumeCache:
+    """
+    Least recently used cache of named arrays (e.g. warped and difference volumes)
+    with a byte budget.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES) -> None:
+        self.max_bytes = max_bytes
+
+        self._entries: 'OrderedDict[Hashable, Dict[str, np.ndarray]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _entry_bytes(entry: Dict[str, np.ndarray]) -> int:
+        return sum(array.nbytes for array in entry.values())
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self._entry_bytes(entry) for entry in self._entries.values())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Returns the entry stored under the key and marks it as most recently used.
+        """
+
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+
+        return entry
+
+    def put(self, key: Hashable, entry: Dict[str, np.ndarray], keep_oversize: bool = False) -> None:
+        """
+        Stores the arrays under the key and evicts least recently used entries until
+        the cache fits its budget. Entries larger than the whole budget are not stored.
+
+        The cache keeps references to the arrays, so callers must not modify them afterwards.
+
+        @param keep_oversize: Keep an entry larger than the budget as the only entry instead
+                              of dropping it, for results that are too costly to compute
+                              again. The budget is unchanged, the next put evicts it.
+        """
+
+        self._entries.pop(key, None)
+
+        if self._entry_bytes(entry) > self.max_bytes:
+            if keep_oversize:
+                self._entries.clear()
+                self._entries[key] = entry
+            return
+
+        self._entries[key] = entry
+        self._evict()
+
+    def reserve(self, nbytes: int) -> bool:
+        """
+        Evicts least recently used entries until an entry of the given size fits next to
+        the remaining ones, so it can be copied without exceeding the budget.
+
+        @return: False if the entry is larger than the whole budget, nothing is evicted then.
+        """
+
+        if nbytes > self.max_bytes:
+            return False
+
+        total = self.nbytes
+        while total + nbytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            total -= self._entry_bytes(entry)
+
+        return True
+
+    def _evict(self) -> None:
+        total = self.nbytes
+
+        while total > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            total -= self._entry_bytes(entry)
+
+    def clear(self) -> None:
+        self._entries.clear()
@@ -0,0 +1,472 @@
+"""
+In-process warping engine.
+
+Everything in this module works on plain NumPy arrays (in Slicer's [k, j, i]
+index order) and 4x4 homogeneous matrices, so it does not need MRML and can be
+used off the GUI thread or without Slicer at all.
+"""
+
+from typing import Any, Callable, List, Optional, Tuple
+
+import numpy as np
+
+# number of output voxels processed per chunk, bounds the size of the temporaries
+DEFAULT_CHUNK_VOXELS = 2 ** 21
+
+
+def apply_matrix(matrix: np.ndarray, points: np.ndarray) -> np.ndarray:
+    """
+    Applies a 4x4 homogeneous matrix to an (N, 3) array of points.
+
+    @param matrix: The 4x4 matrix.
+    @param points: The points, one per row.
+    """
+
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def sample_trilinear(volume: np.ndarray,
+                     points_ijk: np.ndarray,
+                     fill_value: Optional[float] = None,
+                     out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Trilinear interpolation of a volume at continuous voxel coordinates.
+
+    @param volume: Array indexed [k, j, i] (scalar) or [k, j, i, c] (vector).
+    @param points_ijk: (N, 3) array of (i, j, k) voxel coordinates.
+    @param fill_value: Value of points outside the volume. None clamps them to the border.
+    @param out: Optional preallocated output of shape (N,) or (N, c).
+    """
+
+    size = np.array(volume.shape[2::-1])
+    coords = np.asarray(points_ijk, dtype=np.float64)
+
+    lower = np.floor(coords)
+    frac = (coords - lower).astype(np.float32)
+    lower = lower.astype(np.intp)
+
+    index_0 = np.clip(lower, 0, size - 1)
+    index_1 = np.clip(lower + 1, 0, size - 1)
+
+    components = volume.shape[3:]
+    if out is not None and out.dtype.kind == 'f':
+        result = out
+        result.fill(0)
+    else:
+        result = np.zeros((coords.shape[0],) + components, dtype=np.float32)
+
+    for corner in range(8):
+        use_upper = [(corner >> axis) & 1 for axis in range(3)]
+
+        weight = np.ones(coords.shape[0], dtype=np.float32)
+        index = []
+        for axis in range(3):
+            if use_upper[axis]:
+                weight *= frac[:, axis]
+                index.append(index_1[:, axis])
+            else:
+                weight *= 1 - frac[:, axis]
+                index.append(index_0[:, axis])
+
+        values = volume[index[2], index[1], index[0]]
+        if components:
+            result += weight[:, None] * values
+        else:
+            result += weight * values
+
+    if fill_value is not None:
+        # same convention as ITK: voxels cover [-0.5, n - 0.5) in index space
+        outside = np.any((coords < -0.5) | (coords > size - 0.5), axis=1)
+        result[outside] = fill_value
+
+    if out is not None and result is not out:
+        if out.dtype.kind in 'iu':
+            np.rint(result, out=result)
+        out[...] = result
+        return out
+
+    return result
+
+
+def sample_trilinear_point(volume: np.ndarray, point_ijk) -> np.ndarray:
+    """
+    Trilinear interpolation of a volume at a single voxel coordinate, clamped to the border.
+    Cheaper than sample_trilinear() when only one point is needed, e.g. for a cursor.
+
+    @param volume: Array indexed [k, j, i] (scalar) or [k, j, i, c] (vector).
+    @param point_ijk: The (i, j, k) voxel coordinate.
+    """
+
+    starts = []
+    fractions = []
+    for axis, size in zip((2, 1, 0), volume.shape[:3]):
+        coordinate = min(max(float(point_ijk[axis]), 0.0), size - 1.0)
+        start = min(int(coordinate), max(size - 2, 0))
+        starts.append(start)
+        fractions.append(coordinate - start)
+
+    # 2x2x2 neighbourhood, or smaller along axes of size one
+    block = volume[starts[0]:starts[0] + 2,
+                   starts[1]:starts[1] + 2,
+                   starts[2]:starts[2] + 2].astype(np.float64)
+
+    for fraction in fractions:
+        if block.shape[0] == 2:
+            block = block[0] * (1 - fraction) + block[1] * fraction
+        else:
+            block = block[0]
+
+    return block
+
+
+def voxel_block_ras(ijk_to_ras: np.ndarray,
+                    k: np.ndarray,
+                    j: np.ndarray,
+                    i: np.ndarray) -> np.ndarray:
+    """
+    Returns the RAS coordinates of the voxel centres of the block spanned by the given indices.
+
+    @param ijk_to_ras: The 4x4 IJK to RAS matrix of the grid.
+    @param k: The slice indices of the block.
+    @param j: The row indices of the block.
+    @param i: The column indices of the block.
+    @return: (N, 3) array of points in [k, j, i] order.
+    """
+
+    k = np.asarray(k, dtype=np.float64)[:, None, None, None]
+    j = np.asarray(j, dtype=np.float64)[None, :, None, None]
+    i = np.asarray(i, dtype=np.float64)[None, None, :, None]
+
+    points = ijk_to_ras[:3, 3] + i * ijk_to_ras[:3, 0] + \
+        j * ijk_to_ras[:3, 1] + k * ijk_to_ras[:3, 2]
+
+    return points.reshape(-1, 3)
+
+
+def voxel_grid_ras(ijk_to_ras: np.ndarray,
+                   shape: Tuple[int, int, int],
+                   k_start: int = 0,
+                   k_stop: Optional[int] = None) -> np.ndarray:
+    """
+    Returns the RAS coordinates of the voxel centres of the slab [k_start, k_stop) of a grid.
+
+    @param ijk_to_ras: The 4x4 IJK to RAS matrix of the grid.
+    @param shape: The (k, j, i) shape of the grid.
+    @param k_start: First slice of the slab.
+    @param k_stop: One past the last slice of the slab, defaults to the whole grid.
+    @return: (N, 3) array of points in [k, j, i] order.
+    """
+
+    if k_stop is None:
+        k_stop = shape[0]
+
+    return voxel_block_ras(ijk_to_ras,
+                           np.arange(k_start, k_stop),
+                           np.arange(shape[1]),
+                           np.arange(shape[2]))
+
+
+def voxel_plane_ras(ijk_to_ras: np.ndarray,
+                    shape: Tuple[int, int, int],
+                    axis: int,
+                    index: int) -> np.ndarray:
+    """
+    Returns the RAS coordinates of the voxel centres of one plane of a grid.
+
+    @param ijk_to_ras: The 4x4 IJK to RAS matrix of the grid.
+    @param shape: The (k, j, i) shape of the grid.
+    @param axis: The array axis normal to the plane (0 = k, 1 = j, 2 = i).
+    @param index: The index of the plane along that axis.
+    @return: (N, 3) array of points in the order of the array plane.
+    """
+
+    ranges = [np.arange(n) for n in shape]
+    ranges[axis] = np.array([index])
+
+    return voxel_block_ras(ijk_to_ras, *ranges)
+
+
+class DisplacementField:
+    """
+    Displacement vectors on a regular grid, looked up in RAS space.
+
+    Points are mapped as p -> p + u(p), which is the resampling (fixed to moving)
+    direction of a registration result.
+    """
+
+    def __init__(self,
+                 array: np.ndarray,
+                 ijk_to_ras: np.ndarray,
+                 displacement_scale: float = 1.0,
+                 displacement_shift: float = 0.0) -> None:
+
+        assert array.ndim == 4 and array.shape[3] == 3, "Expected a [k, j, i, 3] array"
+
+        self.array = array
+        self.ijk_to_ras = np.asarray(ijk_to_ras, dtype=np.float64)
+        self.ras_to_ijk = np.linalg.inv(self.ijk_to_ras)
+        self.displacement_scale = displacement_scale
+        self.displacement_shift = displacement_shift
+
+    def displacements_at(self, points_ras: np.ndarray) -> np.ndarray:
+        """
+        Interpolates the displacement at the given (N, 3) RAS points.
+        """
+
+        displacement = sample_trilinear(
+            self.array, apply_matrix(self.ras_to_ijk, points_ras))
+
+        if self.displacement_scale != 1.0:
+            displacement *= self.displacement_scale
+        if self.displacement_shift != 0.0:
+            displacement += self.displacement_shift
+
+        return displacement
+
+    def transform_points(self, points_ras: np.ndarray) -> np.ndarray:
+        """
+        Maps the given (N, 3) RAS points through the field.
+        """
+
+        return points_ras + self.displacements_at(points_ras)
+
+    def transform_point(self, point_ras) -> np.ndarray:
+        """
+        Maps a single RAS point through the field with one trilinear interpolation.
+        """
+
+        point_ras = np.asarray(point_ras, dtype=np.float64)
+        point_ijk = self.ras_to_ijk[:3, :3] @ point_ras + self.ras_to_ijk[:3, 3]
+
+        displacement = sample_trilinear_point(self.array, point_ijk)
+
+        return point_ras + displacement * self.displacement_scale + self.displacement_shift
+
+    @property
+    def nbytes(self) -> int:
+        return self.array.nbytes
+
+
+class AffineMapping:
+    """
+    A linear transform as a 4x4 matrix, with the same interface as DisplacementField.
+
+    Warping with it only costs one matrix product per point, and its inverse is exact.
+    """
+
+    def __init__(self, matrix: np.ndarray) -> None:
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+
+    def transform_points(self, points_ras: np.ndarray) -> np.ndarray:
+        """
+        Maps the given (N, 3) RAS points through the matrix.
+        """
+
+        return apply_matrix(self.matrix, points_ras)
+
+    def transform_point(self, point_ras) -> np.ndarray:
+        return self.matrix[:3, :3] @ np.asarray(point_ras, dtype=np.float64) + self.matrix[:3, 3]
+
+    def inverse(self) -> 'AffineMapping':
+        return AffineMapping(np.linalg.inv(self.matrix))
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes
+
+
+class MappingStack:
+    """
+    Several mappings evaluated at the same point together, e.g. the cursor in a comparison
+    of many registration results.
+
+    The matrices of all affine mappings are applied in one product. The voxel coordinates
+    and interpolation weights of all displacement fields are computed as (K, ...) arrays,
+    only the 2x2x2 neighbourhood is gathered per field. Other mappings are evaluated one
+    by one with their transform_point().
+    """
+
+    def __init__(self, mappings: List[Any]) -> None:
+        self.mappings = list(mappings)
+
+        self._affine = [n for n, mapping in enumerate(self.mappings) if isinstance(mapping, AffineMapping)]
+        self._fields = [n for n, mapping in enumerate(self.mappings) if isinstance(mapping, DisplacementField)]
+        self._other = [n for n in range(len(self.mappings)) if n not in self._affine and n not in self._fields]
+
+        self._matrices = np.array([self.mappings[n].matrix for n in self._affine]).reshape(-1, 4, 4)
+
+        fields = [self.mappings[n] for n in self._fields]
+        self._arrays = [field.array for field in fields]
+        self._ras_to_ijk = np.array([field.ras_to_ijk for field in fields]).reshape(-1, 4, 4)
+        # (F, 3) grid sizes in (i, j, k) order
+        self._sizes = np.array([field.array.shape[2::-1] for field in fields]).reshape(-1, 3)
+        self._scales = np.array([field.displacement_scale for field in fields], dtype=np.float64)
+        self._shifts = np.array([field.displacement_shift for field in fields], dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.mappings)
+
+    def transform_point(self, point_ras) -> np.ndarray:
+        """
+        Maps a single RAS point through every mapping.
+
+        @return: (K, 3) array, row n is the point mapped by mappings[n].
+        """
+
+        point_ras = np.asarray(point_ras, dtype=np.float64)
+        result = np.empty((len(self.mappings), 3))
+
+        if self._affine:
+            result[self._affine] = self._matrices[:, :3, :3] @ point_ras + self._matrices[:, :3, 3]
+
+        if self._fields:
+            result[self._fields] = point_ras + self._field_displacements(point_ras)
+
+        for n in self._other:
+            result[n] = self.mappings[n].transform_point(point_ras)
+
+        return result
+
+    def _field_displacements(self, point_ras: np.ndarray) -> np.ndarray:
+        """
+        Trilinear displacements of all fields at the point, clamped to the border like
+        sample_trilinear_point().
+        """
+
+        point_ijk = self._ras_to_ijk[:, :3, :3] @ point_ras + self._ras_to_ijk[:, :3, 3]
+
+        coordinates = np.clip(point_ijk, 0.0, self._sizes - 1.0)
+        starts = np.minimum(coordinates.astype(np.intp), np.maximum(self._sizes - 2, 0))
+        # the second voxel equals the first along axes of size one
+        stops = np.minimum(starts + 1, self._sizes - 1)
+        fractions = coordinates - starts
+
+        # (F, 3, 2) weights of the lower and upper voxel along i, j and k
+        axis_weights = np.stack([1.0 - fractions, fractions], axis=2)
+        weights = np.einsum('fk,fj,fi->fkji', axis_weights[:, 2], axis_weights[:, 1], axis_weights[:, 0])
+
+        blocks = np.empty((len(self._arrays), 2, 2, 2, 3))
+        for n, array in enumerate(self._arrays):
+            blocks[n] = array[np.ix_((starts[n, 2], stops[n, 2]),
+                                     (starts[n, 1], stops[n, 1]),
+                                     (starts[n, 0], stops[n, 0]))]
+
+        displacements = np.einsum('fkji,fkjic->fc', weights, blocks)
+
+        return displacements * self._scales[:, None] + self._shifts[:, None]
+
+
+def warp_points(points_ras: np.ndarray,
+                moving: np.ndarray,
+                moving_ras_to_ijk: np.ndarray,
+                mapping,
+                fill_value: float = 0.0,
+                out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Samples the moving image at the mapped positions of the given points.
+
+    @param points_ras: (N, 3) points on the reference (fixed) grid.
+    @param moving: The moving image, indexed [k, j, i].
+    @param moving_ras_to_ijk: The RAS to IJK matrix of the moving image.
+    @param mapping: Object with a transform_points(points_ras) method, e.g. a DisplacementField.
+    @param fill_value: Value for points that map outside the moving image.
+    @param out: Optional preallocated output of shape (N,).
+    """
+
+    moving_ijk = apply_matrix(moving_ras_to_ijk,
+                              mapping.transform_points(points_ras))
+
+    return sample_trilinear(moving, moving_ijk, fill_value=fill_value, out=out)
+
+
+def sample_nearest(volume: np.ndarray, points_ijk: np.ndarray, fill_value=0) -> np.ndarray:
+    """
+    Samples a volume at (N, 3) IJK points with nearest-neighbour interpolation, e.g. label maps.
+
+    @param volume: The volume, indexed [k, j, i].
+    @param points_ijk: The points as (i, j, k) columns.
+    @param fill_value: Value for points outside the volume.
+    """
+
+    index = np.rint(points_ijk).astype(np.intp)
+    inside = np.all((index >= 0) & (index < np.array(volume.shape[2::-1])), axis=1)
+
+    result = np.full(index.shape[0], fill_value, dtype=volume.dtype)
+    result[inside] = volume[index[inside, 2], index[inside, 1], index[inside, 0]]
+
+    return result
+
+
+def warp_labels(labels: np.ndarray,
+                labels_ras_to_ijk: np.ndarray,
+                mapping,
+                reference_ijk_to_ras: np.ndarray,
+                out: np.ndarray,
+                chunk_voxels: int = DEFAULT_CHUNK_VOXELS) -> np.ndarray:
+    """
+    Warps a label map onto the reference grid with nearest-neighbour interpolation,
+    slab by slab like warp_volume().
+
+    @param out: Preallocated output with the (k, j, i) shape of the reference grid.
+    """
+
+    slab = max(1, chunk_voxels // max(1, out.shape[1] * out.shape[2]))
+
+    for k_start in range(0, out.shape[0], slab):
+        k_stop = min(out.shape[0], k_start + slab)
+
+        points = voxel_grid_ras(reference_ijk_to_ras, out.shape, k_start, k_stop)
+        labels_ijk = apply_matrix(labels_ras_to_ijk, mapping.transform_points(points))
+
+        out[k_start:k_stop] = sample_nearest(labels, labels_ijk).reshape(out[k_start:k_stop].shape)
+
+    return out
+
+
+def warp_volume(moving: np.ndarray,
+                moving_ras_to_ijk: np.ndarray,
+                mapping,
+                reference_ijk_to_ras: np.ndarray,
+                out: np.ndarray,
+                fill_value: float = 0.0,
+                chunk_voxels: int = DEFAULT_CHUNK_VOXELS,
+                progress_callback: Optional[Callable[[float], None]] = None) -> np.ndarray:
+    """
+    Warps the moving image onto the reference grid, writing straight into `out`.
+
+    The reference grid is processed in z-slabs of about `chunk_voxels` voxels, so the
+    temporaries stay small no matter how large the volume is.
+
+    @param moving: The moving image, indexed [k, j, i].
+    @param moving_ras_to_ijk: The RAS to IJK matrix of the moving image.
+    @param mapping: Object with a transform_points(points_ras) method, e.g. a DisplacementField.
+    @param reference_ijk_to_ras: The IJK to RAS matrix of the reference grid.
+    @param out: Preallocated output with the (k, j, i) shape of the reference grid.
+    @param fill_value: Value for voxels that map outside the moving image.
+    @param chunk_voxels: Approximate number of voxels per slab.
+    @param progress_callback: Called with the finished fraction after every slab.
+    """
+
+    slice_voxels = out.shape[1] * out.shape[2]
+    slab = max(1, chunk_voxels // max(1, slice_voxels))
+
+    for k_start in range(0, out.shape[0], slab):
+        k_stop = min(out.shape[0], k_start + slab)
+
+        points = voxel_grid_ras(reference_ijk_to_ras, out.shape, k_start, k_stop)
+
+        out_slab = out[k_start:k_stop]
+        if out.flags.c_contiguous:
+            warp_points(points, moving, moving_ras_to_ijk, mapping,
+                        fill_value=fill_value, out=out_slab.reshape(-1))
+        else:
+            values = np.empty(out_slab.size, dtype=out.dtype)
+            warp_points(points, moving, moving_ras_to_ijk, mapping,
+                        fill_value=fill_value, out=values)
+            out_slab[...] = values.reshape(out_slab.shape)
+
+        if progress_callback is not None:
+            progress_callback(k_stop / out.shape[0])
+
+    return out
+
@@ -0,0 +1,71 @@
+"""
+Wrapping NumPy arrays, e.g. memory-mapped cache entries, as VTK arrays without copying.
+
+VTK only borrows the buffer of a shallow array. numpy_to_vtk(deep=False) keeps the NumPy
+array as an attribute of the VTK array, and VTK keeps the attributes of an object for as
+long as the object lives, so a mapping is never closed while any node, pipeline or
+lookup still reads from it.
+"""
+
+from typing import Optional
+
+import numpy as np
+import slicer
+import vtk
+from vtk.util import numpy_support
+
+
+def wrap_array(array: np.ndarray, components: int = 1) -> vtk.vtkDataArray:
+    """
+    Returns a VTK array using the buffer of the given array.
+
+    Arrays that are not C-contiguous are copied once, everything else is shared.
+
+    @param array: The voxels, indexed [k, j, i] or [k, j, i, component].
+    @param components: Number of components per voxel.
+    """
+
+    if not array.flags.c_contiguous:
+        array = np.ascontiguousarray(array)
+
+    flat = array.reshape(-1, components) if components > 1 else array.reshape(-1)
+
+    return numpy_support.numpy_to_vtk(flat, deep=False)
+
+
+def image_from_array(array: np.ndarray, components: int = 1) -> vtk.vtkImageData:
+    """
+    vtkImageData whose point scalars share the buffer of the array, indexed [k, j, i(, c)].
+    """
+
+    image = vtk.vtkImageData()
+    image.SetDimensions(array.shape[2], array.shape[1], array.shape[0])
+    image.GetPointData().SetScalars(wrap_array(array, components))
+
+    return image
+
+
+def add_volume_from_array(array: np.ndarray,
+                          ijk_to_ras: np.ndarray,
+                          name: str,
+                          node_class_name: Optional[str] = None) -> slicer.vtkMRMLVolumeNode:
+    """
+    Like slicer.util.addVolumeFromArray, but the node uses the array without a copy.
+
+    @param array: The voxels, indexed [k, j, i] or, for vector volumes, [k, j, i, component].
+    @param node_class_name: Defaults to a scalar volume for 3D and a vector volume for 4D arrays.
+    """
+
+    if array.ndim not in (3, 4):
+        raise ValueError(f"Expected a [k, j, i] or [k, j, i, component] array, got {array.ndim} dimensions")
+
+    components = array.shape[3] if array.ndim == 4 else 1
+    if node_class_name is None:
+        node_class_name = "vtkMRMLVectorVolumeNode" if array.ndim == 4 else "vtkMRMLScalarVolumeNode"
+
+    node = slicer.mrmlScene.AddNewNodeByClass(node_class_name, name)
+    node.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(ijk_to_ras))
+    node.SetAndObserveImageData(image_from_array(array, components))
+    node.CreateDefaultDisplayNodes()
+
+    return node